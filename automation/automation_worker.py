@@ -0,0 +1,806 @@
+#!/usr/bin/env python3
+"""
+Worker persistente para os scripts de automação de etiquetas
+Mantém OpenCV, scikit-image, numpy, pdf2image e PIL carregados entre requisições,
+evitando iniciar um novo python3 a cada upload ou inspeção de etiqueta.
+
+Protocolo JSON lines (uma requisição por linha, via stdin/stdout ou socket Unix):
+    -> {"id": "42", "op": "compare", "params": {"reference": "ref.png", "test": "foto.jpg", "method": "ssim"}}
+    <- {"id": "42", "ok": true, "result": {...}, "error": null}
+
+Imagens e PDFs também podem ser enviados em memória, em base64
+(reference_b64, test_b64, tests_b64, frame_b64, pdf_b64), sem arquivos temporários.
+
+Rajadas de quadros da câmera usam stream_open, stream_frame (um por quadro) e
+stream_finish, com um stream_id escolhido pelo cliente; o pool encaminha todas
+as requisições de um fluxo para o mesmo worker.
+"""
+
+import os
+import sys
+import json
+import base64
+import time
+import signal
+import argparse
+import itertools
+import collections
+import logging
+import threading
+import socketserver
+import zlib
+import multiprocessing
+from multiprocessing.connection import wait
+from typing import Dict, Any, Callable, Optional, List
+
+# Importações "quentes": carregadas uma única vez por processo worker
+from image_comparison import (
+    FAST_SSIM_MODES, MAX_INPUT_BYTES, MAX_INPUT_PIXELS, SSIM_ENGINES, STREAM_MAX_FRAMES, STREAM_MAX_SECONDS,
+    ComparisonResultCache, FrameStream, IlluminationNormalizer, ImageComparator, ImageSource, QualityGate,
+    ReferenceFeatureStore, ReferenceIndex, SessionDedup
+)
+from pdf_to_image import PDFToImageConverter
+
+# Configurar logging (stderr, para não misturar com as respostas em stdout)
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+# Fluxos de quadros abertos por worker; acima disso, os mais antigos são descartados
+MAX_OPEN_STREAMS = 64
+
+ResponseCallback = Callable[[Dict[str, Any]], None]
+
+
+def _to_builtin(value: Any) -> Any:
+    """Converte escalares numpy e afins para tipos serializáveis em JSON"""
+    if hasattr(value, 'item'):
+        return value.item()
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    raise TypeError(f"Tipo não serializável: {type(value).__name__}")
+
+
+def encode_response(response: Dict[str, Any]) -> str:
+    """Serializa uma resposta em uma única linha JSON"""
+    return json.dumps(response, default=_to_builtin, ensure_ascii=False)
+
+
+def _image_param(params: Dict[str, Any], name: str) -> ImageSource:
+    """Imagem informada por caminho (name) ou pelo conteúdo em base64 (name_b64)"""
+    encoded = params.get(f'{name}_b64')
+    if encoded is not None:
+        return base64.b64decode(encoded)
+    return params[name]
+
+
+class RequestHandler:
+    """Executa as operações do worker reaproveitando objetos já inicializados"""
+
+    def __init__(self, config: Optional[Dict[str, Any]] = None):
+        config = config or {}
+        # As features das referências ficam em memória enquanto o worker vive;
+        # com cache_dir elas também são compartilhadas em disco entre os workers
+        feature_store = ReferenceFeatureStore(
+            max_bytes=int(config.get('feature_cache_mb', 256)) * 1024 * 1024,
+            cache_dir=config.get('feature_cache_dir')
+        )
+        # Resultados de comparações repetidas (novas tentativas do app com a mesma foto);
+        # com result_cache_db o cache é compartilhado entre os workers via SQLite
+        result_cache = None
+        if int(config.get('result_cache_size', 1024)) > 0:
+            result_cache = ComparisonResultCache(
+                max_entries=int(config.get('result_cache_size', 1024)),
+                ttl=config.get('result_cache_ttl'),
+                db_path=config.get('result_cache_db')
+            )
+        self.comparator = ImageComparator(
+            feature_store=feature_store,
+            working_pixels=int(config.get('working_pixels') or 0) or None,
+            profile_dir=config.get('profile_dir'),
+            ssim_engine=config.get('ssim_engine') or 'skimage',
+            fast_ssim_mode=config.get('fast_ssim_mode') or 'box',
+            result_cache=result_cache,
+            localize=bool(config.get('localize')),
+            # Iluminação do chão de fábrica: CLAHE e alinhamento ECC antes de comparar
+            normalizer=IlluminationNormalizer() if config.get('normalize') else None,
+            # Fotos tremidas, escuras ou pequenas são recusadas antes da comparação
+            quality_gate=QualityGate(**config['quality_gate']) if config.get('quality_gate') is not None else None,
+            # Fotos quase idênticas de uma mesma sessão reaproveitam o score; o pool
+            # encaminha as requisições de uma sessão sempre para o mesmo worker
+            session_dedup=SessionDedup(max_distance=int(config['session_dedup_distance']))
+            if int(config.get('session_dedup_distance', -1)) >= 0 else None,
+            # Entradas enormes são reduzidas na decodificação ou recusadas
+            max_pixels=config.get('max_input_pixels', MAX_INPUT_PIXELS),
+            max_bytes=config.get('max_input_bytes', MAX_INPUT_BYTES)
+        )
+        # Orçamentos da rasterização de PDFs; o conversor é criado a cada requisição
+        self.pdf_max_pixels = config.get('max_input_pixels', MAX_INPUT_PIXELS)
+        self.pdf_max_bytes = config.get('max_input_bytes', MAX_INPUT_BYTES)
+        # O índice de referências é carregado na primeira operação que o usa
+        self.index_path = config.get('reference_index')
+        self._index: Optional[ReferenceIndex] = None
+        # Fluxos de quadros abertos (stream_id -> FrameStream), do mais antigo ao mais recente
+        self.streams: 'collections.OrderedDict[str, FrameStream]' = collections.OrderedDict()
+        self.operations = {
+            'ping': self._ping,
+            'stats': self._stats,
+            'compare': self._compare,
+            'compare_all': self._compare_all,
+            'compare_batch': self._compare_batch,
+            'compare_cascade': self._compare_cascade,
+            'set_rois': self._set_rois,
+            'check_quality': self._check_quality,
+            'end_session': self._end_session,
+            'stream_open': self._stream_open,
+            'stream_frame': self._stream_frame,
+            'stream_finish': self._stream_finish,
+            'pdf_to_image': self._pdf_to_image,
+            'index_add': self._index_add,
+            'index_remove': self._index_remove,
+            'index_rebuild': self._index_rebuild,
+            'index_query': self._index_query
+        }
+
+    def handle(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        """Executa uma requisição e retorna a resposta (sem o id)"""
+        op = request.get('op')
+        params = request.get('params') or {}
+
+        try:
+            if op not in self.operations:
+                raise ValueError(f"Operação '{op}' não suportada")
+
+            result = self.operations[op](params)
+            return {'ok': True, 'result': result, 'error': None}
+
+        except Exception as e:
+            logger.error(f"Erro ao executar operação {op}: {str(e)}")
+            return {'ok': False, 'result': None, 'error': str(e)}
+
+    def _ping(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        return {'pid': os.getpid()}
+
+    def _stats(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        result_cache = self.comparator.result_cache
+        session_dedup = self.comparator.session_dedup
+        return {
+            'pid': os.getpid(),
+            'feature_store': self.comparator.feature_store.stats(),
+            'result_cache': result_cache.stats() if result_cache is not None else None,
+            'session_dedup': session_dedup.stats() if session_dedup is not None else None,
+            'open_streams': len(self.streams)
+        }
+
+    def _compare(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        return self.comparator.compare_images(
+            _image_param(params, 'reference'),
+            _image_param(params, 'test'),
+            params.get('method', 'ssim'),
+            threshold=params.get('threshold'),
+            instrument=params.get('instrument'),
+            rois=params.get('rois'),
+            session_id=params.get('session_id'),
+            photo_id=params.get('photo_id')
+        )
+
+    def _compare_all(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        return self.comparator.compare_multiple_methods(
+            _image_param(params, 'reference'),
+            _image_param(params, 'test'),
+            deadline=params.get('deadline'),
+            threshold=params.get('threshold'),
+            instrument=params.get('instrument'),
+            rois=params.get('rois')
+        )
+
+    def _compare_batch(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        tests = [base64.b64decode(item) for item in params['tests_b64']] if 'tests_b64' in params else params['tests']
+        return self.comparator.compare_batch(
+            _image_param(params, 'reference'),
+            tests,
+            params.get('method', 'ssim'),
+            threshold=params.get('threshold'),
+            instrument=params.get('instrument'),
+            rois=params.get('rois')
+        )
+
+    def _compare_cascade(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        return self.comparator.compare_cascade(
+            _image_param(params, 'reference'),
+            _image_param(params, 'test'),
+            float(params['threshold']),
+            final_method=params.get('final_method', 'ssim'),
+            cutoffs=params.get('cutoffs'),
+            instrument=params.get('instrument'),
+            rois=params.get('rois')
+        )
+
+    def _end_session(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        session_dedup = self.comparator.session_dedup
+        ended = session_dedup.forget(str(params['session_id'])) if session_dedup is not None else False
+        return {'session_id': params['session_id'], 'ended': ended}
+
+    def _stream_open(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        stream_id = str(params['stream_id'])
+        stream = self.comparator.open_stream(
+            _image_param(params, 'reference'),
+            params.get('method', 'ssim'),
+            threshold=params.get('threshold'),
+            rois=params.get('rois'),
+            max_frames=int(params.get('max_frames', STREAM_MAX_FRAMES)),
+            max_seconds=params.get('max_seconds', STREAM_MAX_SECONDS)
+        )
+        self.streams.pop(stream_id, None)
+        self.streams[stream_id] = stream
+        while len(self.streams) > MAX_OPEN_STREAMS:
+            dropped, _ = self.streams.popitem(last=False)
+            logger.warning(f"Fluxo {dropped} descartado: limite de {MAX_OPEN_STREAMS} fluxos abertos")
+        return {'stream_id': stream_id, 'max_frames': stream.max_frames, 'max_seconds': stream.max_seconds}
+
+    def _stream(self, params: Dict[str, Any]) -> FrameStream:
+        stream_id = str(params['stream_id'])
+        if stream_id not in self.streams:
+            # Também acontece se o worker do fluxo foi reiniciado: o cliente reabre o fluxo
+            raise ValueError(f"Fluxo '{stream_id}' não encontrado")
+        return self.streams[stream_id]
+
+    def _stream_frame(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        return {'stream_id': str(params['stream_id']), **self._stream(params).push(_image_param(params, 'frame'))}
+
+    def _stream_finish(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        stream = self._stream(params)
+        del self.streams[str(params['stream_id'])]
+        return stream.finish(
+            instrument=params.get('instrument'),
+            session_id=params.get('session_id'),
+            photo_id=params.get('photo_id')
+        )
+
+    def _check_quality(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        return self.comparator.check_quality(_image_param(params, 'test'))
+
+    def _set_rois(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        # Sem feature_cache_dir as regiões ficam só na memória deste processo;
+        # com vários workers, use o cache em disco ou envie rois em cada compare
+        return self.comparator.set_reference_rois(_image_param(params, 'reference'), params.get('rois'))
+
+    @property
+    def index(self) -> ReferenceIndex:
+        if self._index is None:
+            self._index = ReferenceIndex(self.comparator, self.index_path)
+        return self._index
+
+    def _index_add(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        return self.index.add(str(params['id']), _image_param(params, 'reference'))
+
+    def _index_remove(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        return {'id': str(params['id']), 'removed': self.index.remove(str(params['id']))}
+
+    def _index_rebuild(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        # Indexação das referências já cadastradas; o servidor envia em lotes
+        # para que cada requisição caiba no --request-timeout
+        references = [(str(item['id']), _image_param(item, 'reference')) for item in params['references']]
+        return self.index.rebuild(references, reset=bool(params.get('reset', False)))
+
+    def _index_query(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        matches = self.index.find_best_references(_image_param(params, 'photo'), int(params.get('k', 5)))
+        return {'matches': matches}
+
+    def _pdf_to_image(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        # Um conversor por requisição: no modo em processo (--workers 0) o servidor
+        # de socket atende requisições em threads, que não podem compartilhar as opções
+        converter = PDFToImageConverter()
+        converter.max_pixels = self.pdf_max_pixels
+        converter.max_bytes = self.pdf_max_bytes
+        converter.dpi = int(params.get('dpi', 300))
+        converter.format = params.get('format', 'PNG')
+        converter.first_page_only = not params.get('all_pages', False)
+
+        if 'pdf_b64' in params:
+            # Conversão em memória: a imagem volta em base64 na própria resposta
+            result = converter.convert_pdf_bytes_in_memory(
+                base64.b64decode(params['pdf_b64']),
+                params.get('filename', 'documento.pdf')
+            )
+            image_bytes = result.pop('image_bytes')
+            result['image_b64'] = base64.b64encode(image_bytes).decode('ascii') if image_bytes else None
+            return result
+
+        if params.get('upload_dir'):
+            return converter.convert_with_upload(params['pdf_path'], params['upload_dir'], params.get('output'))
+        return converter.convert_pdf_file(params['pdf_path'], params.get('output'))
+
+
+def _worker_main(conn, config: Dict[str, Any]) -> None:
+    """Laço principal de um processo worker: recebe requisições pelo pipe e responde"""
+    # O supervisor é quem trata Ctrl+C; os workers apenas terminam quando o pipe fecha
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    handler = RequestHandler(config)
+
+    while True:
+        try:
+            message = conn.recv()
+        except (EOFError, OSError):
+            break
+
+        if message is None:
+            break
+
+        seq, request = message
+        conn.send((seq, handler.handle(request)))
+
+
+class _WorkerSlot:
+    """Estado de um processo worker supervisionado"""
+
+    def __init__(self, index: int):
+        self.index = index
+        self.process = None
+        self.conn = None
+        self.started_at = 0.0
+        self.available = False
+        self.restarting = False
+        self.failures = 0
+        self.inflight: Dict[int, Dict[str, Any]] = {}
+
+
+class WorkerPool:
+    """Pool de processos worker com supervisão e reinício automático em caso de falha"""
+
+    def __init__(self, size: int = 1, request_timeout: Optional[float] = None,
+                 min_uptime: float = 2.0, max_restart_delay: float = 30.0,
+                 config: Optional[Dict[str, Any]] = None):
+        self.size = size
+        self.config = config or {}
+        self.request_timeout = request_timeout
+        self.min_uptime = min_uptime
+        self.max_restart_delay = max_restart_delay
+
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._seq = itertools.count()
+        self._slots: List[_WorkerSlot] = []
+        self._backlog = collections.deque()
+        self._dead: List[_WorkerSlot] = []
+        self._closing = False
+        self._collector = None
+        self._inline_handler = None
+        self._context = self._get_context()
+
+    @staticmethod
+    def _get_context():
+        """Usa forkserver com pré-carregamento quando disponível (Linux), senão spawn"""
+        if 'forkserver' in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context('forkserver')
+            context.set_forkserver_preload(['image_comparison', 'pdf_to_image'])
+            return context
+        return multiprocessing.get_context('spawn')
+
+    def start(self) -> None:
+        """Inicia os processos worker (ou o modo em processo, se size == 0)"""
+        if self.size <= 0:
+            self._inline_handler = RequestHandler(self.config)
+            logger.info("Worker executando em processo único (sem supervisão)")
+            return
+
+        for index in range(self.size):
+            slot = _WorkerSlot(index)
+            self._slots.append(slot)
+            self._spawn(slot)
+
+        self._collector = threading.Thread(target=self._collect, name='worker-collector', daemon=True)
+        self._collector.start()
+        logger.info(f"Pool iniciado com {self.size} worker(s)")
+
+    def _spawn(self, slot: _WorkerSlot) -> None:
+        parent_conn, child_conn = self._context.Pipe()
+        process = self._context.Process(target=_worker_main, args=(child_conn, self.config), daemon=True)
+        process.start()
+        child_conn.close()
+
+        slot.process = process
+        slot.conn = parent_conn
+        slot.started_at = time.monotonic()
+        slot.available = True
+        slot.restarting = False
+        logger.info(f"Worker {slot.index} iniciado (pid {process.pid})")
+        self._dispatch()
+
+    def _restart(self, slot: _WorkerSlot) -> None:
+        with self._lock:
+            if self._closing:
+                return
+            self._spawn(slot)
+
+    def submit(self, request: Dict[str, Any], callback: ResponseCallback) -> None:
+        """Envia uma requisição para o worker menos ocupado; a resposta chega pelo callback"""
+        if self._inline_handler is not None:
+            callback({'id': request.get('id'), **self._inline_handler.handle(request)})
+            return
+
+        with self._lock:
+            if self._closing:
+                error = 'Pool de workers em encerramento'
+            else:
+                error = None
+                self._backlog.append((request, callback))
+                self._dispatch()
+
+        if error:
+            callback({'id': request.get('id'), 'ok': False, 'result': None, 'error': error})
+
+    def _dispatch(self) -> None:
+        """Distribui a fila pendente entre os workers disponíveis (chamado com o lock)"""
+        while self._backlog:
+            candidates = [slot for slot in self._slots if slot.available]
+            if not candidates:
+                # Todos os workers estão reiniciando: a fila é drenada no próximo _spawn
+                return
+
+            request, callback = self._backlog.popleft()
+            slot = self._affine_slot(request, candidates) or min(candidates, key=lambda s: len(s.inflight))
+            seq = next(self._seq)
+            slot.inflight[seq] = {
+                'id': request.get('id'),
+                'callback': callback,
+                'started_at': time.monotonic()
+            }
+
+            try:
+                slot.conn.send((seq, request))
+            except (OSError, ValueError):
+                # Processo morreu entre verificações: a requisição volta para a fila
+                # e o slot fica indisponível até o coletor reiniciá-lo
+                slot.inflight.pop(seq, None)
+                slot.available = False
+                self._backlog.appendleft((request, callback))
+                self._dead.append(slot)
+
+    def _affine_slot(self, request: Dict[str, Any], candidates: List[_WorkerSlot]) -> Optional[_WorkerSlot]:
+        """Worker fixo das requisições com stream_id ou session_id, onde fica o estado delas
+
+        Se ele estiver reiniciando, a requisição vai para outro worker: uma
+        sessão apenas perde a deduplicação com as fotos anteriores, e um fluxo
+        de quadros responde que não foi encontrado.
+        """
+        params = request.get('params') or {}
+        key = params.get('stream_id', params.get('session_id'))
+        if key is None:
+            return None
+        slot = self._slots[zlib.crc32(str(key).encode()) % len(self._slots)]
+        return slot if slot in candidates else None
+
+    def _collect(self) -> None:
+        """Recebe respostas dos workers e supervisiona falhas e timeouts"""
+        while True:
+            with self._lock:
+                if self._closing and not any(slot.inflight for slot in self._slots):
+                    return
+                dead, self._dead = self._dead, []
+
+            for slot in dead:
+                self._handle_exit(slot)
+
+            with self._lock:
+                conns = {slot.conn: slot for slot in self._slots if slot.available}
+                sentinels = {slot.process.sentinel: slot for slot in self._slots if slot.available}
+
+            ready = wait(list(conns) + list(sentinels), timeout=0.5)
+
+            for item in ready:
+                if item in conns:
+                    self._receive(conns[item])
+
+            for item in ready:
+                if item in sentinels:
+                    self._handle_exit(sentinels[item])
+
+            self._check_timeouts()
+
+    def _receive(self, slot: _WorkerSlot) -> bool:
+        try:
+            seq, response = slot.conn.recv()
+        except (EOFError, OSError):
+            return False
+
+        with self._lock:
+            pending = slot.inflight.pop(seq, None)
+            slot.failures = 0
+            self._idle.notify_all()
+
+        if pending:
+            pending['callback']({'id': pending['id'], **response})
+        return True
+
+    def _handle_exit(self, slot: _WorkerSlot) -> None:
+        with self._lock:
+            if slot.restarting:
+                return
+            slot.restarting = True
+            slot.available = False
+
+        # Drenar respostas que chegaram antes do término do processo
+        try:
+            while slot.conn.poll() and self._receive(slot):
+                pass
+        except (EOFError, OSError):
+            pass
+
+        if slot.process.is_alive():
+            slot.process.terminate()
+        slot.process.join(timeout=5)
+
+        with self._lock:
+            exitcode = slot.process.exitcode
+            pending = list(slot.inflight.values())
+            slot.inflight.clear()
+            slot.conn.close()
+
+            uptime = time.monotonic() - slot.started_at
+            slot.failures = slot.failures + 1 if uptime < self.min_uptime else 0
+            # Falhas seguidas logo após a inicialização aumentam o intervalo de reinício
+            delay = min(self.max_restart_delay, 0.5 * (2 ** slot.failures)) if slot.failures > 1 else 0.0
+            self._idle.notify_all()
+
+        logger.warning(f"Worker {slot.index} finalizado (código {exitcode}); "
+                       f"{len(pending)} requisição(ões) perdida(s)")
+
+        for item in pending:
+            item['callback']({
+                'id': item['id'],
+                'ok': False,
+                'result': None,
+                'error': f'Worker finalizado inesperadamente (código {exitcode})'
+            })
+
+        if self._closing:
+            return
+
+        if delay:
+            logger.warning(f"Reiniciando worker {slot.index} em {delay:.1f}s")
+            timer = threading.Timer(delay, self._restart, args=(slot,))
+            timer.daemon = True
+            timer.start()
+        else:
+            self._restart(slot)
+
+    def _check_timeouts(self) -> None:
+        if not self.request_timeout:
+            return
+
+        now = time.monotonic()
+        with self._lock:
+            expired = [
+                slot for slot in self._slots
+                if slot.available and any(now - item['started_at'] > self.request_timeout
+                                          for item in slot.inflight.values())
+            ]
+
+        for slot in expired:
+            # O processo travado é encerrado; o reinício acontece via sentinel
+            logger.warning(f"Worker {slot.index} excedeu {self.request_timeout}s; encerrando processo")
+            slot.process.terminate()
+
+    def close(self, wait_pending: bool = True) -> None:
+        """Encerra o pool, aguardando (opcionalmente) as requisições em andamento"""
+        if self._inline_handler is not None:
+            return
+
+        with self._lock:
+            self._closing = True
+            if wait_pending:
+                while any(slot.inflight for slot in self._slots if slot.available):
+                    self._idle.wait(timeout=1.0)
+            orphaned = list(self._backlog)
+            self._backlog.clear()
+
+        for request, callback in orphaned:
+            callback({'id': request.get('id'), 'ok': False, 'result': None,
+                      'error': 'Pool de workers encerrado antes do processamento'})
+
+        for slot in self._slots:
+            if slot.available:
+                try:
+                    slot.conn.send(None)
+                except (OSError, ValueError):
+                    pass
+
+        for slot in self._slots:
+            if slot.process is not None:
+                slot.process.join(timeout=5)
+                if slot.process.is_alive():
+                    slot.process.terminate()
+
+        logger.info("Pool de workers encerrado")
+
+
+def _parse_request(line: str) -> Dict[str, Any]:
+    request = json.loads(line)
+    if not isinstance(request, dict):
+        raise ValueError('A requisição deve ser um objeto JSON')
+    return request
+
+
+def serve_stdio(pool: WorkerPool) -> None:
+    """Atende requisições JSON lines em stdin, respondendo em stdout"""
+    write_lock = threading.Lock()
+
+    def reply(response: Dict[str, Any]) -> None:
+        with write_lock:
+            sys.stdout.write(encode_response(response) + '\n')
+            sys.stdout.flush()
+
+    for line in sys.stdin:
+        line = line.strip()
+        if not line:
+            continue
+
+        try:
+            request = _parse_request(line)
+        except ValueError as e:
+            reply({'id': None, 'ok': False, 'result': None, 'error': f'Requisição inválida: {str(e)}'})
+            continue
+
+        pool.submit(request, reply)
+
+
+class _SocketRequestHandler(socketserver.StreamRequestHandler):
+    """Conexão de cliente no socket Unix: JSON lines nos dois sentidos"""
+
+    def handle(self):
+        pool: WorkerPool = self.server.pool
+        done = threading.Condition()
+        pending = [0]
+
+        def reply(response: Dict[str, Any]) -> None:
+            with done:
+                try:
+                    self.wfile.write((encode_response(response) + '\n').encode('utf-8'))
+                    self.wfile.flush()
+                except OSError:
+                    pass
+                pending[0] -= 1
+                done.notify_all()
+
+        for raw in self.rfile:
+            line = raw.decode('utf-8').strip()
+            if not line:
+                continue
+
+            with done:
+                pending[0] += 1
+
+            try:
+                request = _parse_request(line)
+            except ValueError as e:
+                reply({'id': None, 'ok': False, 'result': None, 'error': f'Requisição inválida: {str(e)}'})
+                continue
+
+            pool.submit(request, reply)
+
+        # Aguardar as respostas desta conexão antes de fechá-la
+        with done:
+            while pending[0] > 0:
+                done.wait()
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve_socket(pool: WorkerPool, socket_path: str) -> None:
+    """Atende requisições JSON lines em um socket Unix"""
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+
+    with _UnixServer(socket_path, _SocketRequestHandler) as server:
+        server.pool = pool
+        logger.info(f"Aguardando conexões em {socket_path}")
+        try:
+            server.serve_forever()
+        finally:
+            os.unlink(socket_path)
+
+
+def main():
+    """Função principal para execução via linha de comando"""
+    parser = argparse.ArgumentParser(description='Worker persistente para comparação de etiquetas e conversão de PDF')
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('AUTOMATION_WORKERS', 1)),
+                        help='Número de processos worker (0 = executar no próprio processo)')
+    parser.add_argument('--socket', help='Caminho do socket Unix (padrão: stdin/stdout)')
+    parser.add_argument('--request-timeout', type=float, default=None,
+                        help='Tempo máximo por requisição em segundos antes de reiniciar o worker')
+    parser.add_argument('--working-pixels', type=int,
+                        default=int(os.environ.get('LABEL_WORKING_PIXELS', 0)),
+                        help='Orçamento de pixels da resolução de trabalho (0 = resolução original). '
+                        'Reduzir a resolução muda os scores: recalibre o limite_aprovacao antes de ativar')
+    parser.add_argument('--ssim-engine', choices=SSIM_ENGINES,
+                        default=os.environ.get('LABEL_SSIM_ENGINE', 'skimage'),
+                        help='Implementação do SSIM: skimage (float64) ou fast (OpenCV em float32)')
+    parser.add_argument('--fast-ssim-mode', choices=FAST_SSIM_MODES,
+                        default=os.environ.get('LABEL_FAST_SSIM_MODE', 'box'),
+                        help='Janela do SSIM com --ssim-engine fast (box, gaussian ou integral)')
+    parser.add_argument('--result-cache-size', type=int,
+                        default=int(os.environ.get('LABEL_RESULT_CACHE_SIZE', 1024)),
+                        help='Máximo de resultados em memória por worker (0 = sem cache de resultados)')
+    parser.add_argument('--result-cache-ttl', type=float,
+                        default=float(os.environ.get('LABEL_RESULT_CACHE_TTL', 3600)),
+                        help='Validade (em segundos) dos resultados em cache')
+    parser.add_argument('--result-cache-db', default=os.environ.get('LABEL_RESULT_CACHE_DB'),
+                        help='Banco SQLite compartilhado para o cache de resultados')
+    parser.add_argument('--localize', action='store_true',
+                        default=os.environ.get('LABEL_LOCALIZE', '').lower() in ('1', 'true', 'yes'),
+                        help='Localizar e recortar a etiqueta na foto antes de comparar')
+    parser.add_argument('--normalize', action='store_true',
+                        default=os.environ.get('LABEL_NORMALIZE', '').lower() in ('1', 'true', 'yes'),
+                        help='Normalizar a iluminação (CLAHE) e alinhar a foto à referência (ECC) antes de comparar')
+    parser.add_argument('--quality-gate', nargs='?', const='{}', default=os.environ.get('LABEL_QUALITY_GATE'),
+                        metavar='LIMITES',
+                        help='Recusar fotos ruins antes de comparar; limites opcionais em JSON '
+                        '(ex.: \'{"min_sharpness": 80}\'). LABEL_QUALITY_GATE aceita 1/true ou o JSON')
+    parser.add_argument('--max-input-pixels', type=int,
+                        default=int(os.environ.get('LABEL_MAX_INPUT_PIXELS', MAX_INPUT_PIXELS)),
+                        help='Pixels máximos por imagem ou página de PDF; entradas maiores são reduzidas '
+                        '(JPEG, DPI do PDF) ou recusadas (0 = sem limite)')
+    parser.add_argument('--max-input-mb', type=int,
+                        default=int(os.environ.get('LABEL_MAX_INPUT_MB', MAX_INPUT_BYTES // (1024 * 1024))),
+                        help='Tamanho máximo de cada imagem ou PDF em MB (0 = sem limite)')
+    parser.add_argument('--session-dedup-distance', type=int,
+                        default=int(os.environ.get('LABEL_SESSION_DEDUP_DISTANCE', 4)),
+                        help='Distância de Hamming máxima (pHash e dHash) para reaproveitar o score de uma '
+                        'foto quase idêntica da mesma sessão (negativo = desativado)')
+    parser.add_argument('--reference-index', default=os.environ.get('LABEL_REFERENCE_INDEX'),
+                        help='Arquivo .npz do índice de referências (sem ele o índice fica só em memória)')
+    parser.add_argument('--profile-dir', default=os.environ.get('LABEL_PROFILE_DIR'),
+                        help='Diretório para gravar um perfil cProfile (.prof) por requisição')
+    parser.add_argument('--feature-cache-dir', default=os.environ.get('LABEL_FEATURE_CACHE_DIR'),
+                        help='Diretório para cache em disco das features de referência')
+    parser.add_argument('--feature-cache-mb', type=int, default=int(os.environ.get('LABEL_FEATURE_CACHE_MB', 256)),
+                        help='Orçamento de memória do cache de features por worker (MB)')
+
+    args = parser.parse_args()
+
+    quality_gate = None
+    if args.quality_gate and args.quality_gate.lower() not in ('0', 'false', 'no'):
+        quality_gate = {} if args.quality_gate.lower() in ('1', 'true', 'yes') else json.loads(args.quality_gate)
+
+    config = {
+        'working_pixels': args.working_pixels,
+        'profile_dir': args.profile_dir,
+        'reference_index': args.reference_index,
+        'localize': args.localize,
+        'normalize': args.normalize,
+        'quality_gate': quality_gate,
+        'session_dedup_distance': args.session_dedup_distance,
+        'max_input_pixels': args.max_input_pixels or None,
+        'max_input_bytes': args.max_input_mb * 1024 * 1024 or None,
+        'result_cache_size': args.result_cache_size,
+        'result_cache_ttl': args.result_cache_ttl,
+        'result_cache_db': args.result_cache_db,
+        'ssim_engine': args.ssim_engine,
+        'fast_ssim_mode': args.fast_ssim_mode,
+        'feature_cache_dir': args.feature_cache_dir,
+        'feature_cache_mb': args.feature_cache_mb
+    }
+    pool = WorkerPool(size=args.workers, request_timeout=args.request_timeout, config=config)
+    pool.start()
+
+    # SIGTERM (enviado pelo servidor Node) encerra o pool de forma ordenada
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    try:
+        if args.socket:
+            serve_socket(pool, args.socket)
+        else:
+            serve_stdio(pool)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        pool.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,390 @@
+#!/usr/bin/env python3
+"""
+Comparação em lote de pares (referência, foto) com um pool de processos
+Usado na revalidação noturna de inspeções históricas quando limites ou métodos
+mudam. Cada referência é decodificada uma única vez pelo processo principal e
+publicada em multiprocessing.shared_memory; os workers mapeiam esses arrays
+sem cópia. Os resultados são emitidos como NDJSON (uma linha por par), o
+progresso vai para stderr e, com um checkpoint, o job pode ser retomado.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import logging
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from multiprocessing import shared_memory
+from typing import Dict, Any, Iterator, List, Optional, Set, TextIO, Tuple
+
+import numpy as np
+
+from image_comparison import (
+    FAST_SSIM_MODES, SSIM_ENGINES, IlluminationNormalizer, ImageComparator, ImageFeatures, QualityGate,
+    normalize_rois
+)
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s',
+    stream=sys.stderr
+)
+logger = logging.getLogger(__name__)
+
+# Alinhamento dos arrays dentro do bloco de memória compartilhada de cada referência
+_ALIGNMENT = 64
+
+# Quantos blocos de memória compartilhada cada worker mantém mapeados
+_WORKER_ATTACHMENTS = 32
+
+
+class SharedReference:
+    """Features de uma referência publicadas em um único bloco de memória compartilhada
+
+    Os arrays vão para o bloco; as regiões de interesse, que são pequenas,
+    seguem no próprio descritor (JSON).
+    """
+
+    def __init__(self, features: ImageFeatures):
+        arrays = features.arrays()
+        layout = {}
+        offset = 0
+        for name, array in arrays.items():
+            layout[name] = (offset, array.shape, array.dtype.str)
+            offset += -(-array.nbytes // _ALIGNMENT) * _ALIGNMENT
+
+        self.shm = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+        for name, array in arrays.items():
+            start, shape, dtype = layout[name]
+            np.ndarray(shape, dtype=dtype, buffer=self.shm.buf, offset=start)[...] = array
+
+        # Descrição enviada aos workers: o nome do bloco e a posição de cada array
+        self.descriptor = {'name': self.shm.name, 'layout': layout, 'rois': features.rois}
+        self.remaining = 0  # pares ainda não concluídos desta referência
+
+    def release(self) -> None:
+        self.shm.close()
+        self.shm.unlink()
+
+
+# Estado de cada processo worker (inicializado por _init_worker)
+_comparator: Optional[ImageComparator] = None
+_attachments: 'OrderedDict[str, Tuple[shared_memory.SharedMemory, ImageFeatures]]' = OrderedDict()
+
+
+def _init_worker(config: Dict[str, Any]) -> None:
+    global _comparator
+    import cv2
+    # O paralelismo vem dos processos; threads do OpenCV só competiriam entre si
+    cv2.setNumThreads(1)
+    logging.getLogger('image_comparison').setLevel(logging.WARNING)
+    _comparator = _build_comparator(config)
+
+
+def _build_comparator(config: Dict[str, Any]) -> ImageComparator:
+    return ImageComparator(
+        working_pixels=config.get('working_pixels') or None,
+        ssim_engine=config.get('ssim_engine') or 'skimage',
+        fast_ssim_mode=config.get('fast_ssim_mode') or 'box',
+        localize=bool(config.get('localize')),
+        normalizer=IlluminationNormalizer() if config.get('normalize') else None,
+        quality_gate=QualityGate(**config['quality_gate']) if config.get('quality_gate') is not None else None
+    )
+
+
+def _attach(descriptor: Dict[str, Any]) -> ImageFeatures:
+    """Features de uma referência mapeadas diretamente da memória compartilhada"""
+    name = descriptor['name']
+    if name in _attachments:
+        _attachments.move_to_end(name)
+        return _attachments[name][1]
+
+    shm = shared_memory.SharedMemory(name=name)
+    arrays = {}
+    for array_name, (offset, shape, dtype) in descriptor['layout'].items():
+        array = np.ndarray(tuple(shape), dtype=dtype, buffer=shm.buf, offset=offset)
+        array.flags.writeable = False
+        arrays[array_name] = array
+    features = ImageFeatures.from_arrays(arrays).with_rois(descriptor.get('rois'))
+
+    _attachments[name] = (shm, features)
+    while len(_attachments) > _WORKER_ATTACHMENTS:
+        _, (old_shm, old_features) = _attachments.popitem(last=False)
+        # Os arrays precisam ser liberados antes de fechar o mapeamento
+        del old_features
+        try:
+            old_shm.close()
+        except BufferError:
+            pass  # ainda há views vivas; o mapeamento é liberado com o processo
+    return features
+
+
+def _compare_pair(task: Tuple[int, Dict[str, Any], Dict[str, Any], str, Optional[float]]) -> Dict[str, Any]:
+    index, pair, descriptor, method, threshold = task
+    reference = _attach(descriptor)
+    if pair.get('rois') is not None:
+        reference = reference.with_rois(normalize_rois(pair['rois']))
+    result = _comparator._compare_with_reference(reference, pair['reference'], pair['test'], method, threshold)
+    return _annotate(result, index, pair, threshold)
+
+
+def _annotate(result: Dict[str, Any], index: int, pair: Dict[str, Any],
+              threshold: Optional[float]) -> Dict[str, Any]:
+    """Acrescenta ao resultado a posição do par, o id de origem e o veredito"""
+    result['index'] = index
+    if 'id' in pair:
+        result['id'] = pair['id']
+    if threshold is not None and result['success']:
+        result['threshold'] = threshold
+        result['approved'] = result['score'] >= threshold
+    return result
+
+
+def read_pairs(stream: TextIO) -> List[Dict[str, Any]]:
+    """Lê os pares de um NDJSON: {"reference": ..., "test": ..., "id"?, "method"?, "threshold"?, "rois"?}"""
+    pairs = []
+    for number, line in enumerate(stream, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        pair = json.loads(line)
+        if 'reference' not in pair or 'test' not in pair:
+            raise ValueError(f"Linha {number}: os campos 'reference' e 'test' são obrigatórios")
+        pairs.append(pair)
+    return pairs
+
+
+def load_checkpoint(path: Optional[str]) -> Set[int]:
+    """Índices dos pares já concluídos em uma execução anterior
+
+    Uma última linha sem quebra de linha (job interrompido no meio da escrita)
+    é descartada do arquivo, para que as próximas anotações não se misturem a ela.
+    """
+    if not path or not os.path.exists(path):
+        return set()
+
+    with open(path, 'rb+') as f:
+        content = f.read()
+        complete = content[:content.rfind(b'\n') + 1]
+        if len(complete) != len(content):
+            f.truncate(len(complete))
+
+    return {int(line) for line in complete.split() if line.isdigit()}
+
+
+def iter_batch_results(pairs: List[Dict[str, Any]], method: str = 'ssim', threshold: Optional[float] = None,
+                       workers: Optional[int] = None, config: Optional[Dict[str, Any]] = None,
+                       skip: Optional[Set[int]] = None) -> Iterator[Dict[str, Any]]:
+    """Compara os pares em um pool de processos e produz os resultados à medida que terminam
+
+    Os pares são agrupados por referência; cada referência é decodificada uma
+    vez no processo principal, publicada em memória compartilhada enquanto
+    houver pares pendentes e liberada em seguida. method, threshold e as
+    regiões de interesse (config['rois']) podem ser sobrescritos por par.
+    Pares em skip (checkpoint) não são recomparados.
+    """
+    config = config or {}
+    skip = skip or set()
+    workers = workers or os.cpu_count() or 1
+    comparator = _build_comparator(config)
+
+    # Pares pendentes agrupados por referência, na ordem em que aparecem
+    groups: 'OrderedDict[str, List[int]]' = OrderedDict()
+    for index, pair in enumerate(pairs):
+        if index not in skip:
+            groups.setdefault(pair['reference'], []).append(index)
+
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('forkserver')
+        context.set_forkserver_preload(['image_comparison'])
+    else:
+        context = multiprocessing.get_context('spawn')
+
+    max_in_flight = workers * 4
+    in_flight: Dict[Any, Tuple[int, Optional[SharedReference]]] = {}
+
+    def collect() -> Iterator[Dict[str, Any]]:
+        done, _ = wait(list(in_flight), return_when=FIRST_COMPLETED)
+        for future in done:
+            index, shared = in_flight.pop(future)
+            try:
+                result = future.result()
+            except Exception as e:
+                pair = pairs[index]
+                result = _annotate(
+                    comparator._build_result(pair.get('method', method), 0.0, pair['reference'], pair['test'],
+                                             error=str(e)),
+                    index, pair, None
+                )
+            if shared is not None:
+                shared.remaining -= 1
+                if shared.remaining == 0:
+                    shared.release()
+            yield result
+
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                             initializer=_init_worker, initargs=(config,)) as executor:
+        try:
+            for reference_path, indexes in groups.items():
+                try:
+                    features = comparator.prepare_reference(reference_path)
+                    if config.get('rois'):
+                        features = features.with_rois(normalize_rois(config['rois']))
+                    shared = SharedReference(features)
+                except Exception as e:
+                    logger.error(f"Erro ao preparar referência {reference_path}: {str(e)}")
+                    for index in indexes:
+                        pair = pairs[index]
+                        yield _annotate(
+                            comparator._build_result(pair.get('method', method), 0.0, reference_path,
+                                                     pair['test'], error=str(e)),
+                            index, pair, None
+                        )
+                    continue
+
+                shared.remaining = len(indexes)
+                for index in indexes:
+                    while len(in_flight) >= max_in_flight:
+                        yield from collect()
+
+                    pair = pairs[index]
+                    task = (index, pair, shared.descriptor, pair.get('method', method),
+                            pair.get('threshold', threshold))
+                    in_flight[executor.submit(_compare_pair, task)] = (index, shared)
+
+            while in_flight:
+                yield from collect()
+
+        finally:
+            # Interrupção: liberar os blocos das referências ainda em uso
+            for future, (_, shared) in list(in_flight.items()):
+                future.cancel()
+                if shared is not None and shared.remaining > 0:
+                    shared.remaining = 0
+                    shared.release()
+
+
+def run_batch(pairs: List[Dict[str, Any]], output: TextIO, method: str = 'ssim',
+              threshold: Optional[float] = None, workers: Optional[int] = None,
+              config: Optional[Dict[str, Any]] = None, checkpoint: Optional[str] = None,
+              progress_interval: float = 10.0) -> Dict[str, Any]:
+    """Executa o lote gravando uma linha NDJSON por par e o progresso em stderr
+
+    Com checkpoint, os índices concluídos são anotados nesse arquivo (depois
+    que o resultado foi gravado) e uma nova execução com o mesmo arquivo
+    continua de onde a anterior parou.
+    """
+    completed = load_checkpoint(checkpoint)
+    total = len(pairs)
+    pending = total - len([index for index in completed if index < total])
+    if completed:
+        logger.info(f"Retomando lote: {total - pending} de {total} pares já concluídos")
+
+    checkpoint_file = open(checkpoint, 'a') if checkpoint else None
+    started = last_report = time.perf_counter()
+    done = failed = approved = 0
+
+    def report(final: bool = False) -> None:
+        elapsed = time.perf_counter() - started
+        rate = done / elapsed if elapsed > 0 else 0.0
+        progress = {
+            'type': 'progress',
+            'done': done,
+            'pending': pending - done,
+            'total': total,
+            'failed': failed,
+            'pairs_per_second': round(rate, 2),
+            'eta_seconds': round((pending - done) / rate, 1) if rate > 0 else None,
+            'final': final
+        }
+        sys.stderr.write(json.dumps(progress) + '\n')
+        sys.stderr.flush()
+
+    try:
+        for result in iter_batch_results(pairs, method, threshold, workers, config, skip=completed):
+            output.write(json.dumps(result, ensure_ascii=False, default=float) + '\n')
+            output.flush()
+            if checkpoint_file:
+                checkpoint_file.write(f"{result['index']}\n")
+                checkpoint_file.flush()
+
+            done += 1
+            failed += not result['success']
+            approved += bool(result.get('approved'))
+            if progress_interval and time.perf_counter() - last_report >= progress_interval:
+                last_report = time.perf_counter()
+                report()
+    finally:
+        if checkpoint_file:
+            checkpoint_file.close()
+
+    report(final=True)
+    return {
+        'total': total,
+        'compared': done,
+        'skipped': total - pending,
+        'failed': failed,
+        'approved': approved,
+        'elapsed_seconds': round(time.perf_counter() - started, 2)
+    }
+
+
+def main():
+    """Função principal para execução via linha de comando"""
+    parser = argparse.ArgumentParser(description='Comparação em lote de pares (referência, foto) em NDJSON')
+    parser.add_argument('pairs', help='Arquivo NDJSON com os pares ("-" para stdin)')
+    parser.add_argument('--output', help='Arquivo NDJSON de saída (padrão: stdout; acrescenta ao retomar)')
+    parser.add_argument('--checkpoint', help='Arquivo de checkpoint para retomar o lote')
+    parser.add_argument('--method', choices=['ssim', 'orb', 'template', 'color'],
+                       default='ssim', help='Método de comparação (o par pode sobrescrever)')
+    parser.add_argument('--threshold', type=float,
+                       help='Limite de aprovação (o par pode sobrescrever); acrescenta approved ao resultado')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='Número de processos')
+    parser.add_argument('--working-pixels', type=int, default=0,
+                       help='Orçamento de pixels da resolução de trabalho (0 = resolução original)')
+    parser.add_argument('--ssim-engine', choices=SSIM_ENGINES, default='skimage',
+                       help='Implementação do SSIM: skimage (float64) ou fast (OpenCV em float32)')
+    parser.add_argument('--fast-ssim-mode', choices=FAST_SSIM_MODES, default='box',
+                       help='Janela do SSIM com --ssim-engine fast')
+    parser.add_argument('--localize', action='store_true',
+                       help='Localizar e recortar a etiqueta na foto antes de comparar')
+    parser.add_argument('--normalize', action='store_true',
+                       help='Normalizar a iluminação (CLAHE) e alinhar a foto à referência (ECC) antes de comparar')
+    parser.add_argument('--quality-gate', nargs='?', const='{}', default=None, metavar='LIMITES',
+                       help='Recusar fotos ruins antes de comparar; limites opcionais em JSON')
+    parser.add_argument('--rois', help='Regiões de interesse de todas as referências: arquivo JSON ou JSON '
+                       'em linha, coordenadas em frações (o par pode sobrescrever)')
+    parser.add_argument('--progress-interval', type=float, default=10.0,
+                       help='Intervalo (em segundos) entre as linhas de progresso em stderr')
+
+    args = parser.parse_args()
+
+    if args.pairs == '-':
+        pairs = read_pairs(sys.stdin)
+    else:
+        with open(args.pairs, 'r', encoding='utf-8') as f:
+            pairs = read_pairs(f)
+
+    config = {'working_pixels': args.working_pixels, 'ssim_engine': args.ssim_engine,
+              'fast_ssim_mode': args.fast_ssim_mode,
+              'localize': args.localize, 'normalize': args.normalize,
+              'quality_gate': json.loads(args.quality_gate) if args.quality_gate else None,
+              'rois': json.loads(open(args.rois, encoding='utf-8').read() if os.path.exists(args.rois)
+                                 else args.rois) if args.rois else None}
+    output = open(args.output, 'a', encoding='utf-8') if args.output else sys.stdout
+    try:
+        summary = run_batch(pairs, output, args.method, args.threshold, args.workers, config,
+                            args.checkpoint, args.progress_interval)
+    finally:
+        if args.output:
+            output.close()
+
+    logger.info(f"Lote concluído: {json.dumps(summary)}")
+    sys.exit(0 if summary['failed'] == 0 else 1)
+
+
+if __name__ == "__main__":
+    main()
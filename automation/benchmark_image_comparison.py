@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+"""
+Benchmark reproduzível do ImageComparator (automation/image_comparison.py)
+Gera pares sintéticos de etiquetas (texto e código de barras com perturbações
+controladas) em várias resoluções e formatos e mede latência, vazão e pico de
+memória de cada método. Os resultados são gravados em JSON para comparação
+entre versões.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import argparse
+import platform
+import subprocess
+import multiprocessing
+import logging
+from datetime import datetime
+from typing import Dict, Any, List, Tuple, Optional
+
+import cv2
+import numpy as np
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RESOLUTIONS = ['640x480', '1600x1200', '4000x3000']
+DEFAULT_FORMATS = ['png', 'jpg']
+DEFAULT_METHODS = ['ssim', 'orb', 'template', 'all']
+
+# Perturbações aplicadas à etiqueta de referência para gerar as fotos de teste
+PERTURBATIONS = ['identical', 'blur', 'noise', 'brightness', 'rotation', 'defect']
+
+
+def render_label(width: int, height: int, seed: int = 0) -> np.ndarray:
+    """Desenha uma etiqueta sintética: textos, código de barras, logotipo e moldura"""
+    rng = np.random.default_rng(seed)
+    label = np.full((height, width, 3), 255, dtype=np.uint8)
+    unit = min(width, height) / 480.0
+
+    cv2.rectangle(label, (int(10 * unit), int(10 * unit)),
+                  (width - int(10 * unit), height - int(10 * unit)), (0, 0, 0), max(1, int(3 * unit)))
+
+    lines = ['MODELO XR-2040', '220V ~ 60Hz  1500W', 'INMETRO  REG. 004512/2024', 'IND. BRASILEIRA']
+    for index, text in enumerate(lines):
+        color = (0, 0, 200) if index == 1 else (0, 0, 0)
+        position = (int(30 * unit), int((60 + index * 45) * unit))
+        cv2.putText(label, text, position, cv2.FONT_HERSHEY_SIMPLEX, 0.9 * unit, color, max(1, int(2 * unit)))
+
+    # Código de barras com larguras de barra aleatórias (mas reprodutíveis)
+    x = int(30 * unit)
+    top, bottom = int(260 * unit), int(420 * unit)
+    while x < width * 0.6:
+        bar = int(rng.integers(1, 5) * unit) or 1
+        cv2.rectangle(label, (x, top), (x + bar, bottom), (0, 0, 0), -1)
+        x += bar + (int(rng.integers(1, 4) * unit) or 1)
+
+    center = (int(width * 0.8), int(height * 0.7))
+    cv2.circle(label, center, int(60 * unit), (0, 120, 0), max(1, int(4 * unit)))
+    cv2.putText(label, 'CE', (center[0] - int(30 * unit), center[1] + int(15 * unit)),
+                cv2.FONT_HERSHEY_SIMPLEX, 1.4 * unit, (0, 120, 0), max(1, int(3 * unit)))
+    return label
+
+
+def perturb(label: np.ndarray, kind: str, seed: int = 0) -> np.ndarray:
+    """Aplica uma perturbação controlada à etiqueta"""
+    rng = np.random.default_rng(seed)
+    height, width = label.shape[:2]
+
+    if kind == 'identical':
+        return label.copy()
+    if kind == 'blur':
+        size = max(3, (min(width, height) // 160) | 1)
+        return cv2.GaussianBlur(label, (size, size), 0)
+    if kind == 'noise':
+        noise = rng.normal(0, 12, label.shape)
+        return np.clip(label.astype(np.float32) + noise, 0, 255).astype(np.uint8)
+    if kind == 'brightness':
+        return cv2.convertScaleAbs(label, alpha=0.85, beta=25)
+    if kind == 'rotation':
+        matrix = cv2.getRotationMatrix2D((width / 2, height / 2), 3.0, 0.97)
+        return cv2.warpAffine(label, matrix, (width, height), borderValue=(255, 255, 255))
+    if kind == 'defect':
+        damaged = label.copy()
+        cv2.rectangle(damaged, (int(width * 0.05), int(height * 0.2)),
+                      (int(width * 0.45), int(height * 0.3)), (255, 255, 255), -1)
+        return damaged
+    raise ValueError(f"Perturbação desconhecida: {kind}")
+
+
+def generate_dataset(directory: str, resolution: str, image_format: str) -> Tuple[str, List[str]]:
+    """Grava a referência e as fotos de teste de uma resolução/formato"""
+    width, height = (int(value) for value in resolution.split('x'))
+    label = render_label(width, height)
+    params = [cv2.IMWRITE_JPEG_QUALITY, 90] if image_format == 'jpg' else []
+
+    reference_path = os.path.join(directory, f'ref_{resolution}.{image_format}')
+    cv2.imwrite(reference_path, label, params)
+
+    test_paths = []
+    for index, kind in enumerate(PERTURBATIONS):
+        path = os.path.join(directory, f'test_{resolution}_{kind}.{image_format}')
+        cv2.imwrite(path, perturb(label, kind, seed=index), params)
+        test_paths.append(path)
+
+    return reference_path, test_paths
+
+
+def _peak_rss_mb() -> Optional[float]:
+    if resource is None:
+        return None
+    # ru_maxrss é em KB no Linux e em bytes no macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def _run_case(case: Dict[str, Any], queue) -> None:
+    """Executa um caso em processo isolado, para que o pico de RSS seja só dele"""
+    logging.disable(logging.CRITICAL)
+    from image_comparison import ImageComparator
+
+    comparator = ImageComparator(working_pixels=case['working_pixels'], ssim_engine=case['ssim_engine'])
+    baseline_rss = _peak_rss_mb()
+
+    def compare(test_path: str) -> Dict[str, Any]:
+        if case['method'] == 'all':
+            return comparator.compare_multiple_methods(case['reference'], test_path)
+        return comparator.compare_images(case['reference'], test_path, case['method'])
+
+    for test_path in case['tests'][:case['warmup']]:
+        compare(test_path)
+
+    latencies = []
+    scores = {}
+    started = time.perf_counter()
+    for iteration in range(case['iterations']):
+        test_path = case['tests'][iteration % len(case['tests'])]
+        call_started = time.perf_counter()
+        result = compare(test_path)
+        latencies.append((time.perf_counter() - call_started) * 1000)
+        scores[os.path.basename(test_path)] = result.get('score', result.get('best_score'))
+    total = time.perf_counter() - started
+
+    latencies = np.array(latencies)
+    queue.put({
+        'latency_ms': {
+            'mean': round(float(latencies.mean()), 2),
+            'p50': round(float(np.percentile(latencies, 50)), 2),
+            'p90': round(float(np.percentile(latencies, 90)), 2),
+            'p99': round(float(np.percentile(latencies, 99)), 2),
+            'min': round(float(latencies.min()), 2),
+            'max': round(float(latencies.max()), 2)
+        },
+        'throughput_per_s': round(len(latencies) / total, 2),
+        'rss_after_import_mb': baseline_rss,
+        'peak_rss_mb': _peak_rss_mb(),
+        'scores': scores
+    })
+
+
+def run_case(case: Dict[str, Any]) -> Dict[str, Any]:
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=_run_case, args=(case, queue))
+    process.start()
+    try:
+        measurements = queue.get(timeout=case['timeout'])
+    except Exception:
+        process.terminate()
+        measurements = {'error': 'Caso não concluído dentro do tempo limite'}
+    process.join()
+    return measurements
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), timeout=5).stdout.strip() or None
+    except Exception:
+        return None
+
+
+def collect_metadata(args: argparse.Namespace) -> Dict[str, Any]:
+    import skimage
+    return {
+        'timestamp': datetime.now().isoformat(),
+        'git_commit': _git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'opencv': cv2.__version__,
+        'numpy': np.__version__,
+        'scikit_image': skimage.__version__,
+        'parameters': {
+            'resolutions': args.resolutions,
+            'formats': args.formats,
+            'methods': args.methods,
+            'iterations': args.iterations,
+            'warmup': args.warmup,
+            'working_pixels': args.working_pixels,
+            'ssim_engine': args.ssim_engine
+        }
+    }
+
+
+def compare_with_baseline(results: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> List[str]:
+    """Lista os casos cuja latência p50 piorou mais que a tolerância (fração)"""
+    def key(case):
+        return case['method'], case['resolution'], case['format']
+
+    previous = {key(case): case for case in baseline.get('cases', [])}
+    regressions = []
+
+    print(f"\n{'método':<10}{'resolução':<12}{'formato':<9}{'p50 antes':>11}{'p50 agora':>11}{'variação':>10}")
+    for case in results['cases']:
+        old = previous.get(key(case))
+        if not old or 'latency_ms' not in old or 'latency_ms' not in case:
+            continue
+        before, now = old['latency_ms']['p50'], case['latency_ms']['p50']
+        change = (now - before) / before if before else 0.0
+        print(f"{case['method']:<10}{case['resolution']:<12}{case['format']:<9}"
+              f"{before:>11.2f}{now:>11.2f}{change * 100:>9.1f}%")
+        if change > tolerance:
+            regressions.append(f"{case['method']} {case['resolution']} {case['format']}: "
+                               f"p50 {before:.2f}ms -> {now:.2f}ms")
+    return regressions
+
+
+def main():
+    """Função principal para execução via linha de comando"""
+    parser = argparse.ArgumentParser(description='Benchmark dos métodos de comparação de etiquetas')
+    parser.add_argument('--resolutions', default=','.join(DEFAULT_RESOLUTIONS),
+                        help='Resoluções separadas por vírgula (LARGURAxALTURA)')
+    parser.add_argument('--formats', default=','.join(DEFAULT_FORMATS), help='Formatos (png, jpg)')
+    parser.add_argument('--methods', default=','.join(DEFAULT_METHODS), help='Métodos (ssim, orb, template, color, all)')
+    parser.add_argument('--iterations', type=int, default=30, help='Comparações medidas por caso')
+    parser.add_argument('--warmup', type=int, default=2, help='Comparações de aquecimento por caso')
+    parser.add_argument('--working-pixels', type=int, default=0,
+                        help='Orçamento de pixels da resolução de trabalho (0 = resolução original)')
+    parser.add_argument('--ssim-engine', choices=['skimage', 'fast'], default='skimage',
+                        help='Implementação do SSIM: skimage (float64) ou fast (OpenCV em float32)')
+    parser.add_argument('--timeout', type=float, default=600, help='Tempo máximo por caso em segundos')
+    parser.add_argument('--output', '-o', default='benchmark_results.json', help='Arquivo JSON de saída')
+    parser.add_argument('--baseline', help='JSON de uma execução anterior para comparação')
+    parser.add_argument('--tolerance', type=float, default=0.10,
+                        help='Piora máxima aceitável de p50 em relação ao baseline (fração)')
+
+    args = parser.parse_args()
+    args.resolutions = [value.strip() for value in args.resolutions.split(',') if value.strip()]
+    args.formats = [value.strip() for value in args.formats.split(',') if value.strip()]
+    args.methods = [value.strip() for value in args.methods.split(',') if value.strip()]
+
+    results = {'meta': collect_metadata(args), 'cases': []}
+    dataset_dir = tempfile.mkdtemp(prefix='label_benchmark_')
+
+    try:
+        for resolution in args.resolutions:
+            for image_format in args.formats:
+                reference, tests = generate_dataset(dataset_dir, resolution, image_format)
+
+                for method in args.methods:
+                    case = {
+                        'method': method,
+                        'reference': reference,
+                        'tests': tests,
+                        'iterations': args.iterations,
+                        'warmup': args.warmup,
+                        'working_pixels': args.working_pixels or None,
+                        'ssim_engine': args.ssim_engine,
+                        'timeout': args.timeout
+                    }
+                    measurements = run_case(case)
+                    entry = {'method': method, 'resolution': resolution, 'format': image_format, **measurements}
+                    results['cases'].append(entry)
+
+                    latency = measurements.get('latency_ms', {})
+                    print(f"{method:<10}{resolution:<12}{image_format:<5} "
+                          f"p50={latency.get('p50', '-')}ms p99={latency.get('p99', '-')}ms "
+                          f"vazão={measurements.get('throughput_per_s', '-')}/s "
+                          f"pico RSS={measurements.get('peak_rss_mb', '-')}MB", file=sys.stderr)
+    finally:
+        shutil.rmtree(dataset_dir, ignore_errors=True)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Resultado salvo em: {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare_with_baseline(results, baseline, args.tolerance)
+        if regressions:
+            print("\nRegressões de desempenho:")
+            for line in regressions:
+                print(f"  {line}")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,25 @@
+"""
+Leitura da entrada binária com prefixo de tamanho
+Compartilhado pelo comparador e pelo conversor de PDF, sem dependências
+externas (importá-lo não carrega OpenCV, scikit-image nem pdf2image)
+"""
+
+import struct
+from typing import BinaryIO, List
+
+
+def read_length_prefixed(stream: BinaryIO) -> List[bytes]:
+    """Lê blocos binários no formato [tamanho uint32 big-endian][conteúdo] até o EOF"""
+    payloads = []
+    while True:
+        header = stream.read(4)
+        if not header:
+            return payloads
+        if len(header) < 4:
+            raise ValueError("Cabeçalho de tamanho incompleto na entrada binária")
+
+        size = struct.unpack('>I', header)[0]
+        payload = stream.read(size)
+        if len(payload) < size:
+            raise ValueError("Entrada binária terminou antes do fim do bloco")
+        payloads.append(payload)
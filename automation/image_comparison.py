@@ -9,13 +9,35 @@ import numpy as np
 import json
 import sys
 import os
+import shutil
+import sqlite3
+import struct
+import hashlib
+import time
+import uuid
+import cProfile
+import tempfile
+import functools
+import threading
+import asyncio
+import weakref
+import urllib.request
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import Executor, ThreadPoolExecutor, wait as wait_futures
 from pathlib import Path
-from typing import Dict, Any, Tuple
+from typing import Dict, Any, Tuple, List, Optional, Union
 import logging
 from skimage.metrics import structural_similarity as ssim
-from skimage import io
 import argparse
 
+from framing import read_length_prefixed
+
+try:
+    import fcntl  # trava de arquivo do índice de referências (indisponível no Windows)
+except ImportError:
+    fcntl = None
+
 # Configurar logging
 logging.basicConfig(
     level=logging.INFO,
@@ -23,91 +45,2028 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Menor lado (em pixels) do nível mais grosseiro da pirâmide de imagens
+MIN_PYRAMID_SIDE = 64
+
+# Margem abaixo do limite de aprovação a partir da qual um nível grosseiro da
+# pirâmide já reprova. Nos níveis grosseiros o SSIM tende a subir (desfoque e
+# detalhes finos somem na redução), por isso eles nunca aprovam sozinhos.
+DEFAULT_SSIM_MARGIN = 0.1
+
+# Cortes dos estágios da cascata por método final, cada um na escala do próprio
+# estágio: (reprovar, aprovar), None = o estágio não decide nesse sentido. O
+# pHash reprova a partir de uma distância de Hamming (de 64 bits) e o SSIM do
+# nível mais grosseiro abaixo de um score. Calibrados em etiquetas sintéticas
+# e fotos: acima desses cortes ainda aparecem etiquetas que o método final
+# aprova (sem o código de barras: distância 34, SSIM 0.77). Nenhum estágio
+# aprova: desfoque e defeitos pequenos mantêm o pHash em 0-4 e o SSIM
+# grosseiro acima de 0.95. O ORB é invariante à rotação e o SSIM não, então
+# com o método final orb o SSIM grosseiro não decide.
+DEFAULT_CASCADE_CUTOFFS = {
+    'ssim': {'phash': (40, None), 'ssim_coarse': (0.25, None)},
+    'template': {'phash': (40, None), 'ssim_coarse': (0.25, None)},
+    'color': {'phash': (40, None), 'ssim_coarse': (0.25, None)},
+    'orb': {'phash': (40, None)}
+}
+
+# Janela do SSIM (a mesma do skimage) e diferença máxima esperada entre o
+# fast_ssim e o structural_similarity do skimage nas mesmas imagens uint8
+SSIM_WINDOW = 7
+FAST_SSIM_TOLERANCE = 1e-3
+FAST_SSIM_MODES = ('box', 'gaussian', 'integral')
+# Implementações do SSIM: structural_similarity do skimage (float64) ou fast_ssim (float32)
+SSIM_ENGINES = ('skimage', 'fast')
+
+# SSIM por blocos: lado do bloco, lado máximo do mapa de calor (em células) e
+# dissimilaridade média mínima (1 - SSIM) para uma célula entrar numa região
+SSIM_TILE = 512
+HEATMAP_MAX_SIDE = 32
+REGION_MIN_DISSIMILARITY = 0.15
+
+# Índice de referências: tabelas LSH (bits sorteados dos descritores ORB de 256
+# bits, com semente fixa para que o índice persistido continue válido) e peso
+# do pHash no score combinado com as palavras visuais
+INDEX_LSH_TABLES = 2
+INDEX_LSH_BITS = 16
+INDEX_LSH_SEED = 20240
+INDEX_PHASH_WEIGHT = 0.25
+
+# Localização da etiqueta na foto: mínimo de inliers da homografia ORB, menor
+# fração da foto que o quadrilátero da etiqueta pode ocupar e estimador da
+# homografia (USAC com otimização local: mais preciso que o RANSAC simples e
+# com semente fixa, então o recorte se repete entre execuções)
+LOCALIZATION_MIN_INLIERS = 15
+LOCALIZATION_MIN_AREA = 0.05
+LOCALIZATION_ESTIMATOR = cv2.USAC_ACCURATE
+
+# Menor lado (em pixels de trabalho) de uma região de interesse; regiões menores
+# são ampliadas em torno do centro para que as métricas tenham janela suficiente
+MIN_ROI_SIDE = 16
+
+# Verificação de qualidade da foto: as métricas são medidas numa cópia com
+# maior lado de até QUALITY_SAMPLE_SIDE, para custar poucos milissegundos e para que
+# a nitidez (variância do Laplaciano) não dependa da resolução da câmera
+QUALITY_SAMPLE_SIDE = 512
+
+# Comparação de cores: ΔE (CIE76) em Lab sobre miniaturas com maior lado
+# COLOR_SIDE, por célula de uma grade COLOR_GRID x COLOR_GRID. A foto é
+# decodificada em cor reduzida até COLOR_DECODE_SIDE (o recorte da etiqueta
+# sai dessa cópia). O score cai linearmente até 0 quando a pior célula chega
+# a COLOR_MAX_DELTA_E
+COLOR_SIDE = 96
+COLOR_DECODE_SIDE = 384
+COLOR_GRID = 8
+COLOR_MAX_DELTA_E = 30.0
+COLOR_REGION_MIN_DELTA_E = 10.0
+
+# Modo de fluxo de quadros: cada quadro é pré-pontuado (nitidez e confiança
+# da localização da etiqueta) com maior lado STREAM_SAMPLE_SIDE e só o melhor
+# é comparado, ao fim de STREAM_MAX_FRAMES quadros ou STREAM_MAX_SECONDS
+# segundos. A referência é reduzida a STREAM_REFERENCE_SIDE, já que a etiqueta
+# costuma ocupar só parte do quadro. A confiança é 1 a partir de
+# STREAM_CONFIDENT_INLIERS inliers
+STREAM_SAMPLE_SIDE = 480
+STREAM_REFERENCE_SIDE = 240
+STREAM_ORB_FEATURES = 500
+STREAM_CONFIDENT_INLIERS = 20
+STREAM_MAX_FRAMES = 30
+STREAM_MAX_SECONDS = 2.0
+
+# Normalização de iluminação: CLAHE na resolução de trabalho e alinhamento
+# ECC afim (sobre o gradiente) no nível da pirâmide com maior lado até
+# ECC_SIDE, encerrado ao variar menos que ECC_EPSILON ou após
+# ECC_MAX_ITERATIONS iterações. Warps que se afastam da identidade mais que
+# ECC_MAX_DEFORMATION (parte linear e translação em fração do tamanho) são
+# descartados
+CLAHE_CLIP_LIMIT = 2.0
+CLAHE_TILE_GRID = 8
+ECC_SIDE = 320
+ECC_MAX_ITERATIONS = 50
+ECC_EPSILON = 1e-3
+ECC_MAX_DEFORMATION = 0.15
+
+# Orçamento de entrada: imagens maiores são decodificadas já reduzidas (JPEG)
+# ou recusadas, antes de ocupar gigabytes de memória na decodificação
+MAX_INPUT_PIXELS = 24_000_000
+MAX_INPUT_BYTES = 50 * 1024 * 1024
+
+# Fotos quase idênticas na mesma sessão de inspeção: distância de Hamming
+# máxima (em bits de 64) aceita tanto no pHash quanto no dHash
+DEDUP_MAX_DISTANCE = 4
+DEFAULT_QUALITY_THRESHOLDS = {
+    'min_side': 480,          # menor lado da foto original, em pixels
+    'min_sharpness': 100.0,   # variância do Laplaciano na amostra
+    'min_brightness': 40.0,   # média dos níveis de cinza
+    'max_brightness': 235.0,
+    'max_clipped': 0.9,       # fração máxima de pixels estourados (>= 250) ou pretos (<= 5)
+    'min_contrast': 15.0      # desvio padrão dos níveis de cinza
+}
+
+
+# Uma imagem pode ser informada por caminho/URL ou pelo seu conteúdo em bytes
+ImageSource = Union[str, bytes]
+
+
+def describe_source(source: ImageSource) -> str:
+    """Descrição da origem de uma imagem para resultados e logs"""
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return f"<{len(source)} bytes>"
+    return source
+
+
+# Flags de decodificação reduzida do OpenCV (o libjpeg escala a DCT durante a leitura)
+REDUCED_GRAYSCALE_FLAGS = {
+    8: cv2.IMREAD_REDUCED_GRAYSCALE_8,
+    4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+    2: cv2.IMREAD_REDUCED_GRAYSCALE_2
+}
+REDUCED_COLOR_FLAGS = {
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    2: cv2.IMREAD_REDUCED_COLOR_2
+}
+
+# Marcadores JPEG SOF (start of frame) que trazem as dimensões da imagem
+_JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+# Tag EXIF/TIFF da orientação; de 5 a 8 a imagem é girada 90° na exibição
+_ORIENTATION_TAG = 0x0112
+# Tags TIFF de largura e altura (ImageWidth, ImageLength)
+_TIFF_WIDTH_TAG = 0x0100
+_TIFF_HEIGHT_TAG = 0x0101
+
+
+def _tiff_tags(tiff: bytes, tags: set) -> Dict[int, int]:
+    """Valores inteiros (SHORT ou LONG) das tags pedidas no primeiro IFD de um bloco TIFF/EXIF"""
+    if tiff[:4] == b'II*\x00':
+        order = '<'
+    elif tiff[:4] == b'MM\x00*':
+        order = '>'
+    else:
+        return {}
+
+    ifd = struct.unpack(order + 'I', tiff[4:8])[0] if len(tiff) >= 8 else len(tiff)
+    if ifd + 2 > len(tiff):
+        return {}
+    count = struct.unpack(order + 'H', tiff[ifd:ifd + 2])[0]
+    values = {}
+    for entry in range(ifd + 2, ifd + 2 + 12 * count, 12):
+        if entry + 12 > len(tiff):
+            break
+        tag, kind = struct.unpack(order + 'HH', tiff[entry:entry + 4])
+        if tag in tags and kind == 3:
+            values[tag] = struct.unpack(order + 'H', tiff[entry + 8:entry + 10])[0]
+        elif tag in tags and kind == 4:
+            values[tag] = struct.unpack(order + 'I', tiff[entry + 8:entry + 12])[0]
+    return values
+
+
+def _exif_orientation(exif: bytes) -> int:
+    """Orientação EXIF (1 a 8) de um bloco EXIF, com ou sem o prefixo 'Exif'"""
+    if exif[:6] == b'Exif\x00\x00':
+        exif = exif[6:]
+    return _tiff_tags(exif, {_ORIENTATION_TAG}).get(_ORIENTATION_TAG, 1)
+
+
+def image_header_info(data: bytes) -> Optional[Tuple[str, int, int]]:
+    """Formato, largura e altura lidos do cabeçalho (JPEG, PNG, WebP, BMP ou TIFF), sem decodificar a imagem
+
+    As dimensões são as da imagem como o cv2.imdecode a entrega: com
+    orientação EXIF de 5 a 8 (fotos de celular na vertical), largura e
+    altura do cabeçalho são trocadas.
+    """
+    info = _stored_header_info(data)
+    if info is not None and _header_orientation(data, info[0]) >= 5:
+        return info[0], info[2], info[1]
+    return info
+
+
+def _stored_header_info(data: bytes) -> Optional[Tuple[str, int, int]]:
+    """Formato, largura e altura gravadas no cabeçalho, sem a orientação EXIF"""
+    if data[:8] == b'\x89PNG\r\n\x1a\n' and len(data) >= 24:
+        width, height = struct.unpack('>II', data[16:24])
+        return 'png', width, height
+
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP' and len(data) >= 30:
+        chunk = data[12:16]
+        if chunk == b'VP8 ':
+            width, height = struct.unpack('<HH', data[26:30])
+            return 'webp', width & 0x3FFF, height & 0x3FFF
+        if chunk == b'VP8L':
+            bits = int.from_bytes(data[21:25], 'little')
+            return 'webp', (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+        if chunk == b'VP8X':
+            return 'webp', int.from_bytes(data[24:27], 'little') + 1, int.from_bytes(data[27:30], 'little') + 1
+        return None
+
+    if data[:4] in (b'II*\x00', b'MM\x00*'):
+        # Primeira página (IFD 0), a que o cv2.imdecode decodifica
+        tags = _tiff_tags(data, {_TIFF_WIDTH_TAG, _TIFF_HEIGHT_TAG})
+        if len(tags) < 2:
+            return None
+        return 'tiff', tags[_TIFF_WIDTH_TAG], tags[_TIFF_HEIGHT_TAG]
+
+    if data[:2] == b'BM' and len(data) >= 26:
+        if struct.unpack('<I', data[14:18])[0] == 12:
+            width, height = struct.unpack('<HH', data[18:22])
+        else:
+            width, height = struct.unpack('<ii', data[18:26])
+        return 'bmp', abs(width), abs(height)
+
+    if data[:2] != b'\xff\xd8':
+        return None
+
+    # Percorrer os segmentos do JPEG até o marcador SOF
+    offset = 2
+    while offset + 4 <= len(data):
+        if data[offset] != 0xFF:
+            return None
+        marker = data[offset + 1]
+        if marker == 0xFF:
+            offset += 1
+            continue
+        if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7:
+            offset += 2
+            continue
+
+        length = struct.unpack('>H', data[offset + 2:offset + 4])[0]
+        if marker in _JPEG_SOF_MARKERS and offset + 9 <= len(data):
+            height, width = struct.unpack('>HH', data[offset + 5:offset + 9])
+            return 'jpeg', width, height
+        offset += 2 + length
+
+    return None
+
+
+def _header_orientation(data: bytes, image_format: str) -> int:
+    """Orientação EXIF (1 a 8) gravada antes dos dados da imagem; 1 sem EXIF"""
+    if image_format == 'jpeg':
+        # APP1 (Exif) vem antes do SOF
+        offset = 2
+        while offset + 4 <= len(data) and data[offset] == 0xFF:
+            marker = data[offset + 1]
+            length = struct.unpack('>H', data[offset + 2:offset + 4])[0]
+            if marker in _JPEG_SOF_MARKERS or marker == 0xDA:
+                break
+            if marker == 0xE1 and data[offset + 4:offset + 10] == b'Exif\x00\x00':
+                return _exif_orientation(data[offset + 10:offset + 2 + length])
+            offset += 2 + length
+    elif image_format == 'png':
+        # Chunk eXIf, antes do primeiro IDAT
+        offset = 8
+        while offset + 8 <= len(data):
+            length, chunk = struct.unpack('>I', data[offset:offset + 4])[0], data[offset + 4:offset + 8]
+            if chunk in (b'IDAT', b'IEND'):
+                break
+            if chunk == b'eXIf':
+                return _exif_orientation(data[offset + 8:offset + 8 + length])
+            offset += 12 + length
+    elif image_format == 'tiff':
+        return _tiff_tags(data, {_ORIENTATION_TAG}).get(_ORIENTATION_TAG, 1)
+    elif image_format == 'webp' and data[12:16] == b'VP8X' and data[20] & 0x08:
+        # Chunk EXIF (indicado no VP8X), normalmente depois dos dados da imagem
+        offset = 12
+        while offset + 8 <= len(data):
+            chunk, length = data[offset:offset + 4], struct.unpack('<I', data[offset + 4:offset + 8])[0]
+            if chunk == b'EXIF':
+                return _exif_orientation(data[offset + 8:offset + 8 + length])
+            offset += 8 + length + (length & 1)
+    return 1
+
+
+def content_hash(data: bytes) -> str:
+    """Hash SHA-256 do conteúdo de um arquivo, usado como chave de cache"""
+    return hashlib.sha256(data).hexdigest()
+
+
+def perceptual_hash(gray: np.ndarray) -> np.ndarray:
+    """pHash de 64 bits (8 bytes): sinais das baixas frequências da DCT em 32x32"""
+    small = cv2.resize(gray, (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32)
+    block = cv2.dct(small)[:8, :8].flatten()
+    # O componente DC (brilho médio) fica fora da mediana
+    return np.packbits(block > np.median(block[1:]))
+
+
+def difference_hash(gray: np.ndarray) -> np.ndarray:
+    """dHash de 64 bits (8 bytes): sinais dos gradientes horizontais em 9x8"""
+    small = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA).astype(np.int16)
+    return np.packbits(small[:, 1:] > small[:, :-1])
+
+
+def hamming_distance(hash1: np.ndarray, hash2: np.ndarray) -> int:
+    """Número de bits diferentes entre dois hashes empacotados"""
+    return int(np.unpackbits(np.bitwise_xor(hash1, hash2)).sum())
+
+
+def _window_sums(integral: np.ndarray, size: int) -> np.ndarray:
+    """Somas de todas as janelas size x size inteiramente dentro da imagem"""
+    return (integral[size:, size:] - integral[:-size, size:]
+            - integral[size:, :-size] + integral[:-size, :-size])
+
+
+def fast_ssim_map(img1: np.ndarray, img2: np.ndarray, mode: str = 'box') -> np.ndarray:
+    """Mapa SSIM em float32 calculado com filtros do OpenCV
+
+    Reproduz o skimage.metrics.structural_similarity para imagens uint8:
+    - 'box': janela uniforme 7x7 (o padrão do skimage);
+    - 'gaussian': janela gaussiana 11x11, sigma 1.5 (gaussian_weights=True);
+    - 'integral': a janela do 'box', com somas exatas em inteiros a partir de
+      imagens integrais (apenas uint8).
+    Em todos os modos a covariância é a amostral, o padrão do skimage
+    (use_sample_covariance=True). Como no skimage, a borda de meia janela fica
+    fora do mapa, que tem (altura - 2*pad, largura - 2*pad) pixels (pad =
+    metade da janela).
+    """
+    if img1.shape != img2.shape:
+        raise ValueError(f"Imagens com tamanhos diferentes: {img1.shape} e {img2.shape}")
+
+    c1 = (0.01 * 255) ** 2
+    c2 = (0.03 * 255) ** 2
+
+    if mode == 'integral':
+        if img1.dtype != np.uint8 or img2.dtype != np.uint8:
+            raise ValueError("O modo 'integral' exige imagens uint8")
+
+        # Σx e Σy em int32; Σx², Σy² e Σxy em float64, exatos até 2^53
+        n = SSIM_WINDOW * SSIM_WINDOW
+        sum_x, sum_xx = cv2.integral2(img1, sdepth=cv2.CV_32S, sqdepth=cv2.CV_64F)
+        sum_y, sum_yy = cv2.integral2(img2, sdepth=cv2.CV_32S, sqdepth=cv2.CV_64F)
+        sum_xy = cv2.integral(cv2.multiply(img1, img2, dtype=cv2.CV_32F), sdepth=cv2.CV_64F)
+        sum_x = _window_sums(sum_x, SSIM_WINDOW).astype(np.float64)
+        sum_y = _window_sums(sum_y, SSIM_WINDOW).astype(np.float64)
+
+        # n*Σxy - Σx*Σy continua exato; só o resultado passa para float32
+        norm = 1.0 / (n * (n - 1))
+        var_x = ((n * _window_sums(sum_xx, SSIM_WINDOW) - sum_x * sum_x) * norm).astype(np.float32)
+        var_y = ((n * _window_sums(sum_yy, SSIM_WINDOW) - sum_y * sum_y) * norm).astype(np.float32)
+        cov_xy = ((n * _window_sums(sum_xy, SSIM_WINDOW) - sum_x * sum_y) * norm).astype(np.float32)
+        mu_x = (sum_x / n).astype(np.float32)
+        mu_y = (sum_y / n).astype(np.float32)
+        pad = 0  # as somas já cobrem apenas janelas válidas
+    else:
+        if mode == 'box':
+            size = SSIM_WINDOW
+            blur = lambda image: cv2.boxFilter(image, cv2.CV_32F, (size, size),
+                                               borderType=cv2.BORDER_REFLECT)
+        elif mode == 'gaussian':
+            size = 11
+            blur = lambda image: cv2.GaussianBlur(image, (size, size), 1.5,
+                                                  borderType=cv2.BORDER_REFLECT)
+        else:
+            raise ValueError(f"Modo de SSIM '{mode}' não suportado")
+        # Covariância amostral: como no skimage (use_sample_covariance=True),
+        # o fator é n/(n-1) com n = pixels da janela também com pesos gaussianos
+        correction = size * size / (size * size - 1.0)
+
+        # Centralizar em zero reduz o cancelamento em E[x²] - E[x]² no float32
+        x = img1.astype(np.float32) - 128.0
+        y = img2.astype(np.float32) - 128.0
+        mu_x = blur(x)
+        mu_y = blur(y)
+        var_x = (blur(x * x) - mu_x * mu_x) * correction
+        var_y = (blur(y * y) - mu_y * mu_y) * correction
+        cov_xy = (blur(x * y) - mu_x * mu_y) * correction
+        mu_x += 128.0
+        mu_y += 128.0
+        pad = (size - 1) // 2
+
+    ssim_map = ((2 * mu_x * mu_y + c1) * (2 * cov_xy + c2)) / \
+        ((mu_x * mu_x + mu_y * mu_y + c1) * (var_x + var_y + c2))
+    if pad:
+        ssim_map = ssim_map[pad:-pad, pad:-pad]
+    return ssim_map
+
+
+def fast_ssim(img1: np.ndarray, img2: np.ndarray, mode: str = 'box') -> float:
+    """SSIM médio em float32 (ver fast_ssim_map)"""
+    return float(fast_ssim_map(img1, img2, mode).mean(dtype=np.float64))
+
+
+def ssim_map(img1: np.ndarray, img2: np.ndarray, engine: str = 'skimage', mode: str = 'box') -> np.ndarray:
+    """Mapa SSIM sem a borda de meia janela, pelo skimage ou pelo fast_ssim_map (engine 'fast')
+    
+    O modo só vale para o engine 'fast'; o skimage usa sempre a janela 7x7.
+    """
+    if engine == 'fast':
+        return fast_ssim_map(img1, img2, mode)
+    if engine != 'skimage':
+        raise ValueError(f"Engine de SSIM '{engine}' não suportado")
+    pad = _ssim_pad('box')
+    _, full = ssim(img1, img2, full=True)
+    return full[pad:-pad, pad:-pad]
+
+
+def _ssim_pad(mode: str, engine: str = 'fast') -> int:
+    """Metade da janela do SSIM no modo informado"""
+    return 5 if mode == 'gaussian' and engine == 'fast' else (SSIM_WINDOW - 1) // 2
+
+
+def _cell_sums(values: np.ndarray, cell: int) -> np.ndarray:
+    """Soma de values em blocos cell x cell (blocos incompletos na borda inclusive)"""
+    rows = -(-values.shape[0] // cell)
+    cols = -(-values.shape[1] // cell)
+    padded = np.zeros((rows * cell, cols * cell), dtype=np.float64)
+    padded[:values.shape[0], :values.shape[1]] = values
+    return padded.reshape(rows, cell, cols, cell).sum(axis=(1, 3))
+
+
+def tiled_ssim(img1: np.ndarray, img2: np.ndarray, mode: str = 'box', tile: int = SSIM_TILE,
+               heatmap_side: int = HEATMAP_MAX_SIDE, max_regions: int = 5,
+               engine: str = 'fast') -> Dict[str, Any]:
+    """SSIM por blocos sobrepostos, com memória constante, mapa de diferenças e piores regiões
+    
+    Cada bloco é estendido em meia janela para cada lado, de modo que os
+    valores no seu interior são idênticos aos do mapa completo; o score
+    global é o mesmo do SSIM da imagem inteira no engine informado (ver
+    ssim_map), e uma imagem que cabe num bloco é comparada de uma vez. O
+    mapa de calor traz a dissimilaridade média (1 - SSIM) por célula de
+    heatmap_cell pixels, e as regiões são os componentes conexos das
+    células mais diferentes, em pixels de img1.
+    """
+    if img1.shape != img2.shape:
+        raise ValueError(f"Imagens com tamanhos diferentes: {img1.shape} e {img2.shape}")
+    
+    pad = _ssim_pad(mode, engine)
+    height, width = img1.shape[:2]
+    if height <= 2 * pad or width <= 2 * pad:
+        raise ValueError(f"Imagem pequena demais para o SSIM: {width}x{height}")
+    
+    # As células são alinhadas aos blocos (o bloco é múltiplo da célula)
+    cell = max(1, -(-max(height, width) // heatmap_side))
+    tile = -(-max(tile, cell) // cell) * cell
+    
+    rows = -(-(height - 2 * pad) // cell)
+    cols = -(-(width - 2 * pad) // cell)
+    dissimilarity = np.zeros((rows, cols), dtype=np.float64)
+    counts = np.zeros((rows, cols), dtype=np.float64)
+    total = 0.0
+    
+    for top in range(pad, height - pad, tile):
+        bottom = min(top + tile, height - pad)
+        for left in range(pad, width - pad, tile):
+            right = min(left + tile, width - pad)
+            window = (slice(top - pad, bottom + pad), slice(left - pad, right + pad))
+            block = ssim_map(img1[window], img2[window], engine, mode)
+            total += float(block.sum(dtype=np.float64))
+            
+            row, col = (top - pad) // cell, (left - pad) // cell
+            sums = _cell_sums(1.0 - block, cell)
+            area = _cell_sums(np.ones(block.shape, dtype=np.float32), cell)
+            dissimilarity[row:row + sums.shape[0], col:col + sums.shape[1]] += sums
+            counts[row:row + area.shape[0], col:col + area.shape[1]] += area
+    
+    score = total / ((height - 2 * pad) * (width - 2 * pad))
+    heatmap = (dissimilarity / np.maximum(counts, 1)).astype(np.float32)
+    
+    return {
+        'score': score,
+        'heatmap': heatmap,
+        'heatmap_cell': cell,
+        'regions': _worst_regions(heatmap, cell, pad, max_regions)
+    }
+
+
+def downscale_to(image: np.ndarray, max_side: int) -> np.ndarray:
+    """Reduz por fator inteiro até o maior lado caber em max_side
+    
+    Recorta a sobra para que o fator seja exato: é o caminho rápido do
+    INTER_AREA, várias vezes mais rápido que um fator fracionário.
+    """
+    factor = -(-max(image.shape[:2]) // max_side)
+    if factor <= 1:
+        return image
+    rows, cols = image.shape[0] // factor, image.shape[1] // factor
+    return cv2.resize(image[:rows * factor, :cols * factor], (max(1, cols), max(1, rows)),
+                      interpolation=cv2.INTER_AREA)
+
+
+def lab_thumbnail(bgr: np.ndarray, size: Optional[Tuple[int, int]] = None) -> np.ndarray:
+    """Miniatura em CIE Lab (float32: L de 0 a 100) com maior lado COLOR_SIDE ou no tamanho (largura, altura)"""
+    # A mesma redução inteira nos dois lados mantém a grade de pixels alinhada
+    small = downscale_to(bgr, max(size) if size is not None else COLOR_SIDE)
+    if size is None and max(small.shape[:2]) > COLOR_SIDE:
+        scale = COLOR_SIDE / max(small.shape[:2])
+        size = (max(1, round(small.shape[1] * scale)), max(1, round(small.shape[0] * scale)))
+    if size is not None and (small.shape[1], small.shape[0]) != tuple(size):
+        small = cv2.resize(small, tuple(size), interpolation=cv2.INTER_AREA)
+    if small.ndim == 2:
+        small = cv2.cvtColor(small, cv2.COLOR_GRAY2BGR)
+    return cv2.cvtColor(small.astype(np.float32) / 255.0, cv2.COLOR_BGR2Lab)
+
+
+def color_delta_e(reference_lab: np.ndarray, test_lab: np.ndarray, grid: int = COLOR_GRID,
+                  max_regions: int = 5) -> Dict[str, Any]:
+    """ΔE entre duas miniaturas Lab do mesmo tamanho, por célula da grade
+    
+    Antes da diferença, a luminância da foto é ajustada à média e ao desvio da
+    referência e a crominância é deslocada pela diferença das medianas (fundo
+    da etiqueta), compensando exposição e balanço de branco. Retorna o score,
+    o ΔE médio e o da pior célula e as células acima de COLOR_REGION_MIN_DELTA_E
+    (caixas em pixels da miniatura).
+    """
+    test = test_lab.copy()
+    ref_mean, ref_std = float(reference_lab[..., 0].mean()), float(reference_lab[..., 0].std())
+    test_mean, test_std = float(test[..., 0].mean()), float(test[..., 0].std())
+    test[..., 0] = (test[..., 0] - test_mean) * (ref_std / test_std if test_std > 1e-3 else 1.0) + ref_mean
+    test[..., 1:] += (np.median(reference_lab[..., 1:].reshape(-1, 2), axis=0)
+                      - np.median(test[..., 1:].reshape(-1, 2), axis=0))
+    
+    delta = np.sqrt(((reference_lab - test) ** 2).sum(axis=2))
+    height, width = delta.shape
+    rows, cols = min(grid, height), min(grid, width)
+    cells = cv2.resize(delta, (cols, rows), interpolation=cv2.INTER_AREA)
+    worst = float(cells.max())
+    
+    regions = []
+    for index in np.argsort(cells, axis=None)[::-1][:max_regions]:
+        row, col = divmod(int(index), cols)
+        if cells[row, col] < COLOR_REGION_MIN_DELTA_E:
+            break
+        top, bottom = row * height // rows, (row + 1) * height // rows
+        left, right = col * width // cols, (col + 1) * width // cols
+        regions.append({'x': left, 'y': top, 'width': right - left, 'height': bottom - top,
+                        'delta_e': round(float(cells[row, col]), 2)})
+    
+    return {
+        'score': max(0.0, 1.0 - worst / COLOR_MAX_DELTA_E),
+        'delta_e_mean': round(float(delta.mean()), 2),
+        'delta_e_max': round(worst, 2),
+        'regions': regions
+    }
+
+
+def _worst_regions(heatmap: np.ndarray, cell: int, pad: int, max_regions: int) -> List[Dict[str, Any]]:
+    """Caixas das regiões mais diferentes do mapa de calor, da pior para a melhor"""
+    if max_regions <= 0 or not heatmap.size:
+        return []
+    
+    # Células claramente acima do fundo de diferença da imagem inteira
+    cutoff = max(REGION_MIN_DISSIMILARITY, float(heatmap.mean() + 2 * heatmap.std()))
+    mask = (heatmap >= cutoff).astype(np.uint8)
+    count, labels, stats, _ = cv2.connectedComponentsWithStats(mask, connectivity=8)
+    
+    regions = []
+    for label in range(1, count):
+        x, y, w, h = (int(value) for value in stats[label, :4])
+        region_dissimilarity = float(heatmap[labels == label].mean())
+        regions.append({
+            'x': x * cell + pad,
+            'y': y * cell + pad,
+            'width': w * cell,
+            'height': h * cell,
+            'score': round(1.0 - region_dissimilarity, 4)
+        })
+    
+    regions.sort(key=lambda region: region['score'])
+    return regions[:max_regions]
+
+
+def _keypoints_to_array(keypoints) -> np.ndarray:
+    """Converte keypoints do OpenCV em array (N, 7) serializável"""
+    return np.array(
+        [(kp.pt[0], kp.pt[1], kp.size, kp.angle, kp.response, kp.octave, kp.class_id) for kp in keypoints],
+        dtype=np.float32
+    ).reshape(-1, 7)
+
+
+class StageTimer:
+    """Tempos de parede e de CPU por estágio de uma comparação, com metadados
+    
+    O tempo de CPU é o da thread que executa o estágio (time.thread_time); o
+    trabalho feito pelas threads internas do OpenCV não entra nessa conta.
+    Desativado (enabled=False), não mede nada e não acrescenta nada ao resultado.
+    """
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.stages: Dict[str, Dict[str, float]] = {}
+        self.dimensions: Dict[str, List[int]] = {}
+        self.bytes_decoded: Dict[str, int] = {}
+        self.info: Dict[str, Any] = {}
+        self._started = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name: str):
+        if not self.enabled:
+            yield
+            return
+
+        wall, cpu = time.perf_counter(), time.thread_time()
+        try:
+            yield
+        finally:
+            entry = self.stages.setdefault(name, {'wall_ms': 0.0, 'cpu_ms': 0.0})
+            entry['wall_ms'] += (time.perf_counter() - wall) * 1000
+            entry['cpu_ms'] += (time.thread_time() - cpu) * 1000
+
+    def image(self, name: str, image: np.ndarray) -> None:
+        """Registra as dimensões (largura, altura) de uma imagem"""
+        if self.enabled:
+            self.dimensions[name] = [int(image.shape[1]), int(image.shape[0])]
+
+    def decoded(self, name: str, size: int) -> None:
+        """Registra quantos bytes foram decodificados para uma imagem"""
+        if self.enabled:
+            self.bytes_decoded[name] = size
+
+    def record(self, **info: Any) -> None:
+        if self.enabled:
+            self.info.update(info)
+
+    def report(self) -> Dict[str, Any]:
+        return {
+            'stages': {
+                name: {key: round(value, 2) for key, value in entry.items()}
+                for name, entry in self.stages.items()
+            },
+            'total_ms': round((time.perf_counter() - self._started) * 1000, 2),
+            'image_dimensions': self.dimensions,
+            'bytes_decoded': self.bytes_decoded,
+            **self.info
+        }
+
+    def attach(self, result: Dict[str, Any]) -> Dict[str, Any]:
+        """Acrescenta o relatório ao resultado (apenas quando ativado)"""
+        if self.enabled:
+            result['instrumentation'] = self.report()
+        return result
+
+
+def profiled(method):
+    """Grava um perfil cProfile por chamada quando o comparador tem profile_dir"""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if not self.profile_dir:
+            return method(self, *args, **kwargs)
+
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Outro profiler já está ativo nesta thread/processo
+            return method(self, *args, **kwargs)
+
+        try:
+            result = method(self, *args, **kwargs)
+        finally:
+            profiler.disable()
+
+        Path(self.profile_dir).mkdir(parents=True, exist_ok=True)
+        profile_path = Path(self.profile_dir) / (
+            f"{method.__name__}_{time.strftime('%Y%m%d-%H%M%S')}_{uuid.uuid4().hex[:8]}.prof"
+        )
+        profiler.dump_stats(str(profile_path))
+        result['profile_file'] = str(profile_path)
+        return result
+
+    return wrapper
+
+
+def normalize_rois(rois: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Valida regiões de interesse e preenche os valores padrão
+
+    Cada região tem x, y, width e height como frações (0 a 1) do tamanho da
+    referência, de modo que independem da resolução; name, weight (padrão 1)
+    e method (padrão: o método da comparação) são opcionais.
+    """
+    normalized = []
+    for index, roi in enumerate(rois):
+        x, y = float(roi['x']), float(roi['y'])
+        width, height = float(roi['width']), float(roi['height'])
+        if not (0 <= x < 1 and 0 <= y < 1 and 0 < width <= 1 - x + 1e-6 and 0 < height <= 1 - y + 1e-6):
+            raise ValueError(f"Região {index}: x, y, width e height devem ser frações dentro da imagem")
+
+        weight = float(roi.get('weight', 1.0))
+        if weight <= 0:
+            raise ValueError(f"Região {index}: o peso deve ser positivo")
+
+        region = {'name': str(roi.get('name') or f'roi_{index}'),
+                  'x': x, 'y': y, 'width': width, 'height': height, 'weight': weight}
+        if roi.get('method'):
+            region['method'] = roi['method']
+        normalized.append(region)
+    return normalized
+
+
+class QualityRejected(ValueError):
+    """Foto recusada pela verificação de qualidade, antes da comparação"""
+
+    error_code = 'QUALITY_REJECTED'
+
+    def __init__(self, report: Dict[str, Any]):
+        self.report = report
+        self.details = {'quality': report}
+        super().__init__(f"Foto recusada na verificação de qualidade: {', '.join(report['reasons'])}")
+
+
+class InputTooLarge(ValueError):
+    """Imagem acima do orçamento de bytes ou pixels que não pode ser reduzida na decodificação
+
+    Com orçamento de pixels, imagens cujas dimensões não podem ser lidas do
+    cabeçalho também são recusadas.
+    """
+
+    error_code = 'INPUT_TOO_LARGE'
+
+    def __init__(self, message: str, **limits: Any):
+        self.details = {'input_limits': limits}
+        super().__init__(message)
+
+
+class QualityGate:
+    """Verificação rápida de qualidade da foto antes da comparação
+    
+    Recusa fotos pequenas demais, tremidas, sub/superexpostas ou sem contraste,
+    que falhariam na comparação e exigiriam outra foto de qualquer forma. Os
+    limites padrão estão em DEFAULT_QUALITY_THRESHOLDS e podem ser alterados
+    por keyword. Os motivos são códigos estáveis: RESOLUTION_TOO_LOW,
+    UNDEREXPOSED, OVEREXPOSED, LOW_CONTRAST e BLURRY.
+    """
+
+    def __init__(self, **thresholds: float):
+        unknown = set(thresholds) - set(DEFAULT_QUALITY_THRESHOLDS)
+        if unknown:
+            raise ValueError(f"Limites de qualidade desconhecidos: {', '.join(sorted(unknown))}")
+        self.thresholds = {**DEFAULT_QUALITY_THRESHOLDS,
+                           **{name: float(value) for name, value in thresholds.items()}}
+
+    @property
+    def signature(self) -> str:
+        return ','.join(f"{name}={value:g}" for name, value in sorted(self.thresholds.items()))
+
+    def check_size(self, width: int, height: int) -> Optional[Dict[str, Any]]:
+        """Relatório de recusa por resolução (lida do cabeçalho), ou None se ela bastar"""
+        if min(width, height) >= self.thresholds['min_side']:
+            return None
+        return {'passed': False, 'reasons': ['RESOLUTION_TOO_LOW'],
+                'metrics': {'width': width, 'height': height}, 'thresholds': self.thresholds}
+
+    def check(self, gray: np.ndarray, original_size: Optional[Tuple[int, int]] = None) -> Dict[str, Any]:
+        """Mede a foto (já em cinza) e retorna passed, reasons, metrics e thresholds
+        
+        original_size (largura, altura) é o tamanho antes da decodificação
+        reduzida; sem ele vale o tamanho de gray.
+        """
+        limits = self.thresholds
+        width, height = original_size or (gray.shape[1], gray.shape[0])
+        
+        sample = downscale_to(gray, QUALITY_SAMPLE_SIDE)
+        
+        histogram = cv2.calcHist([sample], [0], None, [256], [0, 256]).ravel() / sample.size
+        mean, std = cv2.meanStdDev(sample)
+        brightness, contrast = float(mean[0, 0]), float(std[0, 0])
+        metrics = {
+            'width': int(width),
+            'height': int(height),
+            'sharpness': round(float(cv2.Laplacian(sample, cv2.CV_32F).var()), 2),
+            'brightness': round(brightness, 2),
+            'contrast': round(contrast, 2),
+            'highlights': round(float(histogram[250:].sum()), 4),
+            'shadows': round(float(histogram[:6].sum()), 4)
+        }
+        
+        reasons = []
+        if min(width, height) < limits['min_side']:
+            reasons.append('RESOLUTION_TOO_LOW')
+        if brightness < limits['min_brightness'] or metrics['shadows'] > limits['max_clipped']:
+            reasons.append('UNDEREXPOSED')
+        if brightness > limits['max_brightness'] or metrics['highlights'] > limits['max_clipped']:
+            reasons.append('OVEREXPOSED')
+        if contrast < limits['min_contrast']:
+            reasons.append('LOW_CONTRAST')
+        elif metrics['sharpness'] < limits['min_sharpness']:
+            # Sem contraste a nitidez não é significativa
+            reasons.append('BLURRY')
+        
+        return {'passed': not reasons, 'reasons': reasons, 'metrics': metrics, 'thresholds': limits}
+
+
+class OrbMatcher:
+    """Detector ORB e matcher por força bruta (Hamming) reaproveitados entre chamadas
+    
+    Cada thread mantém seu próprio par detector/matcher, já que os objetos do
+    OpenCV não são seguros para uso concorrente. O matching usa k-NN (k=2) com
+    o teste de razão de Lowe e, opcionalmente, verificação geométrica por
+    homografia RANSAC. max_per_cell limita os keypoints por célula de uma grade
+    grid x grid, evitando que regiões com muito texto dominem o score.
+    O matcher é o BFMatcher (NORM_HAMMING) com knnMatch, e não o FLANN com
+    índice LSH: o índice LSH é aleatório e reconstruído a cada chamada, e os
+    scores variavam entre execuções. O matching exato e a semente fixa do
+    RANSAC tornam o score determinístico; com 1000 descritores por imagem a
+    força bruta custa cerca de 15 ms por comparação.
+    """
+
+    # Semente do gerador do OpenCV antes de cada RANSAC
+    RANSAC_SEED = 0
+
+    def __init__(self, nfeatures: int = 1000, ratio: float = 0.75, verify_geometry: bool = False,
+                 ransac_threshold: float = 5.0, grid: int = 8, max_per_cell: Optional[int] = None):
+        self.nfeatures = nfeatures
+        self.ratio = ratio
+        self.verify_geometry = verify_geometry
+        self.ransac_threshold = ransac_threshold
+        self.grid = grid
+        self.max_per_cell = max_per_cell
+        self._local = threading.local()
+
+    @property
+    def signature(self) -> str:
+        """Identifica os parâmetros que mudam os keypoints detectados"""
+        cap = f"-g{self.grid}x{self.max_per_cell}" if self.max_per_cell else ''
+        return f"orb{self.nfeatures}{cap}"
+
+    @property
+    def scoring_signature(self) -> str:
+        """Identifica os parâmetros do matching, que mudam o score mas não os keypoints"""
+        geometry = f"-ransac{self.ransac_threshold:g}" if self.verify_geometry else ''
+        return f"ratio{self.ratio:g}{geometry}"
+
+    def _detector(self):
+        detector = getattr(self._local, 'detector', None)
+        if detector is None:
+            # Com limite por célula, detectar mais candidatos para a seleção na grade
+            candidates = self.nfeatures * 2 if self.max_per_cell else self.nfeatures
+            detector = cv2.ORB_create(nfeatures=candidates)
+            self._local.detector = detector
+        return detector
+
+    def _matcher(self):
+        matcher = getattr(self._local, 'matcher', None)
+        if matcher is None:
+            matcher = cv2.BFMatcher(cv2.NORM_HAMMING)
+            self._local.matcher = matcher
+        return matcher
+
+    def detect(self, image: np.ndarray) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+        """Detecta keypoints (array N x 7) e descritores de uma imagem"""
+        keypoints, descriptors = self._detector().detectAndCompute(image, None)
+        keypoints = _keypoints_to_array(keypoints)
+
+        if descriptors is None or not len(keypoints):
+            return keypoints, None
+
+        if self.max_per_cell:
+            keep = self._grid_selection(keypoints, image.shape)
+            keypoints, descriptors = keypoints[keep], descriptors[keep]
+
+        return keypoints, descriptors
+
+    def _grid_selection(self, keypoints: np.ndarray, shape: Tuple[int, ...]) -> np.ndarray:
+        """Índices dos keypoints mais fortes de cada célula, limitados a nfeatures"""
+        height, width = shape[:2]
+        columns = np.minimum((keypoints[:, 0] * self.grid / width).astype(np.int32), self.grid - 1)
+        rows = np.minimum((keypoints[:, 1] * self.grid / height).astype(np.int32), self.grid - 1)
+        cells = rows * self.grid + columns
+
+        # Ordenar por célula e, dentro dela, por resposta decrescente
+        order = np.lexsort((-keypoints[:, 4], cells))
+        sorted_cells = cells[order]
+        first_in_cell = np.searchsorted(sorted_cells, sorted_cells, side='left')
+        rank_in_cell = np.arange(len(order)) - first_in_cell
+        keep = order[rank_in_cell < self.max_per_cell]
+
+        if len(keep) > self.nfeatures:
+            keep = keep[np.argsort(-keypoints[keep, 4])[:self.nfeatures]]
+        return np.sort(keep)
+
+    def good_matches(self, des1: Optional[np.ndarray], des2: Optional[np.ndarray]) -> list:
+        """Matches (teste -> referência) que passam no teste de razão de Lowe"""
+        if des1 is None or des2 is None or len(des1) < 2 or len(des2) < 2:
+            return []
+
+        pairs = self._matcher().knnMatch(des2, des1, k=2)
+        return [pair[0] for pair in pairs
+                if len(pair) == 2 and pair[0].distance < self.ratio * pair[1].distance]
+
+    def homography(self, kp1: np.ndarray, kp2: np.ndarray, good: list,
+                   estimator: int = cv2.RANSAC) -> Tuple[Optional[np.ndarray], int]:
+        """Homografia robusta (RANSAC, por padrão) que leva o teste à referência e o número de inliers"""
+        if len(good) < 4:
+            return None, 0
+
+        test_points = np.float32([kp2[m.queryIdx, :2] for m in good])
+        reference_points = np.float32([kp1[m.trainIdx, :2] for m in good])
+        # O gerador do OpenCV é por thread: a semente vale só para esta chamada
+        cv2.setRNGSeed(self.RANSAC_SEED)
+        homography, mask = cv2.findHomography(test_points, reference_points,
+                                              estimator, self.ransac_threshold)
+        if homography is None or mask is None:
+            return None, 0
+        return homography, int(mask.sum())
+
+    def match(self, kp1: np.ndarray, des1: Optional[np.ndarray],
+              kp2: np.ndarray, des2: Optional[np.ndarray]) -> Tuple[float, Dict[str, Any]]:
+        """Score de similaridade entre dois conjuntos de features (referência, teste)"""
+        details = {'orb_keypoints': [len(kp1), len(kp2)], 'orb_matches': 0}
+        good = self.good_matches(des1, des2)
+        details['orb_matches'] = len(good)
+        accepted = len(good)
+
+        if self.verify_geometry:
+            _, inliers = self.homography(kp1, kp2, good)
+            details['orb_inliers'] = inliers
+            accepted = inliers
+
+        score = accepted / max(len(kp1), len(kp2), 1)
+        return min(1.0, score), details
+
+
+class IlluminationNormalizer:
+    """Normalização de iluminação antes da comparação
+    
+    Equaliza o histograma localmente (CLAHE) nas duas imagens e alinha a foto
+    à referência por ECC com movimento afim em baixa resolução, reaproveitando
+    o warp na resolução de trabalho. Cada thread mantém sua própria instância
+    de CLAHE, criada uma única vez, já que o objeto do OpenCV não é seguro para
+    uso concorrente.
+    """
+
+    def __init__(self, clip_limit: float = CLAHE_CLIP_LIMIT, tile_grid: int = CLAHE_TILE_GRID,
+                 align: bool = True, ecc_side: int = ECC_SIDE, max_iterations: int = ECC_MAX_ITERATIONS,
+                 epsilon: float = ECC_EPSILON):
+        self.clip_limit = clip_limit
+        self.tile_grid = tile_grid
+        self.align = align
+        self.ecc_side = ecc_side
+        self.criteria = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, max_iterations, epsilon)
+        self._local = threading.local()
+
+    @property
+    def signature(self) -> str:
+        """Identifica os parâmetros que mudam a referência normalizada"""
+        alignment = f"-ecc{self.ecc_side}" if self.align else ''
+        return f"clahe{self.clip_limit:g}x{self.tile_grid}{alignment}"
+
+    def _clahe(self):
+        clahe = getattr(self._local, 'clahe', None)
+        if clahe is None:
+            clahe = cv2.createCLAHE(clipLimit=self.clip_limit, tileGridSize=(self.tile_grid, self.tile_grid))
+            self._local.clahe = clahe
+        return clahe
+
+    def equalize(self, gray: np.ndarray) -> np.ndarray:
+        """CLAHE de uma imagem em tons de cinza (uint8)"""
+        return self._clahe().apply(gray)
+
+    def ecc_level(self, pyramid: List[np.ndarray]) -> int:
+        """Nível da pirâmide usado no ECC: o primeiro com maior lado até ecc_side"""
+        return next((level for level, image in enumerate(pyramid) if max(image.shape[:2]) <= self.ecc_side),
+                    len(pyramid) - 1)
+
+    @staticmethod
+    def ecc_template(image: np.ndarray) -> np.ndarray:
+        """Magnitude do gradiente, a imagem em que o ECC é calculado
+        
+        Bordas e traços sobrevivem à iluminação desigual que a CLAHE não
+        corrige por completo; nas intensidades o ECC converge para máximos
+        locais.
+        """
+        image = image.astype(np.float32)
+        return cv2.magnitude(cv2.Sobel(image, cv2.CV_32F, 1, 0), cv2.Sobel(image, cv2.CV_32F, 0, 1))
+
+    def align_to(self, reference: 'ImageFeatures', test_img: np.ndarray) -> Tuple[np.ndarray, Dict[str, Any]]:
+        """Alinha a foto (já equalizada, no tamanho da referência) por ECC afim
+        
+        O warp é estimado entre o nível ecc_level da pirâmide da referência e a
+        foto reduzida pelo mesmo caminho (pyrDown, que preserva o alinhamento
+        dos centros dos pixels) e então aplicado à foto na resolução de
+        trabalho. Sem convergência, com um warp implausível ou que não melhora
+        a correlação, a foto volta sem alteração.
+        """
+        level = self.ecc_level(reference.pyramid)
+        template = reference.ecc if reference.ecc is not None else self.ecc_template(reference.pyramid[level])
+        small = test_img
+        for _ in range(level):
+            small = cv2.pyrDown(small)
+        small = self.ecc_template(small)
+        height, width = template.shape[:2]
+        
+        warp = np.eye(2, 3, dtype=np.float32)
+        try:
+            _, warp = cv2.findTransformECC(template, small, warp, cv2.MOTION_AFFINE, self.criteria, None, 5)
+        except cv2.error:
+            return test_img, {'aligned': False, 'reason': 'NOT_CONVERGED'}
+        
+        if (np.abs(warp[:, :2] - np.eye(2)).max() > ECC_MAX_DEFORMATION
+                or abs(warp[0, 2]) > ECC_MAX_DEFORMATION * width
+                or abs(warp[1, 2]) > ECC_MAX_DEFORMATION * height):
+            return test_img, {'aligned': False, 'reason': 'IMPLAUSIBLE_WARP'}
+        
+        before = cv2.computeECC(template, small)
+        after = cv2.computeECC(template, cv2.warpAffine(small, warp, (width, height),
+                                                        flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP,
+                                                        borderMode=cv2.BORDER_REPLICATE))
+        # Melhora mínima igual ao critério de parada: imagens já alinhadas ficam intactas
+        if after - before < ECC_EPSILON:
+            return test_img, {'aligned': False, 'reason': 'NO_IMPROVEMENT', 'correlation': round(before, 4)}
+        
+        # Mesmo warp na resolução de trabalho: só a translação muda de escala
+        full_height, full_width = test_img.shape[:2]
+        scale_x, scale_y = full_width / width, full_height / height
+        full_warp = warp.copy()
+        full_warp[0, 1] *= scale_x / scale_y
+        full_warp[1, 0] *= scale_y / scale_x
+        full_warp[0, 2] *= scale_x
+        full_warp[1, 2] *= scale_y
+        aligned = cv2.warpAffine(test_img, full_warp, (full_width, full_height),
+                                 flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP, borderMode=cv2.BORDER_REPLICATE)
+        return aligned, {
+            'aligned': True,
+            'correlation': [round(before, 4), round(after, 4)],
+            'translation': [round(float(full_warp[0, 2]), 2), round(float(full_warp[1, 2]), 2)]
+        }
+
+
+class ImageFeatures:
+    """Imagem pré-processada: tons de cinza, resolução de trabalho, pirâmide, features ORB e miniatura Lab"""
+
+    def __init__(self, gray: np.ndarray, working: np.ndarray, pyramid: List[np.ndarray],
+                 keypoints: Optional[np.ndarray] = None, descriptors: Optional[np.ndarray] = None,
+                 phash: Optional[np.ndarray] = None, rois: Optional[List[Dict[str, Any]]] = None,
+                 color: Optional[np.ndarray] = None, ecc: Optional[np.ndarray] = None):
+        self.gray = gray
+        self.working = working
+        self.pyramid = pyramid  # pyramid[0] é a própria imagem de trabalho
+        self.keypoints = keypoints
+        self.descriptors = descriptors
+        self.phash = phash
+        self.rois = rois  # regiões de interesse (normalize_rois) associadas à referência
+        self.color = color  # miniatura Lab (lab_thumbnail) para o método color
+        self.ecc = ecc  # gradiente do nível de alinhamento (IlluminationNormalizer.ecc_template)
+
+    def with_rois(self, rois: Optional[List[Dict[str, Any]]]) -> 'ImageFeatures':
+        """Cópia rasa com outras regiões de interesse (os arrays são compartilhados)"""
+        return ImageFeatures(self.gray, self.working, self.pyramid, self.keypoints, self.descriptors,
+                             self.phash, rois, self.color, self.ecc)
+
+    def arrays(self) -> Dict[str, np.ndarray]:
+        """Arrays que compõem as features, sem duplicar os que são compartilhados"""
+        arrays = {'gray': self.gray}
+        if self.working is not self.gray:
+            arrays['working'] = self.working
+        for level, image in enumerate(self.pyramid[1:], start=1):
+            arrays[f'pyramid_{level}'] = image
+        if self.keypoints is not None:
+            arrays['keypoints'] = self.keypoints
+        if self.descriptors is not None:
+            arrays['descriptors'] = self.descriptors
+        if self.phash is not None:
+            arrays['phash'] = self.phash
+        if self.color is not None:
+            arrays['color'] = self.color
+        if self.ecc is not None:
+            arrays['ecc'] = self.ecc
+        return arrays
+
+    @property
+    def nbytes(self) -> int:
+        return sum(array.nbytes for array in self.arrays().values())
+
+    @classmethod
+    def from_arrays(cls, arrays: Dict[str, np.ndarray]) -> 'ImageFeatures':
+        gray = arrays['gray']
+        working = arrays.get('working', gray)
+        levels = sorted(int(name.split('_')[1]) for name in arrays if name.startswith('pyramid_'))
+        pyramid = [working] + [arrays[f'pyramid_{level}'] for level in levels]
+        return cls(gray, working, pyramid, arrays.get('keypoints'), arrays.get('descriptors'),
+                   arrays.get('phash'), color=arrays.get('color'), ecc=arrays.get('ecc'))
+
+
+class ReferenceFeatureStore:
+    """Cache de features das imagens de referência, indexado pelo hash do conteúdo
+
+    Mantém as entradas mais recentes em memória (LRU limitado em bytes) e, se
+    cache_dir for informado, grava cada entrada em disco como arquivos .npy que
+    são reabertos via memory-map, compartilhados entre processos worker.
+    """
+
+    def __init__(self, max_bytes: int = 256 * 1024 * 1024, cache_dir: Optional[str] = None):
+        self.max_bytes = max_bytes
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        if self.cache_dir:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+        self._entries: 'OrderedDict[str, ImageFeatures]' = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.counters = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0}
+
+    def get(self, key: str) -> Optional[ImageFeatures]:
+        """Busca features em memória e, em seguida, no disco"""
+        with self._lock:
+            features = self._entries.get(key)
+            if features is not None:
+                self._entries.move_to_end(key)
+                self.counters['memory_hits'] += 1
+                return features
+
+        features = self._load_from_disk(key)
+        if features is None:
+            with self._lock:
+                self.counters['misses'] += 1
+            return None
+
+        with self._lock:
+            self.counters['disk_hits'] += 1
+        self._remember(key, features)
+        return features
+
+    def put(self, key: str, features: ImageFeatures) -> None:
+        """Armazena features em memória e grava no disco (se configurado)"""
+        self._remember(key, features)
+        if self.cache_dir:
+            self._save_to_disk(key, features)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {'entries': len(self._entries), 'bytes': self._bytes, **self.counters}
+
+    def _remember(self, key: str, features: ImageFeatures) -> None:
+        size = features.nbytes
+        if size > self.max_bytes:
+            # Entrada maior que o orçamento inteiro: fica apenas no disco
+            return
+
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= previous.nbytes
+
+            self._entries[key] = features
+            self._bytes += size
+
+            while self._bytes > self.max_bytes and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted.nbytes
+
+    def _entry_dir(self, key: str) -> Path:
+        return self.cache_dir / key
+
+    def _load_from_disk(self, key: str) -> Optional[ImageFeatures]:
+        if not self.cache_dir:
+            return None
+
+        entry_dir = self._entry_dir(key)
+        if not entry_dir.is_dir():
+            return None
+
+        try:
+            arrays = {
+                path.stem: np.load(path, mmap_mode='r', allow_pickle=False)
+                for path in entry_dir.glob('*.npy')
+            }
+            return ImageFeatures.from_arrays(arrays)
+        except Exception as e:
+            logger.warning(f"Entrada de cache inválida {entry_dir}: {str(e)}")
+            return None
+
+    def _save_to_disk(self, key: str, features: ImageFeatures) -> None:
+        entry_dir = self._entry_dir(key)
+        if entry_dir.exists():
+            return
+
+        # Gravar em diretório temporário e renomear, para que outros processos
+        # nunca leiam uma entrada incompleta
+        temp_dir = Path(tempfile.mkdtemp(prefix=f'.{key}-', dir=self.cache_dir))
+        try:
+            for name, array in features.arrays().items():
+                np.save(temp_dir / f'{name}.npy', np.ascontiguousarray(array))
+            os.rename(temp_dir, entry_dir)
+        except OSError as e:
+            if not entry_dir.exists():
+                logger.warning(f"Não foi possível gravar cache de features {entry_dir}: {str(e)}")
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+class ComparisonResultCache:
+    """Cache de resultados de comparação, indexado pelos hashes das imagens e parâmetros
+
+    Fotos reenviadas (novas tentativas do app) chegam com os mesmos bytes e não
+    precisam ser recomparadas. As entradas ficam em um LRU em memória e, se
+    db_path for informado, também em um banco SQLite compartilhado entre
+    processos. Ambos os níveis expiram entradas após ttl segundos e descartam
+    as menos usadas acima do limite de entradas.
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl: Optional[float] = None,
+                 db_path: Optional[str] = None, max_db_entries: int = 100_000):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_db_entries = max_db_entries
+        self.db_path = db_path
+
+        self._entries: 'OrderedDict[str, Tuple[float, Dict[str, Any]]]' = OrderedDict()
+        self._lock = threading.Lock()
+        self.counters = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'expired': 0, 'evictions': 0}
+
+        self._db = None
+        if db_path:
+            Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+            self._db = sqlite3.connect(db_path, timeout=10, check_same_thread=False)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS results ('
+                'key TEXT PRIMARY KEY, result TEXT NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)'
+            )
+            self._db.execute('CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed)')
+            self._db.commit()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """Busca um resultado em memória e, em seguida, no SQLite"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                created, result = entry
+                if self._expired(created, now):
+                    del self._entries[key]
+                    self.counters['expired'] += 1
+                else:
+                    self._entries.move_to_end(key)
+                    self.counters['memory_hits'] += 1
+                    return dict(result)
+
+            if self._db is not None:
+                result = self._get_from_db(key, now)
+                if result is not None:
+                    self.counters['disk_hits'] += 1
+                    self._remember(key, result, now)
+                    return dict(result)
+
+            self.counters['misses'] += 1
+            return None
+
+    def put(self, key: str, result: Dict[str, Any]) -> None:
+        """Armazena um resultado em memória e no SQLite (se configurado)"""
+        now = time.time()
+        with self._lock:
+            self._remember(key, result, now)
+            if self._db is not None:
+                self._put_in_db(key, result, now)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            hits = self.counters['memory_hits'] + self.counters['disk_hits']
+            lookups = hits + self.counters['misses']
+            stats = {
+                'entries': len(self._entries),
+                'hits': hits,
+                'hit_rate': round(hits / lookups, 4) if lookups else 0.0,
+                **self.counters
+            }
+            if self._db is not None:
+                stats['db_entries'] = self._db.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+            return stats
+
+    def _expired(self, created: float, now: float) -> bool:
+        return self.ttl is not None and now - created > self.ttl
+
+    def _remember(self, key: str, result: Dict[str, Any], created: float) -> None:
+        self._entries[key] = (created, result)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.counters['evictions'] += 1
+
+    def _get_from_db(self, key: str, now: float) -> Optional[Dict[str, Any]]:
+        try:
+            row = self._db.execute('SELECT result, created FROM results WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            if self._expired(row[1], now):
+                self._db.execute('DELETE FROM results WHERE key = ?', (key,))
+                self._db.commit()
+                self.counters['expired'] += 1
+                return None
+
+            self._db.execute('UPDATE results SET accessed = ? WHERE key = ?', (now, key))
+            self._db.commit()
+            return json.loads(row[0])
+        except sqlite3.Error as e:
+            logger.warning(f"Erro ao ler cache de resultados: {str(e)}")
+            return None
+
+    def _put_in_db(self, key: str, result: Dict[str, Any], now: float) -> None:
+        try:
+            self._db.execute(
+                'INSERT OR REPLACE INTO results (key, result, created, accessed) VALUES (?, ?, ?, ?)',
+                (key, json.dumps(result, default=float), now, now)
+            )
+            if self.ttl is not None:
+                self._db.execute('DELETE FROM results WHERE created < ?', (now - self.ttl,))
+            evicted = self._db.execute(
+                'DELETE FROM results WHERE key IN ('
+                'SELECT key FROM results ORDER BY accessed DESC LIMIT -1 OFFSET ?)',
+                (self.max_db_entries,)
+            ).rowcount
+            self.counters['evictions'] += max(evicted, 0)
+            self._db.commit()
+        except sqlite3.Error as e:
+            logger.warning(f"Erro ao gravar cache de resultados: {str(e)}")
+
+
+class SessionDedup:
+    """Detector de fotos quase idênticas dentro de uma sessão de inspeção
+    
+    Inspetores costumam enviar várias fotos seguidas da mesma etiqueta. Cada
+    foto comparada com sucesso fica registrada na sessão com seu pHash e dHash;
+    uma nova foto cujos dois hashes estão a no máximo max_distance bits de uma
+    já registrada (com a mesma referência e parâmetros, o escopo) reaproveita o
+    resultado dela. As sessões ficam em memória, expiram após ttl segundos sem
+    uso e as menos recentes são descartadas acima de max_sessions.
+    """
+
+    def __init__(self, max_distance: int = DEDUP_MAX_DISTANCE, max_sessions: int = 1024,
+                 max_photos: int = 32, ttl: Optional[float] = 1800.0):
+        self.max_distance = max_distance
+        self.max_sessions = max_sessions
+        self.max_photos = max_photos
+        self.ttl = ttl
+
+        self._sessions: 'OrderedDict[str, Tuple[float, List[Dict[str, Any]]]]' = OrderedDict()
+        self._lock = threading.Lock()
+        self.counters = {'hits': 0, 'misses': 0, 'expired': 0}
+
+    def lookup(self, session_id: str, scope: str, phash: np.ndarray,
+               dhash: np.ndarray) -> Optional[Dict[str, Any]]:
+        """Foto já pontuada mais próxima dentro da tolerância (photo_id, result, distance)"""
+        with self._lock:
+            photos = self._photos(session_id, time.time())
+            best = None
+            for photo in photos:
+                if photo['scope'] != scope:
+                    continue
+                phash_distance = hamming_distance(phash, photo['phash'])
+                dhash_distance = hamming_distance(dhash, photo['dhash'])
+                if max(phash_distance, dhash_distance) > self.max_distance:
+                    continue
+                if best is None or phash_distance + dhash_distance < sum(best['distance'].values()):
+                    best = {'photo_id': photo['photo_id'], 'result': dict(photo['result']),
+                            'distance': {'phash': phash_distance, 'dhash': dhash_distance}}
+
+            self.counters['hits' if best else 'misses'] += 1
+            return best
+
+    def add(self, session_id: str, scope: str, photo_id: str, phash: np.ndarray, dhash: np.ndarray,
+            result: Dict[str, Any]) -> None:
+        """Registra uma foto pontuada na sessão"""
+        now = time.time()
+        with self._lock:
+            photos = self._photos(session_id, now)
+            photos.append({'scope': scope, 'photo_id': photo_id, 'phash': phash, 'dhash': dhash,
+                           'result': result})
+            del photos[:-self.max_photos]
+            self._sessions[session_id] = (now, photos)
+            self._sessions.move_to_end(session_id)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+
+    def forget(self, session_id: str) -> bool:
+        """Descarta as fotos de uma sessão encerrada"""
+        with self._lock:
+            return self._sessions.pop(session_id, None) is not None
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {'sessions': len(self._sessions), **self.counters}
+
+    def _photos(self, session_id: str, now: float) -> List[Dict[str, Any]]:
+        entry = self._sessions.get(session_id)
+        if entry is None:
+            return []
+        last_used, photos = entry
+        if self.ttl is not None and now - last_used > self.ttl:
+            del self._sessions[session_id]
+            self.counters['expired'] += 1
+            return []
+        return photos
+
+
 class ImageComparator:
     """Classe para comparação de imagens usando múltiplos métodos"""
     
-    def __init__(self):
-        self.methods = {
-            'ssim': self._compare_ssim,
-            'orb': self._compare_orb,
-            'template': self._compare_template
-        }
+    def __init__(self, feature_store: Optional[ReferenceFeatureStore] = None,
+                 working_pixels: Optional[int] = None, orb_features: int = 1000,
+                 ssim_margin: float = DEFAULT_SSIM_MARGIN, orb_matcher: Optional[OrbMatcher] = None,
+                 instrument: bool = False, profile_dir: Optional[str] = None,
+                 ssim_engine: str = 'skimage', fast_ssim_mode: str = 'box', ssim_tile: int = SSIM_TILE,
+                 result_cache: Optional[ComparisonResultCache] = None,
+                 executor: Optional[Executor] = None, max_concurrency: Optional[int] = None,
+                 localize: bool = False, quality_gate: Optional[QualityGate] = None,
+                 session_dedup: Optional[SessionDedup] = None,
+                 max_pixels: Optional[int] = MAX_INPUT_PIXELS, max_bytes: Optional[int] = MAX_INPUT_BYTES,
+                 normalizer: Optional[IlluminationNormalizer] = None):
+        if ssim_engine not in SSIM_ENGINES:
+            raise ValueError(f"Engine de SSIM '{ssim_engine}' não suportado")
+        if fast_ssim_mode not in FAST_SSIM_MODES:
+            raise ValueError(f"Modo de SSIM '{fast_ssim_mode}' não suportado")
+        
+        self.methods = {
+            'ssim': self._compare_ssim,
+            'orb': self._compare_orb,
+            'template': self._compare_template,
+            'color': self._compare_color
+        }
+        self.feature_store = feature_store
+        self.working_pixels = working_pixels  # None = comparar na resolução original
+        self.orb = orb_matcher or OrbMatcher(nfeatures=orb_features)
+        self.ssim_margin = ssim_margin
+        self.instrument = instrument  # tempos por estágio em cada resultado
+        self.profile_dir = profile_dir  # um arquivo .prof (cProfile) por chamada
+        self.ssim_engine = ssim_engine  # 'skimage' ou 'fast' (fast_ssim, na janela fast_ssim_mode)
+        self.fast_ssim_mode = fast_ssim_mode
+        self.ssim_tile = ssim_tile  # imagens com um lado maior que isso são comparadas por blocos
+        self.result_cache = result_cache  # resultados de compare_images por conteúdo das imagens
+        self.localize = localize  # recortar a etiqueta da foto antes de comparar
+        self.quality_gate = quality_gate  # recusar fotos ruins antes de comparar
+        self.session_dedup = session_dedup  # reaproveitar fotos quase idênticas da mesma sessão
+        self.max_pixels = max_pixels  # orçamento de pixels decodificados por imagem (None = sem limite)
+        self.max_bytes = max_bytes  # tamanho máximo do arquivo de entrada (None = sem limite)
+        self.normalizer = normalizer  # CLAHE e alinhamento ECC antes de comparar
+        # Regiões de interesse por referência (hash do conteúdo); com cache em
+        # disco de features elas são gravadas junto, em cache_dir/rois
+        self._rois: Dict[str, List[Dict[str, Any]]] = {}
+        self._rois_mtime: Dict[str, int] = {}
+        self._rois_dir = (self.feature_store.cache_dir / 'rois'
+                          if self.feature_store is not None and self.feature_store.cache_dir else None)
+        # API assíncrona: executor do trabalho de CPU (threads, por padrão) e
+        # limite de comparações simultâneas por event loop
+        self.executor = executor
+        self.max_concurrency = max_concurrency or os.cpu_count() or 1
+        self._async_semaphores: 'weakref.WeakKeyDictionary' = weakref.WeakKeyDictionary()
+        self._async_lock = threading.Lock()
+    
+    def _read_source(self, image_path: ImageSource) -> bytes:
+        """Lê o conteúdo bruto de um arquivo local ou URL (bytes são usados diretamente)
+        
+        Entradas acima de max_bytes são recusadas sem serem lidas por inteiro.
+        """
+        if isinstance(image_path, (bytes, bytearray, memoryview)):
+            data = bytes(image_path)
+        elif image_path.startswith('http'):
+            with urllib.request.urlopen(image_path, timeout=30) as response:
+                data = response.read(self.max_bytes + 1 if self.max_bytes else -1)
+        else:
+            if self.max_bytes and os.path.getsize(image_path) > self.max_bytes:
+                self._reject_bytes(image_path, os.path.getsize(image_path))
+            with open(image_path, 'rb') as f:
+                data = f.read()
+        
+        if self.max_bytes and len(data) > self.max_bytes:
+            self._reject_bytes(image_path, len(data))
+        return data
+    
+    def _reject_bytes(self, image_path: ImageSource, size: int) -> None:
+        raise InputTooLarge(f"Imagem {describe_source(image_path)} excede o limite de "
+                            f"{self.max_bytes / (1024 * 1024):.1f} MB", max_bytes=self.max_bytes, bytes=size)
+    
+    def _budget_reduction(self, data: bytes, image_path: ImageSource) -> int:
+        """Menor fator de redução na decodificação que respeita max_pixels
+        
+        Lido do cabeçalho, antes de decodificar. Só JPEG pode ser reduzido
+        durante a decodificação; outros formatos acima do orçamento (e JPEGs
+        grandes demais mesmo reduzidos por 8) são recusados. Formatos cujo
+        cabeçalho não é lido aqui (JPEG 2000, por exemplo) são decodificados
+        inteiros e verificados depois, em _check_decoded_pixels.
+        """
+        if not self.max_pixels:
+            return 1
+        
+        info = image_header_info(data)
+        if info is None:
+            return 1
+        
+        image_format, width, height = info
+        if width * height <= self.max_pixels:
+            return 1
+        if image_format == 'jpeg':
+            for factor in sorted(REDUCED_GRAYSCALE_FLAGS):
+                if (width // factor) * (height // factor) <= self.max_pixels:
+                    return factor
+        self._reject_pixels(image_path, width, height)
+    
+    def _check_decoded_pixels(self, image: np.ndarray, image_path: ImageSource) -> None:
+        """Recusa uma imagem decodificada acima de max_pixels (cabeçalho não lido antes)"""
+        height, width = image.shape[:2]
+        if self.max_pixels and width * height > self.max_pixels:
+            self._reject_pixels(image_path, width, height)
+    
+    def _reject_pixels(self, image_path: ImageSource, width: int, height: int) -> None:
+        raise InputTooLarge(f"Imagem {describe_source(image_path)} ({width}x{height}) excede o limite de "
+                            f"{self.max_pixels} pixels", max_pixels=self.max_pixels, width=width, height=height)
+    
+    def _decode_reduction(self, data: bytes) -> int:
+        """Fator de redução na decodificação (1, 2, 4 ou 8) para o orçamento de trabalho
+        
+        Só se aplica a JPEG, cujo decodificador reduz a escala sem decodificar a
+        resolução cheia. Escolhe o maior fator que ainda entrega pelo menos
+        working_pixels; PNG, imagens pequenas e cabeçalhos ilegíveis usam 1.
+        """
+        if not self.working_pixels:
+            return 1
+        
+        info = image_header_info(data)
+        if info is None or info[0] != 'jpeg':
+            return 1
+        
+        _, width, height = info
+        for factor in sorted(REDUCED_GRAYSCALE_FLAGS, reverse=True):
+            if (width // factor) * (height // factor) >= self.working_pixels:
+                return factor
+        return 1
+    
+    def _decode_gray(self, data: bytes, image_path: ImageSource) -> np.ndarray:
+        """Decodifica o conteúdo de uma imagem já convertendo para escala de cinza
+        
+        Imagens acima de max_pixels são decodificadas já reduzidas (JPEG) ou
+        recusadas com InputTooLarge.
+        """
+        return self._decode(data, image_path)[0]
+    
+    def _decode(self, data: bytes, image_path: ImageSource,
+                with_color: bool = False) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+        """Decodifica em cinza e, com with_color, também uma cópia colorida reduzida
+        
+        A cópia colorida (BGR, maior lado até COLOR_DECODE_SIDE) vem de uma
+        segunda decodificação reduzida quando o JPEG é decodificado reduzido em
+        cinza; nos demais casos ela sai da mesma decodificação colorida.
+        """
+        buffer = np.frombuffer(data, dtype=np.uint8)
+        budget = self._budget_reduction(data, image_path)
+        factor = max(self._decode_reduction(data), budget)
+        
+        if factor > 1:
+            # JPEG grande: decodificar direto em cinza e em escala reduzida
+            gray = cv2.imdecode(buffer, REDUCED_GRAYSCALE_FLAGS[factor])
+            if gray is not None:
+                color = None
+                if with_color:
+                    color_factor = max([budget] + [f for f in REDUCED_COLOR_FLAGS
+                                                   if max(gray.shape[:2]) * factor // f >= COLOR_DECODE_SIDE])
+                    color = cv2.imdecode(buffer, REDUCED_COLOR_FLAGS[color_factor]
+                                         if color_factor > 1 else cv2.IMREAD_COLOR)
+                    if color is None:
+                        raise ValueError(f"Não foi possível carregar a imagem: {describe_source(image_path)}")
+                    color = downscale_to(color, COLOR_DECODE_SIDE)
+                return gray, color
+        
+        image = cv2.imdecode(buffer, cv2.IMREAD_COLOR)
+        
+        if image is None:
+            raise ValueError(f"Não foi possível carregar a imagem: {describe_source(image_path)}")
+        self._check_decoded_pixels(image, image_path)
+        
+        return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY), downscale_to(image, COLOR_DECODE_SIDE) if with_color else None
+    
+    def load_image(self, image_path: ImageSource) -> np.ndarray:
+        """Carrega e pré-processa uma imagem (caminho, URL ou conteúdo em bytes)"""
+        try:
+            return self._decode_gray(self._read_source(image_path), image_path)
+            
+        except Exception as e:
+            logger.error(f"Erro ao carregar imagem {describe_source(image_path)}: {str(e)}")
+            raise
+    
+    def _to_working_resolution(self, gray: np.ndarray) -> np.ndarray:
+        """Reduz a imagem para o orçamento de pixels configurado (interpolação por área)"""
+        height, width = gray.shape[:2]
+        if not self.working_pixels or height * width <= self.working_pixels:
+            return gray
+        
+        scale = (self.working_pixels / float(height * width)) ** 0.5
+        size = (max(1, int(width * scale)), max(1, int(height * scale)))
+        return cv2.resize(gray, size, interpolation=cv2.INTER_AREA)
+    
+    def _build_features(self, gray: np.ndarray, with_orb: bool = False,
+                        color: Optional[np.ndarray] = None) -> ImageFeatures:
+        """Gera resolução de trabalho, pirâmide gaussiana, (opcionalmente) features ORB e miniatura Lab
+        
+        Com normalizer, a resolução de trabalho já é equalizada (CLAHE) antes
+        da pirâmide e das features, que ficam assim em cache junto com o
+        gradiente do nível de alinhamento (ECC).
+        """
+        working = self._to_working_resolution(gray)
+        if self.normalizer is not None:
+            working = self.normalizer.equalize(working)
+        
+        pyramid = [working]
+        while min(pyramid[-1].shape[:2]) // 2 >= MIN_PYRAMID_SIDE:
+            pyramid.append(cv2.pyrDown(pyramid[-1]))
+        
+        keypoints = descriptors = phash = ecc = None
+        if with_orb:
+            keypoints, descriptors = self.orb.detect(working)
+            phash = perceptual_hash(working)
+            if self.normalizer is not None and self.normalizer.align:
+                ecc = self.normalizer.ecc_template(pyramid[self.normalizer.ecc_level(pyramid)])
+        
+        return ImageFeatures(gray, working, pyramid, keypoints, descriptors, phash,
+                             color=lab_thumbnail(color) if color is not None else None, ecc=ecc)
+    
+    def _feature_signature(self) -> str:
+        """Identifica os parâmetros que influenciam as features armazenadas em cache"""
+        normalization = f"-{self.normalizer.signature}" if self.normalizer is not None else ''
+        return f"w{self.working_pixels or 0}-{self.orb.signature}-lab{COLOR_SIDE}{normalization}"
+    
+    def _comparison_scope(self, reference_data: bytes, method: str, threshold: Optional[float],
+                          rois: Optional[List[Dict[str, Any]]] = None) -> str:
+        """Referência e parâmetros de uma comparação: só o conteúdo da foto de teste fica de fora"""
+        reference_hash = content_hash(reference_data)
+        if rois is None:
+            rois = self.reference_rois(reference_hash)
+        parameters = (f"{method}|{threshold}|{self._feature_signature()}|{self.orb.scoring_signature}"
+                      f"|{self.ssim_margin}|{self.ssim_engine}|{self.fast_ssim_mode}|{self.ssim_tile}"
+                      f"|{self.localize}|{self.normalizer.criteria if self.normalizer else None}"
+                      f"|{self.quality_gate.signature if self.quality_gate else None}"
+                      f"|{self.max_pixels}|{self.max_bytes}|{json.dumps(rois, sort_keys=True)}")
+        return content_hash(f"{reference_hash}|{parameters}".encode())
+    
+    def _result_key(self, scope: str, test_data: bytes) -> str:
+        """Chave do cache de resultados: conteúdo das duas imagens e parâmetros da comparação"""
+        return content_hash(f"{scope}|{content_hash(test_data)}".encode())
+    
+    def set_reference_rois(self, reference_path: ImageSource,
+                           rois: Optional[List[Dict[str, Any]]]) -> Dict[str, Any]:
+        """Associa regiões de interesse (com pesos) a uma referência; None ou [] remove"""
+        reference_hash = content_hash(self._read_source(reference_path))
+        rois = normalize_rois(rois) if rois else []
+        
+        if rois:
+            self._rois[reference_hash] = rois
+        else:
+            self._rois.pop(reference_hash, None)
+        
+        if self._rois_dir is not None:
+            path = self._rois_dir / f'{reference_hash}.json'
+            if rois:
+                self._rois_dir.mkdir(parents=True, exist_ok=True)
+                temp_path = path.with_suffix(f'.{os.getpid()}.tmp')
+                temp_path.write_text(json.dumps(rois), encoding='utf-8')
+                os.replace(temp_path, path)
+            elif path.exists():
+                path.unlink()
+        
+        logger.info(f"{len(rois)} região(ões) de interesse associada(s) à referência {reference_hash[:12]}")
+        return {'reference_hash': reference_hash, 'rois': rois}
+    
+    def reference_rois(self, reference_hash: str) -> Optional[List[Dict[str, Any]]]:
+        """Regiões de interesse associadas a uma referência (pelo hash do conteúdo)
+        
+        Com cache em disco o arquivo é a fonte da verdade: outro processo do
+        pool pode ter alterado as regiões, então a cópia em memória só vale
+        enquanto o mtime do arquivo não muda.
+        """
+        if self._rois_dir is None:
+            return self._rois.get(reference_hash)
+        
+        path = self._rois_dir / f'{reference_hash}.json'
+        try:
+            mtime = path.stat().st_mtime_ns
+        except FileNotFoundError:
+            self._rois.pop(reference_hash, None)
+            self._rois_mtime.pop(reference_hash, None)
+            return None
+        
+        if self._rois_mtime.get(reference_hash) != mtime:
+            self._rois[reference_hash] = json.loads(path.read_text(encoding='utf-8'))
+            self._rois_mtime[reference_hash] = mtime
+        return self._rois[reference_hash]
     
-    def load_image(self, image_path: str) -> np.ndarray:
-        """Carrega e pré-processa uma imagem"""
+    def prepare_reference(self, reference_path: ImageSource,
+                          timer: Optional[StageTimer] = None) -> ImageFeatures:
+        """Carrega as features da referência, reaproveitando o cache quando possível"""
+        timer = timer or StageTimer(enabled=False)
         try:
-            # Carregar imagem
-            if image_path.startswith('http'):
-                # Para URLs, usar skimage
-                image = io.imread(image_path)
-                if len(image.shape) == 3:
-                    image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
-            else:
-                # Para arquivos locais, usar OpenCV
-                image = cv2.imread(image_path)
+            with timer.stage('read_reference'):
+                data = self._read_source(reference_path)
             
-            if image is None:
-                raise ValueError(f"Não foi possível carregar a imagem: {image_path}")
+            features = key = reference_hash = None
+            if self.feature_store is not None or self._rois or self._rois_dir is not None:
+                reference_hash = content_hash(data)
+            if self.feature_store is not None:
+                with timer.stage('reference_cache'):
+                    key = f"{reference_hash}-{self._feature_signature()}"
+                    features = self.feature_store.get(key)
+            timer.record(reference_cache_hit=features is not None)
             
-            # Converter para escala de cinza
-            if len(image.shape) == 3:
-                gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-            else:
-                gray = image
+            if features is None:
+                with timer.stage('decode_reference'):
+                    gray, color = self._decode(data, reference_path, with_color=True)
+                timer.decoded('reference', len(data))
+                
+                with timer.stage('reference_features'):
+                    features = self._build_features(gray, with_orb=True, color=color)
+                
+                if key is not None:
+                    self.feature_store.put(key, features)
             
-            # Redimensionar para tamanho padrão (opcional)
-            # gray = cv2.resize(gray, (800, 600))
+            rois = self.reference_rois(reference_hash) if reference_hash else None
+            if rois:
+                features = features.with_rois(rois)
             
-            return gray
+            timer.image('reference', features.gray)
+            timer.image('reference_working', features.working)
+            return features
             
         except Exception as e:
-            logger.error(f"Erro ao carregar imagem {image_path}: {str(e)}")
+            logger.error(f"Erro ao carregar imagem {describe_source(reference_path)}: {str(e)}")
             raise
     
+    def check_quality(self, test_path: ImageSource) -> Dict[str, Any]:
+        """Relatório da verificação de qualidade de uma foto, sem compará-la
+        
+        Usa o quality_gate configurado ou, na falta dele, os limites padrão.
+        """
+        gate = self.quality_gate or QualityGate()
+        data = self._read_source(test_path)
+        header = image_header_info(data)
+        gray = self._decode_gray(data, test_path)
+        report = gate.check(gray, header[1:] if header else None)
+        return {**report, 'test_image': describe_source(test_path)}
+    
+    def _load_test(self, test_path: ImageSource, timer: Optional[StageTimer] = None) -> np.ndarray:
+        """Carrega a imagem de teste na resolução de trabalho"""
+        test_img, _, _ = self._load_test_for(test_path, None, timer)
+        return test_img
+
+    def _load_test_for(self, test_path: ImageSource, reference: Optional[ImageFeatures],
+                       timer: Optional[StageTimer] = None,
+                       color: bool = False) -> Tuple[np.ndarray, Optional[np.ndarray], Dict[str, Any]]:
+        """Carrega a imagem de teste para comparar com a referência
+
+        Com localize, a etiqueta é localizada na foto e recortada com correção
+        de perspectiva para a geometria da referência. Com normalizer, a foto é
+        equalizada e alinhada à referência. Retorna a imagem de trabalho, a
+        miniatura Lab no tamanho da da referência (só com color) e os detalhes
+        a acrescentar ao resultado: localization (com localize), alignment (com
+        normalizer) e downscale_factor, quando a foto excedeu max_pixels e foi
+        decodificada reduzida por esse fator em cada eixo.
+        """
+        timer = timer or StageTimer(enabled=False)
+
+        with timer.stage('read_test'):
+            data = self._read_source(test_path)
+        header = image_header_info(data)
+        if self.quality_gate is not None and header:
+            # Resolução insuficiente é recusada pelo cabeçalho, antes de decodificar
+            report = self.quality_gate.check_size(*header[1:])
+            if report is not None:
+                raise QualityRejected(report)
+        color = color and reference is not None and reference.color is not None
+        with timer.stage('decode_test'):
+            gray, test_bgr = self._decode(data, test_path, with_color=color)
+        timer.decoded('test', len(data))
+        timer.image('test', gray)
+        # Tamanho da foto original, mesmo quando ela foi decodificada já reduzida;
+        # o cabeçalho já aplica a orientação EXIF, como a decodificação
+        original_size = header[1:] if header else (gray.shape[1], gray.shape[0])
+        details = {}
+        if self.max_pixels and original_size[0] * original_size[1] > self.max_pixels:
+            details['downscale_factor'] = round(original_size[0] / gray.shape[1], 3)
+
+        if self.quality_gate is not None:
+            with timer.stage('quality_check'):
+                report = self.quality_gate.check(gray, original_size)
+            timer.record(quality=report['metrics'])
+            if not report['passed']:
+                raise QualityRejected(report)
+
+        with timer.stage('resize_test'):
+            test_img = self._to_working_resolution(gray)
+
+        homography = None
+        working_shape = test_img.shape
+        if self.localize and reference is not None:
+            with timer.stage('localize_test'):
+                # Os cantos são informados em pixels da foto original
+                test_img, details['localization'], homography = self._localize(reference, gray, test_img,
+                                                                               original_size)
+
+        if self.normalizer is not None:
+            with timer.stage('normalize_test'):
+                test_img = self.normalizer.equalize(test_img)
+            if self.normalizer.align and reference is not None:
+                with timer.stage('align_test'):
+                    if test_img.shape != reference.working.shape:
+                        test_img = self._resize_to(test_img, reference.working.shape)
+                    test_img, details['alignment'] = self.normalizer.align_to(reference, test_img)
+
+        test_color = None
+        if color:
+            with timer.stage('color_test'):
+                test_color = self._test_color(reference, test_bgr, working_shape, homography)
+
+        timer.image('test_working', test_img)
+        return test_img, test_color, details
+
+    @staticmethod
+    def _test_color(reference: ImageFeatures, test_bgr: np.ndarray, working_shape: Tuple[int, ...],
+                    homography: Optional[np.ndarray]) -> np.ndarray:
+        """Miniatura Lab da foto no tamanho da miniatura da referência
+        
+        Com a etiqueta localizada, a cópia colorida é recortada com a mesma
+        homografia (convertida para as escalas das miniaturas) em 4x o tamanho
+        da miniatura e reduzida por área, evitando aliasing.
+        """
+        thumb_height, thumb_width = reference.color.shape[:2]
+        if homography is None:
+            return lab_thumbnail(test_bgr, (thumb_width, thumb_height))
+        
+        ref_height, ref_width = reference.working.shape[:2]
+        oversample = 4
+        from_color = np.diag([working_shape[1] / test_bgr.shape[1], working_shape[0] / test_bgr.shape[0], 1.0])
+        to_thumb = np.diag([oversample * thumb_width / ref_width, oversample * thumb_height / ref_height, 1.0])
+        warped = cv2.warpPerspective(test_bgr, to_thumb @ homography @ from_color,
+                                     (oversample * thumb_width, oversample * thumb_height),
+                                     flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+        return lab_thumbnail(warped, (thumb_width, thumb_height))
+
+    def _localize(self, reference: ImageFeatures, gray: np.ndarray, working: np.ndarray,
+                  original_size: Tuple[int, int]) -> Tuple[np.ndarray, Dict[str, Any], Optional[np.ndarray]]:
+        """Localiza a etiqueta na foto e a recorta na geometria da referência
+
+        Tenta primeiro a homografia dos matches ORB com a referência e, se ela
+        não for confiável, o maior quadrilátero convexo entre os contornos. Sem
+        localização, a foto inteira é comparada como antes. Retorna também a
+        homografia (imagem de trabalho -> referência), ou None.
+        """
+        homography, localization = self._locate_by_features(reference, working)
+        if homography is None:
+            homography, localization = self._locate_by_contour(reference, working)
+        if homography is None:
+            logger.info("Etiqueta não localizada na foto; comparando a imagem inteira")
+            return working, {'method': None}, None
+
+        # Cantos da etiqueta na foto original
+        ref_height, ref_width = reference.working.shape[:2]
+        corners = cv2.perspectiveTransform(self._reference_corners(reference).reshape(-1, 1, 2),
+                                           np.linalg.inv(homography)).reshape(-1, 2)
+        original_scale = np.float32([original_size[0] / working.shape[1], original_size[1] / working.shape[0]])
+        localization['corners'] = np.round(corners * original_scale).astype(int).tolist()
+
+        # Recortar a partir da foto decodificada, reduzida por pyrDown enquanto
+        # a etiqueta nela for bem maior que a referência (evita aliasing)
+        source = gray
+        label_area = cv2.contourArea(corners) * gray.size / working.size
+        while label_area > 4 * ref_width * ref_height and min(source.shape[:2]) // 2 >= MIN_PYRAMID_SIDE:
+            source = cv2.pyrDown(source)
+            label_area /= 4
+        from_source = np.diag([working.shape[1] / source.shape[1], working.shape[0] / source.shape[0], 1.0])
+
+        cropped = cv2.warpPerspective(source, homography @ from_source, (ref_width, ref_height),
+                                      flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+        logger.info(f"Etiqueta localizada por {localization['method']}")
+        return cropped, localization, homography
+
+    @staticmethod
+    def _reference_corners(reference: ImageFeatures) -> np.ndarray:
+        """Cantos da imagem de trabalho da referência, em ordem horária"""
+        height, width = reference.working.shape[:2]
+        return np.float32([[0, 0], [width, 0], [width, height], [0, height]])
+
+    @staticmethod
+    def _plausible_quad(corners: np.ndarray, shape: Tuple[int, ...]) -> bool:
+        """Quadrilátero convexo e com área mínima dentro da foto"""
+        quad = corners.reshape(-1, 1, 2).astype(np.float32)
+        area = cv2.contourArea(quad)
+        return cv2.isContourConvex(quad) and area >= LOCALIZATION_MIN_AREA * shape[0] * shape[1]
+
+    def _locate_by_features(self, reference: ImageFeatures,
+                            working: np.ndarray) -> Tuple[Optional[np.ndarray], Dict[str, Any]]:
+        """Homografia foto -> referência a partir dos matches ORB"""
+        if reference.keypoints is None:
+            return None, {}
+
+        keypoints, descriptors = self.orb.detect(working)
+        good = self.orb.good_matches(reference.descriptors, descriptors)
+        homography, inliers = self.orb.homography(reference.keypoints, keypoints, good, LOCALIZATION_ESTIMATOR)
+        if homography is None or inliers < LOCALIZATION_MIN_INLIERS:
+            return None, {}
+
+        corners = cv2.perspectiveTransform(self._reference_corners(reference).reshape(-1, 1, 2),
+                                           np.linalg.inv(homography))
+        if not self._plausible_quad(corners, working.shape):
+            return None, {}
+        return homography, {'method': 'homography', 'inliers': inliers}
+
+    def _locate_by_contour(self, reference: ImageFeatures,
+                           working: np.ndarray) -> Tuple[Optional[np.ndarray], Dict[str, Any]]:
+        """Homografia foto -> referência a partir do contorno quadrilátero da etiqueta"""
+        edges = cv2.dilate(cv2.Canny(cv2.GaussianBlur(working, (5, 5), 0), 50, 150), None)
+        contours, _ = cv2.findContours(edges, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+        ref_height, ref_width = reference.working.shape[:2]
+        target = self._reference_corners(reference)
+        reference_hash = reference.phash if reference.phash is not None else perceptual_hash(reference.working)
+
+        for contour in sorted(contours, key=cv2.contourArea, reverse=True)[:5]:
+            approx = cv2.approxPolyDP(contour, 0.02 * cv2.arcLength(contour, True), True)
+            if len(approx) != 4 or not self._plausible_quad(approx, working.shape):
+                continue
+
+            # Cantos em ordem horária a partir do mais próximo da origem
+            points = approx.reshape(4, 2).astype(np.float32)
+            center = points.mean(axis=0)
+            points = points[np.argsort(np.arctan2(points[:, 1] - center[1], points[:, 0] - center[0]))]
+            points = np.roll(points, -int(np.argmin(points.sum(axis=1))), axis=0)
+
+            # Orientação: lados compatíveis com a proporção da referência e, entre
+            # as duas rotações restantes (0° e 180°), a de pHash mais próximo
+            top = np.linalg.norm(points[1] - points[0])
+            side = np.linalg.norm(points[3] - points[0])
+            if (top >= side) != (ref_width >= ref_height):
+                points = np.roll(points, -1, axis=0)
+
+            candidates = []
+            for rotation in (0, 2):
+                homography = cv2.getPerspectiveTransform(np.roll(points, -rotation, axis=0), target)
+                preview = cv2.warpPerspective(working, homography, (ref_width, ref_height))
+                candidates.append((hamming_distance(reference_hash, perceptual_hash(preview)), rotation))
+            distance, rotation = min(candidates)
+            homography = cv2.getPerspectiveTransform(np.roll(points, -rotation, axis=0), target)
+            return homography, {'method': 'contour', 'phash_distance': distance}
+
+        return None, {}
+    
     def _compare_ssim(self, img1: np.ndarray, img2: np.ndarray) -> float:
-        """Compara imagens usando Structural Similarity Index (SSIM)"""
+        """Compara imagens usando Structural Similarity Index (SSIM)
+        
+        Usa o engine configurado (ssim_engine); imagens com um lado maior que
+        ssim_tile são comparadas por blocos, com o mesmo score e memória constante.
+        """
         try:
             # Garantir que as imagens tenham o mesmo tamanho
             if img1.shape != img2.shape:
-                img2 = cv2.resize(img2, (img1.shape[1], img1.shape[0]))
+                img2 = self._resize_to(img2, img1.shape)
             
             # Calcular SSIM
-            score = ssim(img1, img2)
+            if max(img1.shape[:2]) > self.ssim_tile:
+                score = tiled_ssim(img1, img2, self.fast_ssim_mode, tile=self.ssim_tile,
+                                   engine=self.ssim_engine)['score']
+            elif self.ssim_engine == 'fast':
+                score = fast_ssim(img1, img2, self.fast_ssim_mode)
+            else:
+                score = ssim(img1, img2)
             return max(0.0, min(1.0, score))  # Garantir que está entre 0 e 1
             
         except Exception as e:
             logger.error(f"Erro no cálculo SSIM: {str(e)}")
             return 0.0
     
-    def _compare_orb(self, img1: np.ndarray, img2: np.ndarray) -> float:
-        """Compara imagens usando ORB Feature Matching"""
+    def _ssim_details(self, reference: ImageFeatures, test_img: np.ndarray) -> Tuple[float, Dict[str, Any]]:
+        """SSIM na resolução de trabalho com mapa de diferenças e piores regiões
+        
+        As coordenadas das regiões e a célula do mapa estão em pixels da
+        referência carregada.
+        """
+        img1 = reference.working
         try:
-            # Inicializar detector ORB
-            orb = cv2.ORB_create(nfeatures=1000)
+            img2 = test_img if test_img.shape == img1.shape else self._resize_to(test_img, img1.shape)
+            tiled = tiled_ssim(img1, img2, self.fast_ssim_mode, tile=self.ssim_tile, engine=self.ssim_engine)
+            scale_x = reference.gray.shape[1] / img1.shape[1]
+            scale_y = reference.gray.shape[0] / img1.shape[0]
+            regions = [
+                {
+                    'x': int(region['x'] * scale_x),
+                    'y': int(region['y'] * scale_y),
+                    'width': int(round(region['width'] * scale_x)),
+                    'height': int(round(region['height'] * scale_y)),
+                    'score': region['score']
+                }
+                for region in tiled['regions']
+            ]
             
-            # Detectar keypoints e descritores
-            kp1, des1 = orb.detectAndCompute(img1, None)
-            kp2, des2 = orb.detectAndCompute(img2, None)
-            
-            if des1 is None or des2 is None:
-                return 0.0
-            
-            # Criar matcher
-            bf = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=True)
-            matches = bf.match(des1, des2)
-            
-            # Ordenar matches por distância
-            matches = sorted(matches, key=lambda x: x.distance)
+            return max(0.0, min(1.0, tiled['score'])), {
+                'ssim_heatmap': np.round(np.maximum(tiled['heatmap'], 0.0).astype(np.float64), 3).tolist(),
+                'ssim_heatmap_cell': int(round(tiled['heatmap_cell'] * scale_x)),
+                'difference_regions': regions
+            }
             
-            # Calcular score baseado no número de matches bons
-            good_matches = [m for m in matches if m.distance < 50]  # Threshold
-            score = len(good_matches) / max(len(kp1), len(kp2), 1)
+        except Exception as e:
+            logger.error(f"Erro no cálculo SSIM: {str(e)}")
+            return 0.0, {}
+    
+    def _compare_orb(self, img1: np.ndarray, img2: np.ndarray,
+                     reference: Optional[ImageFeatures] = None) -> float:
+        """Compara imagens usando ORB Feature Matching"""
+        return self._match_orb(img1, img2, reference)[0]
+    
+    def _match_orb(self, img1: np.ndarray, img2: np.ndarray,
+                   reference: Optional[ImageFeatures] = None) -> Tuple[float, Dict[str, Any]]:
+        """ORB com detalhes do matching (matches aceitos, inliers e keypoints)"""
+        try:
+            # Detectar keypoints e descritores (da referência, quando já pré-calculados)
+            if reference is not None and reference.keypoints is not None:
+                kp1, des1 = reference.keypoints, reference.descriptors
+            else:
+                kp1, des1 = self.orb.detect(img1)
+            kp2, des2 = self.orb.detect(img2)
             
-            return min(1.0, score)
+            return self.orb.match(kp1, des1, kp2, des2)
             
         except Exception as e:
             logger.error(f"Erro no cálculo ORB: {str(e)}")
-            return 0.0
+            return 0.0, {}
     
     def _compare_template(self, img1: np.ndarray, img2: np.ndarray) -> float:
         """Compara imagens usando Template Matching"""
@@ -126,96 +2085,1269 @@ class ImageComparator:
             logger.error(f"Erro no cálculo Template Matching: {str(e)}")
             return 0.0
     
-    def compare_images(self, reference_path: str, test_path: str, method: str = 'ssim') -> Dict[str, Any]:
-        """Compara duas imagens e retorna o resultado"""
+    def _compare_color(self, img1: np.ndarray, img2: np.ndarray) -> float:
+        """Compara as cores (ΔE em Lab) de duas imagens BGR em miniatura
+        
+        Em imagens em tons de cinza só a luminância conta; as comparações de
+        compare_images usam a miniatura Lab pré-calculada da referência.
+        """
         try:
-            logger.info(f"Iniciando comparação de imagens usando método: {method}")
+            reference_lab = lab_thumbnail(img1)
+            test_lab = lab_thumbnail(img2, (reference_lab.shape[1], reference_lab.shape[0]))
+            return color_delta_e(reference_lab, test_lab)['score']
+            
+        except Exception as e:
+            logger.error(f"Erro no cálculo de diferença de cor: {str(e)}")
+            return 0.0
+    
+    def _color_details(self, reference: ImageFeatures, test_color: np.ndarray,
+                       box: Optional[Tuple[int, int, int, int]] = None) -> Tuple[float, Dict[str, Any]]:
+        """Score de cor e piores células, com caixas em pixels da referência
+        
+        box (esquerda, topo, direita, base) restringe a comparação a uma parte
+        das miniaturas, em pixels da miniatura.
+        """
+        reference_lab = reference.color
+        if box is not None:
+            left, top, right, bottom = box
+            reference_lab = reference_lab[top:bottom, left:right]
+            test_color = test_color[top:bottom, left:right]
+        else:
+            left = top = 0
+        
+        delta = color_delta_e(reference_lab, test_color)
+        scale_x = reference.gray.shape[1] / reference.color.shape[1]
+        scale_y = reference.gray.shape[0] / reference.color.shape[0]
+        regions = [
+            {
+                'x': int((left + region['x']) * scale_x),
+                'y': int((top + region['y']) * scale_y),
+                'width': int(round(region['width'] * scale_x)),
+                'height': int(round(region['height'] * scale_y)),
+                'delta_e': region['delta_e']
+            }
+            for region in delta['regions']
+        ]
+        return delta['score'], {'delta_e_mean': delta['delta_e_mean'], 'delta_e_max': delta['delta_e_max'],
+                                'color_regions': regions}
+    
+    @staticmethod
+    def _needs_color(method: str, reference: ImageFeatures) -> bool:
+        """O método (ou alguma região de interesse) compara cores"""
+        return method in ('color', 'all') or any(roi.get('method') == 'color' for roi in reference.rois or [])
+    
+    @staticmethod
+    def _resize_to(image: np.ndarray, shape: Tuple[int, ...]) -> np.ndarray:
+        """Redimensiona para o tamanho de outra imagem (área ao reduzir, linear ao ampliar)"""
+        height, width = shape[:2]
+        shrinking = image.shape[0] * image.shape[1] > height * width
+        interpolation = cv2.INTER_AREA if shrinking else cv2.INTER_LINEAR
+        return cv2.resize(image, (width, height), interpolation=interpolation)
+    
+    def _matching_pyramid(self, reference: ImageFeatures, test_img: np.ndarray) -> List[np.ndarray]:
+        """Pirâmide da imagem de teste com os mesmos tamanhos e filtros da referência
+        
+        Os níveis precisam ser gerados pelo mesmo caminho (pyrDown) nas duas
+        imagens; reduzir a foto direto por área gera um SSIM bem mais baixo.
+        """
+        test = test_img
+        if test.shape != reference.working.shape:
+            test = self._resize_to(test, reference.working.shape)
+        
+        test_pyramid = [test]
+        for _ in reference.pyramid[1:]:
+            test_pyramid.append(cv2.pyrDown(test_pyramid[-1]))
+        return test_pyramid
+    
+    def _compare_ssim_pyramid(self, reference: ImageFeatures, test_img: np.ndarray,
+                              threshold: float) -> Tuple[float, Dict[str, Any]]:
+        """SSIM no nível mais grosseiro da pirâmide e, se não reprovar, no nível 0
+        
+        Nos níveis grosseiros o SSIM é enviesado para cima (desfoque e detalhes
+        finos somem na redução), então eles só podem reprovar: o nível mais
+        grosseiro reprova quando o score fica abaixo do limite por mais que
+        ssim_margin. Os níveis intermediários não são calculados: custam até
+        um terço do nível 0 e quase nunca reprovam o que o mais grosseiro
+        deixou passar, o que tornava a aprovação mais lenta que o SSIM direto.
+        Uma aprovação é sempre confirmada na resolução de trabalho (nível 0), e
+        o score retornado é o do nível que decidiu, com o mapa de diferenças
+        quando a decisão é do nível 0.
+        """
+        test_pyramid = self._matching_pyramid(reference, test_img)
+        
+        level = len(reference.pyramid) - 1
+        score = self._compare_ssim(reference.pyramid[level], test_pyramid[level])
+        level_scores = {level: round(float(score), 4)}
+        details = {}
+        if score >= threshold - self.ssim_margin:
+            level = 0
+            score, details = self._ssim_details(reference, test_pyramid[0])
+            level_scores[level] = round(float(score), 4)
+        
+        return score, {'ssim_level': level, 'ssim_level_scores': level_scores, **details}
+    
+    def _run_method(self, method: str, reference: ImageFeatures, test_img: np.ndarray,
+                    threshold: Optional[float] = None,
+                    test_color: Optional[np.ndarray] = None) -> Tuple[float, Dict[str, Any]]:
+        """Executa um método de comparação aproveitando as features pré-calculadas
+        
+        Retorna o score e detalhes adicionais específicos do método. test_color
+        é a miniatura Lab da foto, exigida pelo método color.
+        """
+        if reference.rois:
+            return self._compare_rois(method, reference, test_img, test_color)
+        if method == 'color':
+            if test_color is None:
+                raise ValueError("O método color requer a miniatura Lab da referência e da foto")
+            return self._color_details(reference, test_color)
+        if method == 'orb':
+            return self._match_orb(reference.working, test_img, reference=reference)
+        if method == 'ssim':
+            # Com limite - margem <= 0 nenhum score grosseiro reprova: vai direto ao nível 0
+            if threshold is not None and threshold - self.ssim_margin > 0 and len(reference.pyramid) > 1:
+                return self._compare_ssim_pyramid(reference, test_img, threshold)
+            return self._ssim_details(reference, test_img)
+        return self.methods[method](reference.working, test_img), {}
+    
+    def _compare_rois(self, method: str, reference: ImageFeatures, test_img: np.ndarray,
+                      test_color: Optional[np.ndarray] = None) -> Tuple[float, Dict[str, Any]]:
+        """Score ponderado das regiões de interesse da referência
+        
+        Cada região é comparada em sub-arrays recortados das duas imagens (sem
+        máscara sobre a imagem inteira), com o método da região ou o da
+        comparação. As caixas retornadas estão em pixels da referência.
+        """
+        ref = reference.working
+        height, width = ref.shape[:2]
+        test = test_img if test_img.shape == ref.shape else self._resize_to(test_img, ref.shape)
+        scale_x = reference.gray.shape[1] / width
+        scale_y = reference.gray.shape[0] / height
+        
+        regions = []
+        weighted = weights = 0.0
+        pixels = 0
+        for roi in reference.rois:
+            region_method = roi.get('method', method)
+            if region_method not in self.methods:
+                raise ValueError(f"Método '{region_method}' da região '{roi['name']}' não suportado")
+            
+            left, right = self._roi_span(roi['x'], roi['width'], width)
+            top, bottom = self._roi_span(roi['y'], roi['height'], height)
+            if region_method == 'color':
+                if test_color is None:
+                    raise ValueError(f"A região '{roi['name']}' usa o método color sem a miniatura Lab")
+                thumb_height, thumb_width = reference.color.shape[:2]
+                box = (int(roi['x'] * thumb_width), int(roi['y'] * thumb_height),
+                       max(int(roi['x'] * thumb_width) + 1, int(round((roi['x'] + roi['width']) * thumb_width))),
+                       max(int(roi['y'] * thumb_height) + 1, int(round((roi['y'] + roi['height']) * thumb_height))))
+                score = self._color_details(reference, test_color, box)[0]
+            else:
+                score = float(self.methods[region_method](ref[top:bottom, left:right],
+                                                          test[top:bottom, left:right]))
+            
+            weighted += roi['weight'] * score
+            weights += roi['weight']
+            pixels += (bottom - top) * (right - left)
+            regions.append({
+                'name': roi['name'],
+                'method': region_method,
+                'weight': roi['weight'],
+                'score': round(score, 4),
+                'box': {
+                    'x': int(left * scale_x),
+                    'y': int(top * scale_y),
+                    'width': int(round((right - left) * scale_x)),
+                    'height': int(round((bottom - top) * scale_y))
+                }
+            })
+        
+        return weighted / weights, {'regions': regions, 'roi_coverage': round(pixels / (width * height), 4)}
+    
+    @staticmethod
+    def _roi_span(start: float, size: float, length: int) -> Tuple[int, int]:
+        """Intervalo em pixels de uma região, com pelo menos MIN_ROI_SIDE pixels"""
+        first = int(round(start * length))
+        last = int(round((start + size) * length))
+        missing = min(MIN_ROI_SIDE, length) - (last - first)
+        if missing > 0:
+            first -= missing // 2
+            last += missing - missing // 2
+            shift = max(0, -first) - max(0, last - length)
+            first, last = first + shift, last + shift
+        return max(0, first), min(length, last)
+    
+    def _build_result(self, method: str, score: float, reference_path: ImageSource, test_path: ImageSource,
+                      error: Optional[str] = None, details: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """Monta o dicionário de resultado de uma comparação"""
+        score = float(score)
+        result = {
+            'method': method,
+            'score': round(score, 4),
+            'score_percentage': round(score * 100, 2),
+            'reference_image': describe_source(reference_path),
+            'test_image': describe_source(test_path),
+            'success': error is None,
+            'error': error
+        }
+        if details:
+            result.update(details)
+        return result
+    
+    def _error_result(self, method: str, reference_path: ImageSource, test_path: ImageSource,
+                      error: Exception) -> Dict[str, Any]:
+        """Resultado de erro; recusas (qualidade, tamanho da entrada) levam error_code e os detalhes"""
+        details = None
+        if isinstance(error, (QualityRejected, InputTooLarge)):
+            details = {'error_code': error.error_code, **error.details}
+        return self._build_result(method, 0.0, reference_path, test_path, error=str(error), details=details)
+    
+    def _instrumenting(self, instrument: Optional[bool]) -> bool:
+        return self.instrument if instrument is None else instrument
+    
+    def _compare_with_reference(self, reference: ImageFeatures, reference_path: ImageSource,
+                                test_path: ImageSource, method: str,
+                                threshold: Optional[float] = None,
+                                timer: Optional[StageTimer] = None,
+                                test_data: Optional[bytes] = None,
+                                session: Optional[Tuple[str, str, str]] = None) -> Dict[str, Any]:
+        """Compara uma imagem de teste com uma referência já preparada
+        
+        test_data, quando informado, é o conteúdo já lido de test_path.
+        session é (session_id, escopo, photo_id) para a deduplicação por sessão.
+        """
+        timer = timer or StageTimer(enabled=False)
+        try:
+            test_img, test_color, test_details = self._load_test_for(
+                test_path if test_data is None else test_data, reference, timer,
+                color=self._needs_color(method, reference)
+            )
             
-            # Carregar imagens
-            reference_img = self.load_image(reference_path)
-            test_img = self.load_image(test_path)
+            if session is not None:
+                # Hashes da foto já recortada e na resolução de trabalho
+                session_id, scope, photo_id = session
+                with timer.stage('session_dedup'):
+                    hashes = perceptual_hash(test_img), difference_hash(test_img)
+                    duplicate = self.session_dedup.lookup(session_id, scope, *hashes)
+                if duplicate is not None:
+                    logger.info(f"Foto quase idêntica a {duplicate['photo_id']} na sessão {session_id}; "
+                                f"score reaproveitado: {duplicate['result']['score']:.4f}")
+                    result = duplicate['result']
+                    result.update(reference_image=describe_source(reference_path),
+                                  test_image=describe_source(test_path), photo_id=photo_id,
+                                  duplicate_of=duplicate['photo_id'], duplicate_distance=duplicate['distance'])
+                    return timer.attach(result)
+            
+            with timer.stage(method):
+                score, details = self._run_method(method, reference, test_img, threshold, test_color)
+            details = {**details, **test_details}
+            
+            logger.info(f"Comparação concluída. Score: {score:.4f} ({score*100:.2f}%)")
+            result = self._build_result(method, score, reference_path, test_path, details=details)
+            if session is not None:
+                result['photo_id'] = photo_id
+                self.session_dedup.add(session_id, scope, photo_id, *hashes, dict(result))
+            
+        except Exception as e:
+            logger.error(f"Erro na comparação de imagens: {str(e)}")
+            result = self._error_result(method, reference_path, test_path, e)
+        
+        return timer.attach(result)
+    
+    @profiled
+    def compare_images(self, reference_path: ImageSource, test_path: ImageSource, method: str = 'ssim',
+                       threshold: Optional[float] = None, instrument: Optional[bool] = None,
+                       rois: Optional[List[Dict[str, Any]]] = None, session_id: Optional[str] = None,
+                       photo_id: Optional[str] = None) -> Dict[str, Any]:
+        """Compara duas imagens e retorna o resultado
+        
+        Com threshold (o limite_aprovacao da pergunta), o SSIM é calculado
+        antes no nível mais grosseiro da pirâmide, que reprova quando o score
+        fica abaixo do limite por mais que ssim_margin; aprovações são sempre
+        confirmadas na resolução de trabalho. Com instrument, o
+        resultado traz tempos por estágio, dimensões e bytes decodificados.
+        Com result_cache, imagens idênticas a uma comparação anterior (mesmo
+        conteúdo, método e parâmetros) devolvem o resultado salvo, com cached.
+        rois substitui as regiões de interesse associadas à referência; com
+        regiões, o score é a média ponderada dos scores de cada uma.
+        Com session_id e session_dedup, uma foto quase idêntica a outra já
+        pontuada na mesma sessão devolve o score dela, com duplicate_of (o
+        photo_id da foto original; por padrão, o hash do conteúdo).
+        """
+        rois = normalize_rois(rois) if rois else rois
+        timer = StageTimer(enabled=self._instrumenting(instrument))
+        reference_data = test_data = cache_key = session = None
+        try:
+            logger.info(f"Iniciando comparação de imagens usando método: {method}")
             
             # Verificar se o método existe
             if method not in self.methods:
                 raise ValueError(f"Método de comparação '{method}' não suportado")
             
-            # Executar comparação
-            score = self.methods[method](reference_img, test_img)
+            deduplicating = session_id is not None and self.session_dedup is not None
+            if self.result_cache is not None or deduplicating:
+                # As imagens são lidas uma única vez: os bytes servem às chaves e à comparação
+                reference_data = self._read_source(reference_path)
+                test_data = self._read_source(test_path)
+                # O orçamento de pixels vale também para resultados já salvos
+                self._budget_reduction(reference_data, reference_path)
+                self._budget_reduction(test_data, test_path)
+                scope = self._comparison_scope(reference_data, method, threshold, rois)
+                if deduplicating:
+                    session = (str(session_id), scope, str(photo_id or content_hash(test_data)[:16]))
             
-            # Preparar resultado
-            result = {
-                'method': method,
-                'score': round(score, 4),
-                'score_percentage': round(score * 100, 2),
-                'reference_image': reference_path,
-                'test_image': test_path,
-                'success': True,
-                'error': None
-            }
+            if self.result_cache is not None:
+                with timer.stage('result_cache'):
+                    cache_key = self._result_key(scope, test_data)
+                    cached = self.result_cache.get(cache_key)
+                
+                if cached is not None:
+                    logger.info(f"Resultado reaproveitado do cache. Score: {cached['score']:.4f}")
+                    cached.update(reference_image=describe_source(reference_path),
+                                  test_image=describe_source(test_path), cached=True)
+                    return timer.attach(cached)
             
-            logger.info(f"Comparação concluída. Score: {score:.4f} ({score*100:.2f}%)")
-            return result
+            # Carregar referência (vem do cache de features, se configurado)
+            reference = self.prepare_reference(reference_path if reference_data is None else reference_data,
+                                               timer)
+            if rois is not None:
+                reference = reference.with_rois(rois)
             
         except Exception as e:
             logger.error(f"Erro na comparação de imagens: {str(e)}")
-            return {
-                'method': method,
-                'score': 0.0,
-                'score_percentage': 0.0,
-                'reference_image': reference_path,
-                'test_image': test_path,
-                'success': False,
-                'error': str(e)
-            }
+            return timer.attach(self._error_result(method, reference_path, test_path, e))
+        
+        result = self._compare_with_reference(reference, reference_path, test_path, method, threshold, timer,
+                                              test_data=test_data, session=session)
+        if cache_key is not None and result['success'] and 'duplicate_of' not in result:
+            self.result_cache.put(cache_key, {
+                key: value for key, value in result.items() if key not in ('instrumentation', 'photo_id')
+            })
+        return result
+    
+    @profiled
+    def compare_batch(self, reference_path: ImageSource, test_paths: List[ImageSource], method: str = 'ssim',
+                      max_workers: Optional[int] = None, threshold: Optional[float] = None,
+                      instrument: Optional[bool] = None,
+                      rois: Optional[List[Dict[str, Any]]] = None) -> Dict[str, Any]:
+        """Compara várias fotos com a mesma referência, carregando-a uma única vez
+        
+        As fotos são processadas em paralelo por threads (o OpenCV libera o GIL).
+        Retorna um resultado por foto, na ordem recebida, e o melhor resultado.
+        """
+        logger.info(f"Iniciando comparação em lote de {len(test_paths)} imagem(ns) usando método: {method}")
+        instrumenting = self._instrumenting(instrument)
+        timer = StageTimer(enabled=instrumenting)
+        
+        try:
+            if method not in self.methods:
+                raise ValueError(f"Método de comparação '{method}' não suportado")
+            
+            reference = self.prepare_reference(reference_path, timer)
+            if rois is not None:
+                reference = reference.with_rois(normalize_rois(rois))
+            
+            workers = max_workers or min(len(test_paths), os.cpu_count() or 1) or 1
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(
+                    lambda test_path: self._compare_with_reference(reference, reference_path, test_path,
+                                                                   method, threshold,
+                                                                   StageTimer(enabled=instrumenting)),
+                    test_paths
+                ))
+            error = None
+            
+        except Exception as e:
+            logger.error(f"Erro na comparação em lote: {str(e)}")
+            error = str(e)
+            results = [self._build_result(method, 0.0, reference_path, test_path, error=error)
+                       for test_path in test_paths]
+        
+        return timer.attach(self._batch_summary(method, reference_path, results, error))
+    
+    def _batch_summary(self, method: str, reference_path: ImageSource, results: List[Dict[str, Any]],
+                       error: Optional[str] = None) -> Dict[str, Any]:
+        """Resultado de um lote: os resultados por foto e o melhor entre eles"""
+        successful = [index for index, result in enumerate(results) if result['success']]
+        best_index = max(successful, key=lambda i: results[i]['score']) if successful else None
+        best_result = results[best_index] if best_index is not None else None
+        
+        return {
+            'method': method,
+            'reference_image': describe_source(reference_path),
+            'results': results,
+            'best_index': best_index,
+            'best_test_image': best_result['test_image'] if best_result else None,
+            'best_score': best_result['score'] if best_result else 0.0,
+            'best_score_percentage': best_result['score_percentage'] if best_result else 0.0,
+            'success': best_result is not None,
+            'error': error if error or best_result else 'Nenhuma imagem de teste pôde ser comparada'
+        }
+    
+    def _async_semaphore(self, loop: asyncio.AbstractEventLoop) -> asyncio.Semaphore:
+        with self._async_lock:
+            semaphore = self._async_semaphores.get(loop)
+            if semaphore is None:
+                semaphore = self._async_semaphores[loop] = asyncio.Semaphore(self.max_concurrency)
+            return semaphore
     
-    def compare_multiple_methods(self, reference_path: str, test_path: str) -> Dict[str, Any]:
-        """Compara imagens usando múltiplos métodos e retorna o melhor resultado"""
+    async def _run_async(self, func, timeout: Optional[float] = None):
+        """Executa func no executor respeitando o limite de concorrência
+        
+        Em caso de timeout ou cancelamento, o trabalho que ainda não começou é
+        cancelado; o que já está rodando não pode ser interrompido, então a vaga
+        só é devolvida quando ele termina, para que o limite continue valendo.
+        """
+        loop = asyncio.get_running_loop()
+        semaphore = self._async_semaphore(loop)
+        await semaphore.acquire()
+        
+        if self.executor is None:
+            with self._async_lock:
+                if self.executor is None:
+                    self.executor = ThreadPoolExecutor(max_workers=self.max_concurrency,
+                                                       thread_name_prefix='image-comparator')
+        try:
+            future = self.executor.submit(func)
+        except BaseException:
+            semaphore.release()
+            raise
+        
+        def release(_) -> None:
+            try:
+                loop.call_soon_threadsafe(semaphore.release)
+            except RuntimeError:
+                pass  # event loop já encerrado
+        
+        future.add_done_callback(release)
+        return await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+    
+    def _timed_out_result(self, method: str, reference_path: ImageSource, test_path: ImageSource,
+                          timeout: float) -> Dict[str, Any]:
+        result = self._build_result(method, 0.0, reference_path, test_path,
+                                    error=f'Tempo limite de {timeout}s excedido')
+        result['timed_out'] = True
+        return result
+    
+    async def compare_async(self, reference_path: ImageSource, test_path: ImageSource, method: str = 'ssim',
+                            threshold: Optional[float] = None, timeout: Optional[float] = None,
+                            instrument: Optional[bool] = None, rois: Optional[List[Dict[str, Any]]] = None,
+                            session_id: Optional[str] = None, photo_id: Optional[str] = None) -> Dict[str, Any]:
+        """Versão assíncrona de compare_images, sem bloquear o event loop
+        
+        Com timeout (segundos), uma comparação que não termina a tempo retorna
+        um resultado com erro e 'timed_out': True. O cancelamento da tarefa
+        se propaga como asyncio.CancelledError.
+        """
+        try:
+            return await self._run_async(
+                functools.partial(self.compare_images, reference_path, test_path, method,
+                                  threshold=threshold, instrument=instrument, rois=rois,
+                                  session_id=session_id, photo_id=photo_id),
+                timeout
+            )
+        except asyncio.TimeoutError:
+            logger.error(f"Comparação excedeu o tempo limite de {timeout}s")
+            return self._timed_out_result(method, reference_path, test_path, timeout)
+    
+    async def compare_batch_async(self, reference_path: ImageSource, test_paths: List[ImageSource],
+                                  method: str = 'ssim', threshold: Optional[float] = None,
+                                  timeout: Optional[float] = None, instrument: Optional[bool] = None,
+                                  rois: Optional[List[Dict[str, Any]]] = None) -> Dict[str, Any]:
+        """Versão assíncrona de compare_batch
+        
+        A referência é preparada uma vez; cada foto é uma tarefa separada no
+        limite de concorrência, então lotes de inspeções diferentes se
+        intercalam em vez de esperar um lote inteiro terminar. O timeout vale
+        para cada foto.
+        """
+        logger.info(f"Iniciando comparação assíncrona em lote de {len(test_paths)} imagem(ns) "
+                    f"usando método: {method}")
+        instrumenting = self._instrumenting(instrument)
+        timer = StageTimer(enabled=instrumenting)
+        
+        try:
+            if method not in self.methods:
+                raise ValueError(f"Método de comparação '{method}' não suportado")
+            reference = await self._run_async(functools.partial(self.prepare_reference, reference_path, timer),
+                                              timeout)
+            if rois is not None:
+                reference = reference.with_rois(normalize_rois(rois))
+        except Exception as e:
+            error = f'Tempo limite de {timeout}s excedido' if isinstance(e, asyncio.TimeoutError) else str(e)
+            logger.error(f"Erro na comparação em lote: {error}")
+            results = [self._build_result(method, 0.0, reference_path, test_path, error=error)
+                       for test_path in test_paths]
+            return timer.attach(self._batch_summary(method, reference_path, results, error))
+        
+        async def compare(test_path: ImageSource) -> Dict[str, Any]:
+            try:
+                return await self._run_async(
+                    functools.partial(self._compare_with_reference, reference, reference_path, test_path,
+                                      method, threshold, StageTimer(enabled=instrumenting)),
+                    timeout
+                )
+            except asyncio.TimeoutError:
+                return self._timed_out_result(method, reference_path, test_path, timeout)
+        
+        results = list(await asyncio.gather(*(compare(test_path) for test_path in test_paths)))
+        return timer.attach(self._batch_summary(method, reference_path, results))
+    
+    @profiled
+    def compare_cascade(self, reference_path: ImageSource, test_path: ImageSource, threshold: float,
+                        final_method: str = 'ssim',
+                        cutoffs: Optional[Dict[str, Tuple[Optional[float], Optional[float]]]] = None,
+                        instrument: Optional[bool] = None,
+                        rois: Optional[List[Dict[str, Any]]] = None) -> Dict[str, Any]:
+        """Compara em cascata, do estágio mais barato ao mais caro, até o veredito
+        
+        Estágios: distância de pHash, SSIM em baixa resolução e, por fim, o método
+        completo (final_method). Os estágios iniciais têm cortes próprios, na sua
+        escala (DEFAULT_CASCADE_CUTOFFS, sobrescritos por cutoffs), e só encerram
+        a cascata em casos claros; nos demais o veredito e o score são os do
+        método final. Uma reprovação antecipada tem score 0.0 e uma aprovação 1.0.
+        rois substitui, só nesta chamada, as regiões associadas à referência.
+        """
+        cutoffs = {**DEFAULT_CASCADE_CUTOFFS.get(final_method, {}), **(cutoffs or {})}
+        timer = StageTimer(enabled=self._instrumenting(instrument))
+        stages = []
+        
+        try:
+            logger.info(f"Iniciando comparação em cascata (limite {threshold}, método final {final_method})")
+            
+            if final_method not in self.methods:
+                raise ValueError(f"Método de comparação '{final_method}' não suportado")
+            
+            load_started = time.perf_counter()
+            reference = self.prepare_reference(reference_path, timer)
+            if rois is not None:
+                reference = reference.with_rois(normalize_rois(rois))
+            test_img, test_color, test_details = self._load_test_for(
+                test_path, reference, timer, color=self._needs_color(final_method, reference)
+            )
+            load_ms = round((time.perf_counter() - load_started) * 1000, 2)
+            
+            def phash_stage() -> Tuple[Dict[str, Any], Optional[bool]]:
+                reference_hash = reference.phash if reference.phash is not None else perceptual_hash(reference.working)
+                distance = hamming_distance(reference_hash, perceptual_hash(test_img))
+                reject, accept = cutoffs['phash']
+                if reject is not None and distance >= reject:
+                    return {'distance': distance}, False
+                return {'distance': distance}, True if accept is not None and distance <= accept else None
+            
+            def coarse_ssim_stage() -> Tuple[Dict[str, Any], Optional[bool]]:
+                test_pyramid = self._matching_pyramid(reference, test_img)
+                score = float(self._compare_ssim(reference.pyramid[-1], test_pyramid[-1]))
+                reject, accept = cutoffs['ssim_coarse']
+                if reject is not None and score < reject:
+                    return {'score': round(score, 4)}, False
+                return {'score': round(score, 4)}, True if accept is not None and score >= accept else None
+            
+            cascade = [(stage, run_stage) for stage, run_stage in
+                       (('phash', phash_stage), ('ssim_coarse', coarse_ssim_stage)) if stage in cutoffs]
+            
+            verdict = None
+            for stage, run_stage in cascade:
+                stage_started = time.perf_counter()
+                with timer.stage(stage):
+                    value, verdict = run_stage()
+                stages.append({
+                    'stage': stage,
+                    **value,
+                    'elapsed_ms': round((time.perf_counter() - stage_started) * 1000, 2),
+                    'decided': verdict is not None
+                })
+                if verdict is not None:
+                    break
+            
+            if verdict is None:
+                stage = final_method
+                stage_started = time.perf_counter()
+                with timer.stage(stage):
+                    score = float(self._run_method(final_method, reference, test_img, test_color=test_color)[0])
+                stages.append({
+                    'stage': stage,
+                    'score': round(score, 4),
+                    'elapsed_ms': round((time.perf_counter() - stage_started) * 1000, 2),
+                    'decided': True
+                })
+                approved = score >= threshold
+            else:
+                score = 1.0 if verdict else 0.0
+                approved = verdict
+            
+            logger.info(f"Cascata decidida no estágio {stage}. Score: {score:.4f} ({score*100:.2f}%)")
+            
+            result = self._build_result('cascade', score, reference_path, test_path, details=test_details)
+            error = None
+            
+        except Exception as e:
+            logger.error(f"Erro na comparação em cascata: {str(e)}")
+            result = self._error_result('cascade', reference_path, test_path, e)
+            approved, stage, load_ms = False, None, None
+        
+        result.update({
+            'threshold': threshold,
+            'approved': approved,
+            'verdict': 'APROVADO' if approved else 'REPROVADO',
+            'decided_by': stage,
+            'stages': stages,
+            'stage_timings': {'load': load_ms, **{item['stage']: item['elapsed_ms'] for item in stages}}
+        })
+        return timer.attach(result)
+    
+    def open_stream(self, reference_path: ImageSource, method: str = 'ssim', threshold: Optional[float] = None,
+                    rois: Optional[List[Dict[str, Any]]] = None, max_frames: int = STREAM_MAX_FRAMES,
+                    max_seconds: Optional[float] = STREAM_MAX_SECONDS) -> 'FrameStream':
+        """Inicia um fluxo de quadros (FrameStream) comparado pelo melhor quadro"""
+        return FrameStream(self, reference_path, method, threshold=threshold,
+                           rois=normalize_rois(rois) if rois else rois,
+                           max_frames=max_frames, max_seconds=max_seconds)
+    
+    @profiled
+    def compare_multiple_methods(self, reference_path: ImageSource, test_path: ImageSource,
+                                 deadline: Optional[float] = None, threshold: Optional[float] = None,
+                                 instrument: Optional[bool] = None,
+                                 rois: Optional[List[Dict[str, Any]]] = None) -> Dict[str, Any]:
+        """Compara imagens usando múltiplos métodos e retorna o melhor resultado
+        
+        As imagens são decodificadas uma única vez e os métodos rodam em paralelo.
+        Com deadline (segundos), retorna o melhor resultado concluído dentro do prazo;
+        os métodos que não terminaram a tempo aparecem com 'timed_out': True.
+        O melhor score é o do melhor método estrutural (ssim, orb, template),
+        limitado pelo score de cor: uma etiqueta com a cor errada reprova mesmo
+        que a estrutura seja idêntica, e então best_method é 'color'.
+        rois substitui, só nesta chamada, as regiões associadas à referência.
+        """
+        started = time.perf_counter()
+        methods = list(self.methods.keys())
+        timer = StageTimer(enabled=self._instrumenting(instrument))
         results = {}
+        test_details = {}
+        
+        try:
+            reference = self.prepare_reference(reference_path, timer)
+            if rois is not None:
+                reference = reference.with_rois(normalize_rois(rois))
+            # A miniatura Lab é decodificada uma vez e compartilhada com o método color
+            test_img, test_color, test_details = self._load_test_for(test_path, reference, timer, color=True)
+            
+        except Exception as e:
+            logger.error(f"Erro na comparação de imagens: {str(e)}")
+            for method in methods:
+                results[method] = self._error_result(method, reference_path, test_path, e)
+            test_img = None
         
-        for method in self.methods.keys():
-            result = self.compare_images(reference_path, test_path, method)
-            results[method] = result
+        if test_img is not None:
+            def run(method: str) -> Dict[str, Any]:
+                method_started = time.perf_counter()
+                try:
+                    with timer.stage(method):
+                        score, details = self._run_method(method, reference, test_img, threshold, test_color)
+                    result = self._build_result(method, score, reference_path, test_path, details=details)
+                except Exception as e:
+                    logger.error(f"Erro no método {method}: {str(e)}")
+                    result = self._build_result(method, 0.0, reference_path, test_path, error=str(e))
+                result['elapsed_ms'] = round((time.perf_counter() - method_started) * 1000, 2)
+                return result
+            
+            executor = ThreadPoolExecutor(max_workers=len(methods))
+            futures = {executor.submit(run, method): method for method in methods}
+            timeout = None if deadline is None else max(0.0, deadline - (time.perf_counter() - started))
+            done, _ = wait_futures(futures, timeout=timeout)
+            # Métodos ainda em execução terminam em segundo plano e são descartados
+            executor.shutdown(wait=False, cancel_futures=True)
+            
+            for future, method in futures.items():
+                if future in done:
+                    results[method] = future.result()
+                else:
+                    results[method] = self._build_result(method, 0.0, reference_path, test_path,
+                                                         error='Tempo limite excedido')
+                    results[method]['timed_out'] = True
+            
+            # Manter a ordem original dos métodos
+            results = {method: results[method] for method in methods}
         
-        # Encontrar o melhor score
-        best_method = max(results.keys(), key=lambda m: results[m]['score'])
+        # Encontrar o melhor score entre os métodos estruturais concluídos com sucesso
+        successful = [method for method in methods if results[method]['success']]
+        structural = [method for method in successful if method != 'color']
+        best_method = max(structural or successful or methods, key=lambda m: results[m]['score'])
+        # A cor não compete com a estrutura: ela só pode reprovar
+        if 'color' in successful and results['color']['score'] < results[best_method]['score']:
+            best_method = 'color'
         best_result = results[best_method]
         
-        return {
+        summary = {
             'best_method': best_method,
             'best_score': best_result['score'],
             'best_score_percentage': best_result['score_percentage'],
             'all_results': results,
+            'elapsed_ms': round((time.perf_counter() - started) * 1000, 2),
+            'deadline_exceeded': any(result.get('timed_out') for result in results.values()),
             'success': best_result['success'],
             'error': best_result.get('error')
         }
+        if 'error_code' in best_result:
+            summary['error_code'] = best_result['error_code']
+        summary.update(test_details)
+        return timer.attach(summary)
+
+
+class FrameStream:
+    """Rajada de quadros da câmera comparada pelo melhor quadro
+    
+    Os quadros chegam um a um por push e são pré-pontuados em baixa resolução:
+    a nitidez (variância do laplaciano) e a confiança de que a etiqueta está
+    enquadrada (inliers da homografia ORB com a referência, também reduzida).
+    Só o conteúdo do melhor quadro até o momento é mantido; finish roda a
+    comparação completa nele. O orçamento (max_frames quadros ou max_seconds
+    desde o primeiro) encerra a rajada: os quadros seguintes são ignorados.
+    Não é seguro para uso concorrente; cada fluxo pertence a um cliente.
+    """
+
+    def __init__(self, comparator: 'ImageComparator', reference_path: ImageSource, method: str = 'ssim',
+                 threshold: Optional[float] = None, rois: Optional[List[Dict[str, Any]]] = None,
+                 max_frames: int = STREAM_MAX_FRAMES, max_seconds: Optional[float] = STREAM_MAX_SECONDS):
+        if method not in comparator.methods:
+            raise ValueError(f"Método de comparação '{method}' não suportado")
+        
+        self.comparator = comparator
+        self.method = method
+        self.threshold = threshold
+        self.rois = rois
+        self.max_frames = max_frames
+        self.max_seconds = max_seconds
+        # A referência é lida uma vez e reaproveitada pela comparação final
+        self.reference_data = comparator._read_source(reference_path)
+        self.reference_name = describe_source(reference_path)
+        self.orb = OrbMatcher(nfeatures=STREAM_ORB_FEATURES)
+        
+        reference = comparator.prepare_reference(self.reference_data)
+        self._reference_sample = downscale_to(reference.working, STREAM_REFERENCE_SIDE)
+        self._reference_keypoints, self._reference_descriptors = self.orb.detect(self._reference_sample)
+        
+        self.frames = 0
+        self.started: Optional[float] = None
+        self.prescore_seconds = 0.0
+        self.best: Optional[Dict[str, Any]] = None
+        self._best_data: Optional[bytes] = None
+    
+    @property
+    def done(self) -> bool:
+        """Orçamento de quadros ou de tempo esgotado"""
+        if self.frames >= self.max_frames:
+            return True
+        return (self.started is not None and self.max_seconds is not None
+                and time.perf_counter() - self.started >= self.max_seconds)
+    
+    def push(self, frame: ImageSource) -> Dict[str, Any]:
+        """Pré-pontua um quadro e retorna o relatório dele e o melhor quadro até agora"""
+        if self.done:
+            return {'frame': None, 'skipped': True, 'best': self.best, 'done': True}
+        
+        started = time.perf_counter()
+        if self.started is None:
+            self.started = started
+        
+        data = self.comparator._read_source(frame)
+        sample = self._sample(data, frame)
+        sharpness = float(cv2.Laplacian(sample, cv2.CV_32F).var())
+        confidence, inliers = self._confidence(sample)
+        report = {
+            'frame': self.frames,
+            'sharpness': round(sharpness, 2),
+            'confidence': round(confidence, 3),
+            'inliers': inliers,
+            # A nitidez decide entre quadros com a etiqueta igualmente enquadrada
+            'score': round(sharpness * (0.25 + 0.75 * confidence), 2)
+        }
+        self.frames += 1
+        if self.best is None or report['score'] > self.best['score']:
+            self.best, self._best_data = report, data
+        
+        elapsed = time.perf_counter() - started
+        self.prescore_seconds += elapsed
+        report['elapsed_ms'] = round(elapsed * 1000, 2)
+        return {'frame': report, 'skipped': False, 'best': self.best, 'done': self.done}
+    
+    def finish(self, instrument: Optional[bool] = None, session_id: Optional[str] = None,
+               photo_id: Optional[str] = None) -> Dict[str, Any]:
+        """Compara o melhor quadro com a referência (compare_images) e descreve a rajada"""
+        if self._best_data is None:
+            raise ValueError("Nenhum quadro recebido no fluxo")
+        
+        logger.info(f"Fluxo encerrado com {self.frames} quadros; comparando o quadro {self.best['frame']}")
+        result = self.comparator.compare_images(self.reference_data, self._best_data, self.method,
+                                                threshold=self.threshold, instrument=instrument, rois=self.rois,
+                                                session_id=session_id, photo_id=photo_id)
+        result.update(reference_image=self.reference_name, test_image=f"<quadro {self.best['frame']}>")
+        result['stream'] = self.stats()
+        return result
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'frames': self.frames,
+            'best_frame': self.best,
+            'prescore_ms': round(self.prescore_seconds * 1000, 2),
+            'prescore_fps': round(self.frames / self.prescore_seconds, 1) if self.prescore_seconds else None
+        }
+    
+    def _sample(self, data: bytes, frame: ImageSource) -> np.ndarray:
+        """Quadro em cinza com maior lado até STREAM_SAMPLE_SIDE
+        
+        JPEGs são decodificados já reduzidos pelo maior fator que ainda entrega
+        o tamanho da amostra; respeita o orçamento de pixels do comparador.
+        """
+        factor = self.comparator._budget_reduction(data, frame)
+        info = image_header_info(data)
+        if info is not None and info[0] == 'jpeg':
+            for candidate in sorted(REDUCED_GRAYSCALE_FLAGS, reverse=True):
+                if max(info[1:]) // candidate >= STREAM_SAMPLE_SIDE:
+                    factor = max(factor, candidate)
+                    break
+        
+        buffer = np.frombuffer(data, dtype=np.uint8)
+        gray = cv2.imdecode(buffer, REDUCED_GRAYSCALE_FLAGS[factor] if factor > 1 else cv2.IMREAD_GRAYSCALE)
+        if gray is None:
+            raise ValueError(f"Não foi possível carregar a imagem: {describe_source(frame)}")
+        if factor == 1:
+            self.comparator._check_decoded_pixels(gray, frame)
+        return downscale_to(gray, STREAM_SAMPLE_SIDE)
+    
+    def _confidence(self, sample: np.ndarray) -> Tuple[float, int]:
+        """Confiança (0 a 1) de que a etiqueta está no quadro e o número de inliers"""
+        keypoints, descriptors = self.orb.detect(sample)
+        good = self.orb.good_matches(self._reference_descriptors, descriptors)
+        homography, inliers = self.orb.homography(self._reference_keypoints, keypoints, good)
+        if homography is None:
+            return 0.0, 0
+        
+        height, width = self._reference_sample.shape[:2]
+        corners = cv2.perspectiveTransform(
+            np.float32([[0, 0], [width, 0], [width, height], [0, height]]).reshape(-1, 1, 2),
+            np.linalg.inv(homography)
+        )
+        if not ImageComparator._plausible_quad(corners, sample.shape):
+            return 0.0, inliers
+        return min(1.0, inliers / STREAM_CONFIDENT_INLIERS), inliers
+
+
+class ReferenceIndex:
+    """Índice das imagens de referência para encontrar a etiqueta de uma foto
+
+    Cada referência é representada pelo seu pHash e por um saco de palavras
+    visuais ORB: as palavras são obtidas por LSH (bits fixos dos descritores
+    binários), sem vocabulário treinado, e ficam em um arquivo invertido
+    ponderado por TF-IDF. O índice é atualizado incrementalmente (add/remove)
+    e, com path, persistido em um arquivo .npz compartilhado entre processos:
+    alterações são feitas sob trava de arquivo e os outros processos recarregam
+    o índice quando o arquivo muda.
+    """
+
+    def __init__(self, comparator: Optional['ImageComparator'] = None, path: Optional[str] = None):
+        self.comparator = comparator or ImageComparator()
+        self.path = Path(path) if path else None
+        self.signature = f"{self.comparator._feature_signature()}-lsh{INDEX_LSH_TABLES}x{INDEX_LSH_BITS}"
+
+        rng = np.random.default_rng(INDEX_LSH_SEED)
+        self._bit_positions = np.stack([
+            rng.choice(256, size=INDEX_LSH_BITS, replace=False) for _ in range(INDEX_LSH_TABLES)
+        ])
+        self._bit_weights = (1 << np.arange(INDEX_LSH_BITS)).astype(np.int64)
+
+        self._ids: List[str] = []
+        self._phashes: List[np.ndarray] = []
+        self._words: List[np.ndarray] = []
+        self._postings: Optional[Dict[str, np.ndarray]] = None
+        self._loaded_mtime: Optional[int] = None
+        self._lock = threading.Lock()
+
+        if self.path and self.path.exists():
+            self._load()
+
+    def __len__(self) -> int:
+        with self._lock:
+            self._sync()
+            return len(self._ids)
+
+    def visual_words(self, descriptors: Optional[np.ndarray]) -> np.ndarray:
+        """Palavras visuais (únicas) de um conjunto de descritores ORB"""
+        if descriptors is None or not len(descriptors):
+            return np.empty(0, dtype=np.int64)
+
+        bits = np.unpackbits(descriptors, axis=1)
+        words = [
+            bits[:, positions].astype(np.int64) @ self._bit_weights + table * (1 << INDEX_LSH_BITS)
+            for table, positions in enumerate(self._bit_positions)
+        ]
+        return np.unique(np.concatenate(words))
+
+    def add(self, reference_id: str, source: ImageSource) -> Dict[str, Any]:
+        """Inclui (ou substitui) uma referência no índice"""
+        phash, words = self._entry(source)
+
+        with self._lock, self._file_lock():
+            self._sync()
+            self._insert(str(reference_id), phash, words)
+            self._postings = None
+            self._save()
+            total = len(self._ids)
+
+        logger.info(f"Referência {reference_id} indexada ({len(words)} palavras visuais, {total} no índice)")
+        return {'id': str(reference_id), 'visual_words': int(len(words)), 'size': total}
+
+    def rebuild(self, references: List[Tuple[str, ImageSource]], reset: bool = False) -> Dict[str, Any]:
+        """Inclui (ou substitui) várias referências com uma única gravação do arquivo
+
+        Usado para indexar as referências já cadastradas. Com reset, as
+        referências que estavam no índice no início da chamada e não estão na
+        lista são removidas; as incluídas por outro processo durante a chamada
+        são mantidas. Referências que não podem ser lidas ficam em failed.
+        """
+        with self._lock:
+            self._sync()
+            previous = set(self._ids) if reset else set()
+
+        entries = []
+        failed = []
+        for reference_id, source in references:
+            try:
+                entries.append((str(reference_id), *self._entry(source)))
+            except Exception as e:
+                logger.warning(f"Referência {reference_id} não indexada: {str(e)}")
+                failed.append(str(reference_id))
+
+        with self._lock, self._file_lock():
+            self._sync()
+            for reference_id in previous - {entry[0] for entry in entries}:
+                self._remove(reference_id)
+            for reference_id, phash, words in entries:
+                self._insert(reference_id, phash, words)
+            self._postings = None
+            self._save()
+            total = len(self._ids)
+
+        logger.info(f"Índice de referências reconstruído: {len(entries)} indexada(s), "
+                    f"{len(failed)} com falha, {total} no índice")
+        return {'indexed': len(entries), 'failed': failed, 'size': total}
+
+    def remove(self, reference_id: str) -> bool:
+        """Remove uma referência do índice; retorna se ela existia"""
+        with self._lock, self._file_lock():
+            self._sync()
+            removed = self._remove(str(reference_id))
+            if removed:
+                self._postings = None
+                self._save()
+        return removed
+
+    def find_best_references(self, photo: ImageSource, k: int = 5) -> List[Dict[str, Any]]:
+        """As k referências mais parecidas com a foto, da melhor para a pior
+
+        O score combina a similaridade de cosseno TF-IDF das palavras visuais
+        com a do pHash (1 - distância/32), com peso INDEX_PHASH_WEIGHT.
+        """
+        test_img = self.comparator._load_test(photo)
+        _, descriptors = self.comparator.orb.detect(test_img)
+        query_words = self.visual_words(descriptors)
+        query_hash = perceptual_hash(test_img)
+
+        with self._lock:
+            self._sync()
+            if not self._ids:
+                return []
+
+            postings = self._build_postings()
+            bow_scores = self._bow_scores(postings, query_words)
+            distances = np.unpackbits(np.bitwise_xor(postings['phashes'], query_hash), axis=1).sum(axis=1)
+            phash_scores = np.maximum(0.0, 1.0 - distances / 32.0)
+            scores = (1 - INDEX_PHASH_WEIGHT) * bow_scores + INDEX_PHASH_WEIGHT * phash_scores
+
+            count = min(k, len(scores))
+            best = np.argpartition(-scores, count - 1)[:count]
+            best = best[np.argsort(-scores[best], kind='stable')]
+            return [
+                {
+                    'id': self._ids[i],
+                    'score': round(float(scores[i]), 4),
+                    'bow_score': round(float(bow_scores[i]), 4),
+                    'phash_distance': int(distances[i])
+                }
+                for i in best
+            ]
+
+    def _bow_scores(self, postings: Dict[str, np.ndarray], query_words: np.ndarray) -> np.ndarray:
+        """Similaridade de cosseno TF-IDF (presença das palavras) com cada referência"""
+        scores = np.zeros(len(self._ids), dtype=np.float64)
+        vocabulary = postings['vocabulary']
+        if not len(query_words) or not len(vocabulary):
+            return scores
+
+        position = np.minimum(np.searchsorted(vocabulary, query_words), len(vocabulary) - 1)
+        matched = position[vocabulary[position] == query_words]
+        if not len(matched):
+            return scores
+
+        # Expandir as faixas [início, início + df) do arquivo invertido
+        starts = postings['starts'][matched]
+        counts = postings['df'][matched]
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        refs = postings['refs'][np.repeat(starts, counts) + offsets]
+        weights = np.repeat(postings['idf'][matched] ** 2, counts)
+
+        query_norm = np.sqrt(float((postings['idf'][matched] ** 2).sum()))
+        scores = np.bincount(refs, weights=weights, minlength=len(self._ids))
+        return scores / np.maximum(query_norm * postings['norms'], 1e-12)
+
+    def _build_postings(self) -> Dict[str, np.ndarray]:
+        """Arquivo invertido (palavra -> referências), refeito após alterações"""
+        if self._postings is not None:
+            return self._postings
+
+        lengths = np.array([len(words) for words in self._words], dtype=np.int64)
+        words = np.concatenate(self._words) if self._words else np.empty(0, dtype=np.int64)
+        refs = np.repeat(np.arange(len(self._words), dtype=np.int32), lengths)
+
+        order = np.argsort(words, kind='stable')
+        words, refs = words[order], refs[order]
+        vocabulary, starts, df = np.unique(words, return_index=True, return_counts=True)
+        idf = np.log1p(len(self._ids) / df)
+
+        # Norma de cada referência: raiz da soma de idf² das suas palavras
+        norms = np.sqrt(np.bincount(refs, weights=np.repeat(idf ** 2, df), minlength=len(self._ids)))
+
+        self._postings = {
+            'vocabulary': vocabulary,
+            'starts': starts,
+            'df': df,
+            'idf': idf,
+            'refs': refs,
+            'norms': norms,
+            'phashes': np.stack(self._phashes)
+        }
+        return self._postings
+
+    def _entry(self, source: ImageSource) -> Tuple[np.ndarray, np.ndarray]:
+        """pHash e palavras visuais de uma referência"""
+        features = self.comparator.prepare_reference(source)
+        words = self.visual_words(features.descriptors)
+        phash = features.phash if features.phash is not None else perceptual_hash(features.working)
+        return np.asarray(phash, dtype=np.uint8), words
+
+    def _insert(self, reference_id: str, phash: np.ndarray, words: np.ndarray) -> None:
+        self._remove(reference_id)
+        self._ids.append(reference_id)
+        self._phashes.append(phash)
+        self._words.append(words)
+
+    def _remove(self, reference_id: str) -> bool:
+        if reference_id not in self._ids:
+            return False
+        position = self._ids.index(reference_id)
+        del self._ids[position], self._phashes[position], self._words[position]
+        return True
+
+    @contextmanager
+    def _file_lock(self):
+        """Trava exclusiva entre processos durante alterações no arquivo do índice"""
+        if not self.path or fcntl is None:
+            yield
+            return
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(f'{self.path}.lock', 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _sync(self) -> None:
+        """Recarregar o índice se outro processo alterou o arquivo"""
+        if not self.path:
+            return
+        try:
+            mtime = self.path.stat().st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime != self._loaded_mtime:
+            self._load()
+
+    def _load(self) -> None:
+        try:
+            with np.load(self.path, allow_pickle=False) as data:
+                if str(data['signature']) != self.signature:
+                    logger.warning(f"Índice de referências {self.path} gerado com outros parâmetros; ignorando")
+                    self._loaded_mtime = self.path.stat().st_mtime_ns
+                    return
+
+                offsets = data['offsets']
+                words = data['words']
+                self._ids = [str(value) for value in data['ids']]
+                self._phashes = list(data['phashes'])
+                self._words = [words[offsets[i]:offsets[i + 1]] for i in range(len(self._ids))]
+            self._postings = None
+            self._loaded_mtime = self.path.stat().st_mtime_ns
+            logger.info(f"Índice de referências carregado: {len(self._ids)} referência(s)")
+        except (OSError, KeyError, ValueError) as e:
+            logger.warning(f"Não foi possível carregar o índice {self.path}: {str(e)}")
+
+    def _save(self) -> None:
+        if not self.path:
+            return
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        lengths = [len(words) for words in self._words]
+        offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+
+        # Gravar em arquivo temporário e renomear, para que leitores nunca vejam
+        # um índice incompleto
+        fd, temp_path = tempfile.mkstemp(prefix=f'.{self.path.name}-', suffix='.npz', dir=self.path.parent)
+        try:
+            with os.fdopen(fd, 'wb') as temp_file:
+                np.savez(
+                    temp_file,
+                    signature=np.array(self.signature),
+                    ids=np.array(self._ids, dtype=str),
+                    phashes=np.stack(self._phashes) if self._phashes else np.empty((0, 8), dtype=np.uint8),
+                    words=np.concatenate(self._words) if self._words else np.empty(0, dtype=np.int64),
+                    offsets=offsets
+                )
+            os.replace(temp_path, self.path)
+            self._loaded_mtime = self.path.stat().st_mtime_ns
+        except OSError as e:
+            logger.warning(f"Não foi possível gravar o índice {self.path}: {str(e)}")
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+
 
 def main():
     """Função principal para execução via linha de comando"""
     parser = argparse.ArgumentParser(description='Comparador de imagens para inspeção de etiquetas')
-    parser.add_argument('reference', help='Caminho para a imagem de referência')
-    parser.add_argument('test', help='Caminho para a imagem de teste')
-    parser.add_argument('--method', choices=['ssim', 'orb', 'template', 'all'], 
+    parser.add_argument('reference', nargs='?', help='Caminho para a imagem de referência')
+    parser.add_argument('test', nargs='*',
+                       help='Caminho para a imagem de teste (várias imagens = comparação em lote)')
+    parser.add_argument('--stdin-binary', action='store_true',
+                       help='Ler referência e teste(s) de stdin como blocos [tamanho uint32 big-endian][bytes]')
+    parser.add_argument('--method', choices=['ssim', 'orb', 'template', 'color', 'all', 'cascade'],
                        default='ssim', help='Método de comparação')
+    parser.add_argument('--final-method', choices=['ssim', 'orb', 'template', 'color'],
+                       default='ssim',
+                       help='Método do último estágio da cascata')
     parser.add_argument('--output', help='Arquivo de saída JSON (opcional)')
+    parser.add_argument('--deadline', type=float,
+                       help='Prazo em segundos para o método "all" (retorna o melhor resultado concluído)')
+    parser.add_argument('--working-pixels', type=int, default=0,
+                       help='Orçamento de pixels da resolução de trabalho (0 = resolução original)')
+    parser.add_argument('--threshold', type=float,
+                       help='Limite de aprovação; ativa o SSIM do grosseiro para o fino')
+    parser.add_argument('--ssim-engine', choices=SSIM_ENGINES, default='skimage',
+                       help='Implementação do SSIM: skimage (float64) ou fast (OpenCV em float32)')
+    parser.add_argument('--fast-ssim-mode', choices=FAST_SSIM_MODES, default='box',
+                       help='Janela do SSIM com --ssim-engine fast (box, gaussian ou integral)')
+    parser.add_argument('--ssim-tile', type=int, default=SSIM_TILE,
+                       help='Lado (em pixels) dos blocos do SSIM: imagens maiores são comparadas por blocos')
+    parser.add_argument('--ssim-margin', type=float, default=DEFAULT_SSIM_MARGIN,
+                       help='Margem abaixo do limite a partir da qual um nível grosseiro do SSIM já reprova')
+    parser.add_argument('--orb-ratio', type=float, default=0.75, help='Razão do teste de Lowe no ORB')
+    parser.add_argument('--orb-ransac', action='store_true',
+                       help='Verificar geometricamente os matches ORB (homografia RANSAC)')
+    parser.add_argument('--orb-max-per-cell', type=int,
+                       help='Máximo de keypoints ORB por célula de uma grade 8x8')
+    parser.add_argument('--localize', action='store_true',
+                       help='Localizar e recortar a etiqueta na foto antes de comparar')
+    parser.add_argument('--normalize', action='store_true',
+                       help='Normalizar a iluminação (CLAHE) e alinhar a foto à referência (ECC) antes de comparar')
+    parser.add_argument('--quality-gate', nargs='?', const='{}', default=None, metavar='LIMITES',
+                       help='Recusar fotos ruins antes de comparar; limites opcionais em JSON '
+                       '(ex.: \'{"min_sharpness": 80}\')')
+    parser.add_argument('--max-input-pixels', type=int, default=MAX_INPUT_PIXELS,
+                       help='Pixels máximos por imagem; JPEGs maiores são decodificados reduzidos, '
+                       'outros formatos são recusados (0 = sem limite)')
+    parser.add_argument('--max-input-mb', type=int, default=MAX_INPUT_BYTES // (1024 * 1024),
+                       help='Tamanho máximo de cada imagem em MB (0 = sem limite)')
+    parser.add_argument('--rois', help='Regiões de interesse: arquivo JSON ou JSON em linha '
+                       '([{"name", "x", "y", "width", "height", "weight"}], coordenadas em frações)')
+    parser.add_argument('--instrument', action='store_true',
+                       help='Incluir tempos por estágio, dimensões e bytes decodificados no resultado')
+    parser.add_argument('--profile-dir', help='Diretório para gravar um perfil cProfile (.prof) por comparação')
+    parser.add_argument('--result-cache', help='Banco SQLite para cache de resultados entre execuções')
+    parser.add_argument('--result-cache-ttl', type=float, help='Validade (em segundos) dos resultados em cache')
+    parser.add_argument('--feature-cache', help='Diretório para cache em disco das features de referência')
     
     args = parser.parse_args()
     
-    # Verificar se os arquivos existem
-    if not os.path.exists(args.reference):
-        print(f"Erro: Arquivo de referência não encontrado: {args.reference}")
-        sys.exit(1)
+    if args.stdin_binary:
+        # Imagens recebidas em memória, sem arquivos temporários
+        payloads = read_length_prefixed(sys.stdin.buffer)
+        if len(payloads) < 2:
+            print("Erro: a entrada binária deve conter a referência e ao menos uma imagem de teste")
+            sys.exit(1)
+        args.reference, args.test = payloads[0], payloads[1:]
+    else:
+        if not args.reference or not args.test:
+            parser.error('informe a imagem de referência e ao menos uma imagem de teste')
+        
+        # Verificar se os arquivos existem
+        if not os.path.exists(args.reference):
+            print(f"Erro: Arquivo de referência não encontrado: {args.reference}")
+            sys.exit(1)
+        
+        for test_path in args.test:
+            if not os.path.exists(test_path):
+                print(f"Erro: Arquivo de teste não encontrado: {test_path}")
+                sys.exit(1)
     
-    if not os.path.exists(args.test):
-        print(f"Erro: Arquivo de teste não encontrado: {args.test}")
+    # Executar comparação
+    feature_store = ReferenceFeatureStore(cache_dir=args.feature_cache) if args.feature_cache else None
+    comparator = ImageComparator(
+        feature_store=feature_store,
+        working_pixels=args.working_pixels or None,
+        ssim_margin=args.ssim_margin,
+        orb_matcher=OrbMatcher(ratio=args.orb_ratio, verify_geometry=args.orb_ransac,
+                               max_per_cell=args.orb_max_per_cell),
+        instrument=args.instrument,
+        profile_dir=args.profile_dir,
+        ssim_engine=args.ssim_engine,
+        fast_ssim_mode=args.fast_ssim_mode,
+        ssim_tile=args.ssim_tile,
+        localize=args.localize,
+        normalizer=IlluminationNormalizer() if args.normalize else None,
+        quality_gate=QualityGate(**json.loads(args.quality_gate)) if args.quality_gate else None,
+        max_pixels=args.max_input_pixels or None,
+        max_bytes=args.max_input_mb * 1024 * 1024 or None,
+        result_cache=ComparisonResultCache(ttl=args.result_cache_ttl, db_path=args.result_cache)
+        if args.result_cache else None
+    )
+    
+    if args.method == 'cascade' and args.threshold is None:
+        print("Erro: o método cascade requer --threshold")
         sys.exit(1)
     
-    # Executar comparação
-    comparator = ImageComparator()
+    rois = None
+    if args.rois:
+        try:
+            rois = normalize_rois(json.loads(Path(args.rois).read_text(encoding='utf-8')
+                                             if os.path.exists(args.rois) else args.rois))
+        except (ValueError, KeyError, TypeError) as e:
+            print(f"Erro: regiões de interesse inválidas: {e}")
+            sys.exit(1)
     
-    if args.method == 'all':
-        result = comparator.compare_multiple_methods(args.reference, args.test)
+    if len(args.test) > 1:
+        if args.method in ('all', 'cascade'):
+            print("Erro: a comparação em lote requer um único método")
+            sys.exit(1)
+        result = comparator.compare_batch(args.reference, args.test, args.method, threshold=args.threshold,
+                                          rois=rois)
+    elif args.method == 'cascade':
+        result = comparator.compare_cascade(args.reference, args.test[0], args.threshold,
+                                            final_method=args.final_method, rois=rois)
+    elif args.method == 'all':
+        result = comparator.compare_multiple_methods(args.reference, args.test[0],
+                                                     deadline=args.deadline, threshold=args.threshold, rois=rois)
     else:
-        result = comparator.compare_images(args.reference, args.test, args.method)
+        result = comparator.compare_images(args.reference, args.test[0], args.method, threshold=args.threshold,
+                                           rois=rois)
     
     # Exibir resultado
     if args.output:
@@ -5,23 +5,29 @@ Usado para extrair a primeira página de PDFs de referência de etiquetas
 """
 
 import os
+import io
+import re
 import sys
 import json
+import base64
 import argparse
 import logging
 from pathlib import Path
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Optional, Tuple
 import tempfile
 import shutil
 
 try:
-    from pdf2image import convert_from_path, convert_from_bytes
+    from pdf2image import convert_from_path, convert_from_bytes, pdfinfo_from_path, pdfinfo_from_bytes
     from PIL import Image
 except ImportError as e:
     print(f"Erro: Dependência não instalada: {e}")
     print("Execute: pip install pdf2image Pillow")
     sys.exit(1)
 
+# Mesmo protocolo binário ([tamanho uint32 big-endian][bytes]) do comparador
+from framing import read_length_prefixed
+
 # Configurar logging
 logging.basicConfig(
     level=logging.INFO,
@@ -29,17 +35,74 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Orçamento da rasterização: o DPI é reduzido para que a maior página caiba em
+# MAX_PDF_PIXELS, e MAX_PDF_DPI limita o DPI mesmo sem o tamanho das páginas
+# (os dois valem apenas com orçamento de pixels configurado)
+MAX_PDF_PIXELS = 24_000_000
+MAX_PDF_BYTES = 50 * 1024 * 1024
+MAX_PDF_DPI = 600
+
+# Linhas "Page size" / "Page    1 size" do pdfinfo: "595.276 x 841.89 pts (A4)"
+_PAGE_SIZE_KEY = re.compile(r'^Page\s*\d*\s*size$')
+_PAGE_SIZE_VALUE = re.compile(r'([\d.]+) x ([\d.]+) pts')
+
+
+class PDFTooLarge(ValueError):
+    """PDF acima do orçamento de bytes"""
+
+    error_code = 'INPUT_TOO_LARGE'
+
+
 class PDFToImageConverter:
     """Classe para converter PDF em imagem"""
     
     def __init__(self, output_dir: str = "temp_images"):
+        # O diretório só é criado quando algo for gravado em disco
         self.output_dir = Path(output_dir)
-        self.output_dir.mkdir(exist_ok=True)
         
         # Configurações para conversão
         self.dpi = 300  # DPI para conversão
         self.format = 'PNG'  # Formato de saída
         self.first_page_only = True  # Converter apenas primeira página
+        self.max_pixels = MAX_PDF_PIXELS  # pixels máximos por página rasterizada (None = sem limite)
+        self.max_bytes = MAX_PDF_BYTES  # tamanho máximo do PDF (None = sem limite)
+    
+    def _plan_dpi(self, pdf_path: Optional[Path] = None, pdf_bytes: Optional[bytes] = None,
+                  first_page_only: Optional[bool] = None) -> Tuple[int, float]:
+        """DPI efetivo da conversão e o fator de redução em relação ao DPI pedido
+        
+        Verifica o tamanho do PDF e lê o tamanho das páginas com o pdfinfo antes
+        de rasterizar, reduzindo o DPI para que a maior página caiba em
+        max_pixels. Se o pdfinfo falhar, vale apenas o teto MAX_PDF_DPI. Sem
+        orçamento de pixels (max_pixels 0/None), o DPI pedido é mantido.
+        """
+        size = len(pdf_bytes) if pdf_bytes is not None else pdf_path.stat().st_size
+        if self.max_bytes and size > self.max_bytes:
+            raise PDFTooLarge(f"PDF excede o limite de {self.max_bytes / (1024 * 1024):.1f} MB")
+        
+        dpi = self.dpi
+        if self.max_pixels:
+            dpi = min(dpi, MAX_PDF_DPI)
+            first_page_only = self.first_page_only if first_page_only is None else first_page_only
+            pages = {'first_page': 1, 'last_page': 1} if first_page_only else {'first_page': 1, 'last_page': 9999}
+            try:
+                info = (pdfinfo_from_bytes(pdf_bytes, **pages) if pdf_bytes is not None
+                        else pdfinfo_from_path(str(pdf_path), **pages))
+                areas = [float(width) * float(height)
+                         for key, value in info.items() if _PAGE_SIZE_KEY.match(key)
+                         for width, height in _PAGE_SIZE_VALUE.findall(str(value))]
+            except Exception as e:
+                logger.warning(f"Não foi possível ler o tamanho das páginas: {str(e)}")
+                areas = []
+            
+            if areas:
+                # pixels = (largura em pt / 72 * dpi) * (altura em pt / 72 * dpi)
+                max_dpi = int(72 * (self.max_pixels / max(areas)) ** 0.5)
+                dpi = max(1, min(dpi, max_dpi))
+        
+        if dpi < self.dpi:
+            logger.info(f"DPI reduzido de {self.dpi} para {dpi} pelo orçamento de pixels")
+        return dpi, round(self.dpi / dpi, 3)
     
     def convert_pdf_file(self, pdf_path: str, output_filename: Optional[str] = None) -> Dict[str, Any]:
         """Converte um arquivo PDF em imagem"""
@@ -50,17 +113,18 @@ class PDFToImageConverter:
                 raise FileNotFoundError(f"Arquivo PDF não encontrado: {pdf_path}")
             
             logger.info(f"Convertendo PDF: {pdf_path}")
+            dpi, downscale_factor = self._plan_dpi(pdf_path=pdf_path)
             
             # Converter PDF para imagem
             if self.first_page_only:
                 images = convert_from_path(
                     pdf_path, 
-                    dpi=self.dpi, 
+                    dpi=dpi, 
                     first_page=1, 
                     last_page=1
                 )
             else:
-                images = convert_from_path(pdf_path, dpi=self.dpi)
+                images = convert_from_path(pdf_path, dpi=dpi)
             
             if not images:
                 raise ValueError("Nenhuma imagem foi gerada do PDF")
@@ -72,6 +136,7 @@ class PDFToImageConverter:
             if output_filename is None:
                 output_filename = f"{pdf_path.stem}_page1.{self.format.lower()}"
             
+            self.output_dir.mkdir(exist_ok=True)
             output_path = self.output_dir / output_filename
             
             # Salvar imagem
@@ -84,7 +149,9 @@ class PDFToImageConverter:
                 'input_pdf': str(pdf_path),
                 'output_image': str(output_path),
                 'image_size': image.size,
-                'dpi': self.dpi,
+                'dpi': dpi,
+                'requested_dpi': self.dpi,
+                'downscale_factor': downscale_factor,
                 'format': self.format,
                 'error': None
             }
@@ -98,24 +165,26 @@ class PDFToImageConverter:
                 'image_size': None,
                 'dpi': self.dpi,
                 'format': self.format,
-                'error': str(e)
+                'error': str(e),
+                'error_code': getattr(e, 'error_code', None)
             }
     
     def convert_pdf_bytes(self, pdf_bytes: bytes, filename: str, output_filename: Optional[str] = None) -> Dict[str, Any]:
         """Converte bytes de PDF em imagem"""
         try:
             logger.info(f"Convertendo PDF de bytes: {filename}")
+            dpi, downscale_factor = self._plan_dpi(pdf_bytes=pdf_bytes)
             
             # Converter PDF para imagem
             if self.first_page_only:
                 images = convert_from_bytes(
                     pdf_bytes, 
-                    dpi=self.dpi, 
+                    dpi=dpi, 
                     first_page=1, 
                     last_page=1
                 )
             else:
-                images = convert_from_bytes(pdf_bytes, dpi=self.dpi)
+                images = convert_from_bytes(pdf_bytes, dpi=dpi)
             
             if not images:
                 raise ValueError("Nenhuma imagem foi gerada do PDF")
@@ -128,6 +197,7 @@ class PDFToImageConverter:
                 base_name = Path(filename).stem
                 output_filename = f"{base_name}_page1.{self.format.lower()}"
             
+            self.output_dir.mkdir(exist_ok=True)
             output_path = self.output_dir / output_filename
             
             # Salvar imagem
@@ -140,7 +210,9 @@ class PDFToImageConverter:
                 'input_filename': filename,
                 'output_image': str(output_path),
                 'image_size': image.size,
-                'dpi': self.dpi,
+                'dpi': dpi,
+                'requested_dpi': self.dpi,
+                'downscale_factor': downscale_factor,
                 'format': self.format,
                 'error': None
             }
@@ -154,14 +226,63 @@ class PDFToImageConverter:
                 'image_size': None,
                 'dpi': self.dpi,
                 'format': self.format,
-                'error': str(e)
+                'error': str(e),
+                'error_code': getattr(e, 'error_code', None)
             }
     
-    def convert_with_upload(self, pdf_path: str, upload_dir: str) -> Dict[str, Any]:
+    def convert_pdf_bytes_in_memory(self, pdf_bytes: bytes, filename: str = 'documento.pdf') -> Dict[str, Any]:
+        """Converte bytes de PDF em imagem sem gravar arquivos, retornando os bytes da imagem"""
+        try:
+            logger.info(f"Convertendo PDF em memória: {filename}")
+            dpi, downscale_factor = self._plan_dpi(pdf_bytes=pdf_bytes, first_page_only=True)
+            
+            # Apenas a primeira página: a imagem retornada é uma só
+            images = convert_from_bytes(
+                pdf_bytes,
+                dpi=dpi,
+                first_page=1,
+                last_page=1
+            )
+            
+            if not images:
+                raise ValueError("Nenhuma imagem foi gerada do PDF")
+            
+            image = images[0]
+            buffer = io.BytesIO()
+            image.save(buffer, self.format)
+            
+            return {
+                'success': True,
+                'input_filename': filename,
+                'output_image': None,
+                'image_bytes': buffer.getvalue(),
+                'image_size': image.size,
+                'dpi': dpi,
+                'requested_dpi': self.dpi,
+                'downscale_factor': downscale_factor,
+                'format': self.format,
+                'error': None
+            }
+            
+        except Exception as e:
+            logger.error(f"Erro ao converter PDF em memória {filename}: {str(e)}")
+            return {
+                'success': False,
+                'input_filename': filename,
+                'output_image': None,
+                'image_bytes': None,
+                'image_size': None,
+                'dpi': self.dpi,
+                'format': self.format,
+                'error': str(e),
+                'error_code': getattr(e, 'error_code', None)
+            }
+    
+    def convert_with_upload(self, pdf_path: str, upload_dir: str, output_filename: Optional[str] = None) -> Dict[str, Any]:
         """Converte PDF e move para diretório de upload"""
         try:
             # Converter PDF
-            result = self.convert_pdf_file(pdf_path)
+            result = self.convert_pdf_file(pdf_path, output_filename)
             
             if not result['success']:
                 return result
@@ -176,6 +297,7 @@ class PDFToImageConverter:
             shutil.move(str(source_path), str(dest_path))
             
             result['upload_path'] = str(dest_path)
+            result['output_image'] = str(dest_path)
             logger.info(f"Arquivo movido para upload: {dest_path}")
             
             return result
@@ -198,16 +320,42 @@ class PDFToImageConverter:
 def main():
     """Função principal para execução via linha de comando"""
     parser = argparse.ArgumentParser(description='Conversor de PDF para imagem')
-    parser.add_argument('pdf_file', help='Caminho para o arquivo PDF')
+    parser.add_argument('pdf_file', nargs='?', help='Caminho para o arquivo PDF')
+    parser.add_argument('--stdin-binary', action='store_true',
+                        help='Ler o PDF de stdin ([tamanho uint32 big-endian][bytes]) e devolver a imagem em base64')
     parser.add_argument('--output', '-o', help='Nome do arquivo de saída')
     parser.add_argument('--dpi', type=int, default=300, help='DPI para conversão (padrão: 300)')
     parser.add_argument('--format', choices=['PNG', 'JPEG', 'TIFF'], default='PNG', help='Formato de saída')
     parser.add_argument('--upload-dir', help='Diretório para mover arquivo convertido')
     parser.add_argument('--cleanup', action='store_true', help='Limpar arquivos temporários após conversão')
     parser.add_argument('--all-pages', action='store_true', help='Converter todas as páginas (padrão: apenas primeira)')
+    parser.add_argument('--max-pixels', type=int, default=MAX_PDF_PIXELS,
+                        help='Pixels máximos por página; o DPI é reduzido para caber (0 = sem limite)')
+    parser.add_argument('--max-mb', type=int, default=MAX_PDF_BYTES // (1024 * 1024),
+                        help='Tamanho máximo do PDF em MB (0 = sem limite)')
     
     args = parser.parse_args()
     
+    if args.stdin_binary:
+        # Conversão em memória: nenhum arquivo é lido ou gravado
+        converter = PDFToImageConverter()
+        converter.dpi = args.dpi
+        converter.format = args.format
+        converter.max_pixels = args.max_pixels or None
+        converter.max_bytes = args.max_mb * 1024 * 1024 or None
+        payloads = read_length_prefixed(sys.stdin.buffer)
+        if len(payloads) != 1:
+            print("Erro: a entrada binária deve conter exatamente um PDF")
+            sys.exit(1)
+        result = converter.convert_pdf_bytes_in_memory(payloads[0], 'stdin.pdf')
+        image_bytes = result.pop('image_bytes')
+        result['image_b64'] = base64.b64encode(image_bytes).decode('ascii') if image_bytes else None
+        print(json.dumps(result))
+        sys.exit(0 if result['success'] else 1)
+    
+    if not args.pdf_file:
+        parser.error('informe o arquivo PDF ou use --stdin-binary')
+    
     # Verificar se o arquivo existe
     if not os.path.exists(args.pdf_file):
         print(f"Erro: Arquivo PDF não encontrado: {args.pdf_file}")
@@ -218,10 +366,12 @@ def main():
     converter.dpi = args.dpi
     converter.format = args.format
     converter.first_page_only = not args.all_pages
+    converter.max_pixels = args.max_pixels or None
+    converter.max_bytes = args.max_mb * 1024 * 1024 or None
     
     # Executar conversão
     if args.upload_dir:
-        result = converter.convert_with_upload(args.pdf_file, args.upload_dir)
+        result = converter.convert_with_upload(args.pdf_file, args.upload_dir, args.output)
     else:
         result = converter.convert_pdf_file(args.pdf_file, args.output)
     
@@ -0,0 +1,88 @@
+"""
+Fixtures dos testes do comparador de etiquetas
+
+As imagens são sintéticas (render_label do benchmark), geradas em memória e
+codificadas como os bytes que chegam do servidor.
+"""
+
+import base64
+import logging
+import os
+import struct
+import sys
+
+import cv2
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmark_image_comparison import render_label  # noqa: E402
+
+logging.disable(logging.CRITICAL)
+
+
+def encode(image: np.ndarray, extension: str = '.png', quality: int = 92) -> bytes:
+    """Bytes da imagem no formato informado"""
+    params = [cv2.IMWRITE_JPEG_QUALITY, quality] if extension == '.jpg' else []
+    ok, buffer = cv2.imencode(extension, image, params)
+    assert ok
+    return buffer.tobytes()
+
+
+def rotated_jpeg(image: np.ndarray, orientation: int = 6, quality: int = 92) -> bytes:
+    """JPEG com orientação EXIF, como as fotos de celular tiradas na vertical
+
+    Os pixels ficam como em image; quem decodifica (cv2.imdecode) aplica a
+    rotação. Com orientação 6 a imagem exibida fica girada 90° no sentido horário.
+    """
+    ifd = struct.pack('>H', 1) + struct.pack('>HHIHH', 0x0112, 3, 1, orientation, 0) + struct.pack('>I', 0)
+    app1 = b'Exif\x00\x00' + b'MM\x00*' + struct.pack('>I', 8) + ifd
+    jpeg = encode(image, '.jpg', quality)
+    return jpeg[:2] + b'\xff\xe1' + struct.pack('>H', len(app1) + 2) + app1 + jpeg[2:]
+
+
+def b64(data: bytes) -> str:
+    """Conteúdo em base64, como nos parâmetros *_b64 do worker"""
+    return base64.b64encode(data).decode('ascii')
+
+
+def photograph(label: np.ndarray, size=(1600, 1200), seed: int = 0) -> np.ndarray:
+    """Etiqueta em perspectiva sobre um fundo texturizado, como numa foto da bancada"""
+    rng = np.random.default_rng(seed)
+    width, height = size
+    background = cv2.GaussianBlur(rng.integers(60, 160, (height // 8, width // 8, 3), dtype=np.uint8), (3, 3), 0)
+    background = cv2.resize(background, (width, height), interpolation=cv2.INTER_CUBIC)
+
+    label_height, label_width = label.shape[:2]
+    source = np.float32([[0, 0], [label_width, 0], [label_width, label_height], [0, label_height]])
+    target = np.float32([[260, 180], [1330, 230], [1300, 1020], [230, 960]])
+    matrix = cv2.getPerspectiveTransform(source, target)
+    warped = cv2.warpPerspective(label, matrix, (width, height))
+    mask = cv2.warpPerspective(np.full(label.shape[:2], 255, np.uint8), matrix, (width, height))
+    photo = background.copy()
+    photo[mask > 0] = warped[mask > 0]
+    return photo
+
+
+def remove_box(image: np.ndarray, box) -> np.ndarray:
+    """Apaga (em branco) a caixa (esquerda, topo, direita, base) da imagem"""
+    damaged = image.copy()
+    left, top, right, bottom = box
+    cv2.rectangle(damaged, (left, top), (right, bottom), (255, 255, 255), -1)
+    return damaged
+
+
+@pytest.fixture(scope='session')
+def label() -> np.ndarray:
+    return render_label(1200, 900, seed=0)
+
+
+@pytest.fixture(scope='session')
+def reference_bytes(label) -> bytes:
+    return encode(label)
+
+
+@pytest.fixture(scope='session')
+def photo_bytes(label) -> bytes:
+    return encode(photograph(label), '.jpg')
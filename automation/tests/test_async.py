@@ -0,0 +1,42 @@
+"""API assíncrona com concorrência limitada e tempo limite"""
+
+import asyncio
+
+import pytest
+
+from benchmark_image_comparison import perturb
+from conftest import encode
+from image_comparison import ImageComparator
+
+KINDS = ['identical', 'noise', 'defect', 'rotation']
+
+
+@pytest.fixture(scope='module')
+def tests(label):
+    return [encode(perturb(label, kind, seed=index)) for index, kind in enumerate(KINDS)]
+
+
+def test_async_comparison_matches_sync(reference_bytes, tests):
+    comparator = ImageComparator(max_concurrency=2)
+
+    async def compare_all():
+        return await asyncio.gather(*(comparator.compare_async(reference_bytes, test, 'ssim') for test in tests))
+
+    results = asyncio.run(compare_all())
+    assert ([result['score'] for result in results]
+            == [comparator.compare_images(reference_bytes, test, 'ssim')['score'] for test in tests])
+
+
+def test_async_timeout_returns_an_error_result(reference_bytes, tests):
+    result = asyncio.run(ImageComparator().compare_async(reference_bytes, tests[1], 'ssim', timeout=1e-6))
+
+    assert result['timed_out'] and not result['success']
+
+
+def test_async_batch_matches_sync(reference_bytes, tests):
+    comparator = ImageComparator(max_concurrency=2)
+
+    batch = asyncio.run(comparator.compare_batch_async(reference_bytes, tests, 'ssim'))
+
+    assert ([result['score'] for result in batch['results']]
+            == [result['score'] for result in comparator.compare_batch(reference_bytes, tests, 'ssim')['results']])
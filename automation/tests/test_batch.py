@@ -0,0 +1,31 @@
+"""Várias fotos contra a mesma referência, carregada uma única vez"""
+
+import pytest
+
+from benchmark_image_comparison import perturb
+from conftest import encode
+from image_comparison import ImageComparator
+
+KINDS = ['identical', 'noise', 'defect', 'rotation']
+
+
+@pytest.fixture(scope='module')
+def tests(label):
+    return [encode(perturb(label, kind, seed=index)) for index, kind in enumerate(KINDS)]
+
+
+def test_compare_batch_keeps_order_and_scores(reference_bytes, tests):
+    comparator = ImageComparator()
+    batch = comparator.compare_batch(reference_bytes, tests, 'ssim')
+
+    expected = [comparator.compare_images(reference_bytes, test, 'ssim')['score'] for test in tests]
+    assert [result['score'] for result in batch['results']] == expected
+    assert batch['best_index'] == expected.index(max(expected))
+
+
+def test_reference_error_fails_every_photo(tests):
+    batch = ImageComparator().compare_batch(b'not an image', tests, 'ssim')
+
+    assert not batch['success'] and batch['best_index'] is None
+    assert len(batch['results']) == len(tests)
+    assert not any(result['success'] for result in batch['results'])
@@ -0,0 +1,66 @@
+"""Lotes de pares NDJSON em um pool de processos com referências em memória compartilhada"""
+
+import cv2
+import pytest
+
+from batch_comparison import iter_batch_results
+from benchmark_image_comparison import perturb
+from conftest import encode
+from image_comparison import ImageComparator
+
+KINDS = ['identical', 'noise', 'defect', 'rotation']
+ROI = [{'x': 0.02, 'y': 0.5, 'width': 0.6, 'height': 0.45}]
+
+
+@pytest.fixture(scope='module')
+def tests(label):
+    return [encode(perturb(label, kind, seed=index)) for index, kind in enumerate(KINDS)]
+
+
+@pytest.fixture(scope='module')
+def files(tmp_path_factory, label, tests):
+    directory = tmp_path_factory.mktemp('batch')
+    cv2.imwrite(str(directory / 'reference.png'), label)
+    paths = []
+    for kind, data in zip(KINDS, tests):
+        path = directory / f'{kind}.png'
+        path.write_bytes(data)
+        paths.append(str(path))
+    return str(directory / 'reference.png'), paths
+
+
+def test_process_pool_matches_direct_comparison(files):
+    reference, paths = files
+    pairs = [{'reference': reference, 'test': path, 'id': kind} for kind, path in zip(KINDS, paths)]
+    pairs.append({'reference': reference, 'test': paths[2], 'id': 'roi', 'rois': ROI})
+
+    results = {result['id']: result for result in iter_batch_results(pairs, 'ssim', threshold=0.9, workers=2)}
+
+    comparator = ImageComparator()
+    for kind, path in zip(KINDS, paths):
+        expected = comparator.compare_images(reference, path, 'ssim', threshold=0.9)['score']
+        assert results[kind]['score'] == expected
+        assert results[kind]['approved'] == (expected >= 0.9)
+    assert results['roi']['score'] == comparator.compare_images(reference, paths[2], 'ssim', threshold=0.9,
+                                                                rois=ROI)['score']
+
+
+def test_process_pool_applies_configured_rois(files):
+    reference, paths = files
+    pairs = [{'reference': reference, 'test': paths[2]}]
+
+    result = next(iter_batch_results(pairs, 'ssim', workers=1, config={'rois': ROI}))
+
+    comparator = ImageComparator()
+    # A região exclui o defeito, então o score dela é diferente do da etiqueta inteira
+    assert result['score'] == comparator.compare_images(reference, paths[2], 'ssim', rois=ROI)['score']
+    assert result['score'] != comparator.compare_images(reference, paths[2], 'ssim')['score']
+
+
+def test_skipped_pairs_are_not_compared(files):
+    reference, paths = files
+    pairs = [{'reference': reference, 'test': path} for path in paths]
+
+    results = list(iter_batch_results(pairs, 'ssim', workers=1, skip={0, 2}))
+
+    assert sorted(result['index'] for result in results) == [1, 3]
@@ -0,0 +1,39 @@
+"""Conjunto de dados e comparação com a execução anterior do benchmark"""
+
+import os
+
+import cv2
+import numpy as np
+import pytest
+
+from benchmark_image_comparison import compare_with_baseline, generate_dataset, perturb
+
+
+@pytest.mark.parametrize('kind', ['identical', 'blur', 'noise', 'brightness', 'rotation', 'defect'])
+def test_perturbations_are_reproducible(label, kind):
+    first, again = perturb(label, kind, seed=3), perturb(label, kind, seed=3)
+
+    assert first.shape == label.shape and np.array_equal(first, again)
+    assert np.array_equal(first, label) == (kind == 'identical')
+
+
+def test_unknown_perturbation_is_rejected(label):
+    with pytest.raises(ValueError):
+        perturb(label, 'fog')
+
+
+def test_dataset_is_written_per_resolution_and_format(tmp_path):
+    reference, tests = generate_dataset(str(tmp_path), '640x480', 'jpg')
+
+    assert cv2.imread(reference).shape == (480, 640, 3)
+    assert len(tests) == 6 and all(os.path.exists(path) for path in tests)
+
+
+def test_latency_regressions_are_reported():
+    def case(p50):
+        return {'method': 'ssim', 'resolution': '640x480', 'format': 'png', 'latency_ms': {'p50': p50}}
+
+    baseline = {'cases': [case(10.0)]}
+
+    assert compare_with_baseline({'cases': [case(10.5)]}, baseline, 0.10) == []
+    assert len(compare_with_baseline({'cases': [case(12.0)]}, baseline, 0.10)) == 1
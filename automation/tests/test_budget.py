@@ -0,0 +1,118 @@
+"""Orçamento de entrada: pixels lidos do cabeçalho, bytes do arquivo e DPI do PDF"""
+
+import cv2
+import numpy as np
+import pytest
+
+from conftest import encode, rotated_jpeg
+from image_comparison import ImageComparator, QualityGate, image_header_info
+
+
+@pytest.fixture(scope='module')
+def large_label(label):
+    return cv2.resize(label, (4800, 3600), interpolation=cv2.INTER_NEAREST)
+
+
+@pytest.mark.parametrize('extension, image_format', [('.png', 'png'), ('.jpg', 'jpeg'), ('.webp', 'webp'),
+                                                     ('.bmp', 'bmp'), ('.tiff', 'tiff')])
+def test_header_info_reads_dimensions(label, extension, image_format):
+    assert image_header_info(encode(label, extension)) == (image_format, 1200, 900)
+
+
+def test_header_info_does_not_guess_unknown_formats(label):
+    assert image_header_info(encode(label, '.jp2')) is None
+    assert image_header_info(b'\x89PNG\r\n\x1a\n') is None
+
+
+@pytest.mark.parametrize('orientation, size', [(1, (4000, 3000)), (3, (4000, 3000)),
+                                               (6, (3000, 4000)), (8, (3000, 4000))])
+def test_header_info_applies_exif_orientation(orientation, size):
+    data = rotated_jpeg(np.zeros((3000, 4000, 3), np.uint8), orientation)
+    decoded = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_GRAYSCALE)
+
+    assert image_header_info(data) == ('jpeg', *size)
+    assert (decoded.shape[1], decoded.shape[0]) == size
+
+
+def test_exif_rotated_photo_reports_the_displayed_size(reference_bytes, label):
+    # Foto de celular na vertical: 4000x3000 gravados, 3000x4000 exibidos
+    photo = rotated_jpeg(cv2.resize(label, (4000, 3000), interpolation=cv2.INTER_NEAREST), 6)
+    comparator = ImageComparator(max_pixels=4_000_000, quality_gate=QualityGate())
+
+    result = comparator.compare_images(reference_bytes, photo, 'ssim')
+    quality = comparator.check_quality(photo)
+
+    assert result['success'] and result['downscale_factor'] == 2
+    assert (quality['metrics']['width'], quality['metrics']['height']) == (3000, 4000)
+
+
+def test_large_jpeg_is_decoded_reduced(reference_bytes, large_label):
+    comparator = ImageComparator(max_pixels=2_000_000)
+    result = comparator.compare_images(reference_bytes, encode(large_label, '.jpg'), 'ssim', instrument=True)
+
+    assert result['success']
+    width, height = result['instrumentation']['image_dimensions']['test']
+    assert width * height <= 2_000_000
+    assert result['score'] > 0.9
+
+
+def test_large_png_is_rejected(reference_bytes, large_label):
+    result = ImageComparator(max_pixels=2_000_000).compare_images(reference_bytes, encode(large_label), 'ssim')
+
+    assert not result['success']
+    assert result['error_code'] == 'INPUT_TOO_LARGE'
+    assert result['input_limits'] == {'max_pixels': 2_000_000, 'width': 4800, 'height': 3600}
+
+
+def test_small_tiff_is_accepted_under_the_default_budget(reference_bytes, label):
+    # pdf_to_image --format TIFF gera referências em TIFF
+    result = ImageComparator().compare_images(reference_bytes, encode(label, '.tiff'), 'ssim')
+
+    assert result['success'] and result['score'] == 1.0
+
+
+def test_large_tiff_is_rejected_from_the_header(reference_bytes, large_label):
+    result = ImageComparator(max_pixels=2_000_000).compare_images(reference_bytes, encode(large_label, '.tiff'))
+
+    assert result['error_code'] == 'INPUT_TOO_LARGE'
+    assert result['input_limits'] == {'max_pixels': 2_000_000, 'width': 4800, 'height': 3600}
+
+
+def test_unreadable_header_is_checked_after_decoding(reference_bytes, label):
+    jp2 = encode(label, '.jp2')
+
+    limited = ImageComparator(max_pixels=1_000_000).compare_images(reference_bytes, jp2, 'ssim')
+    accepted = ImageComparator(max_pixels=2_000_000).compare_images(reference_bytes, jp2, 'ssim')
+
+    assert not limited['success'] and limited['error_code'] == 'INPUT_TOO_LARGE'
+    assert limited['input_limits'] == {'max_pixels': 1_000_000, 'width': 1200, 'height': 900}
+    assert accepted['success'] and accepted['score'] > 0.9
+
+
+def test_byte_budget_is_enforced(reference_bytes):
+    result = ImageComparator(max_bytes=len(reference_bytes) - 1).compare_images(reference_bytes, reference_bytes)
+
+    assert not result['success'] and result['error_code'] == 'INPUT_TOO_LARGE'
+
+
+def test_pdf_dpi_cap_only_applies_with_a_pixel_budget():
+    pdf_to_image = pytest.importorskip('pdf_to_image')
+    converter = pdf_to_image.PDFToImageConverter()
+    converter.dpi = 1200
+    pdf = b'%PDF-1.4\n%%EOF\n'
+
+    converter.max_pixels = None
+    assert converter._plan_dpi(pdf_bytes=pdf) == (1200, 1.0)
+
+    converter.max_pixels = 24_000_000
+    dpi, _ = converter._plan_dpi(pdf_bytes=pdf)
+    assert dpi <= pdf_to_image.MAX_PDF_DPI
+
+
+def test_pdf_byte_budget_is_enforced():
+    pdf_to_image = pytest.importorskip('pdf_to_image')
+    converter = pdf_to_image.PDFToImageConverter()
+    converter.max_bytes = 10
+
+    with pytest.raises(pdf_to_image.PDFTooLarge):
+        converter._plan_dpi(pdf_bytes=b'%PDF-1.4\n%%EOF\n')
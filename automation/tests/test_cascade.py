@@ -0,0 +1,74 @@
+"""Comparação em cascata: reprovação antecipada e veredito do método final"""
+
+import cv2
+import pytest
+
+from automation_worker import RequestHandler
+from conftest import b64, encode, remove_box
+from image_comparison import ImageComparator
+
+BARCODE_BOX = (30, 480, 760, 960)
+
+
+@pytest.fixture(scope='module')
+def comparator():
+    return ImageComparator()
+
+
+def test_inverted_label_is_rejected_by_phash(comparator, reference_bytes, label):
+    result = comparator.compare_cascade(reference_bytes, encode(255 - label), 0.8)
+
+    assert result['decided_by'] == 'phash'
+    assert [stage['stage'] for stage in result['stages']] == ['phash']
+    assert result['score'] == 0.0 and not result['approved']
+
+
+def test_misplaced_label_is_rejected_by_coarse_ssim(comparator, reference_bytes, label):
+    result = comparator.compare_cascade(reference_bytes, encode(cv2.flip(label, -1)), 0.8)
+
+    assert result['decided_by'] == 'ssim_coarse'
+    assert result['score'] == 0.0 and not result['approved']
+
+
+@pytest.mark.parametrize('threshold', [0.7, 0.75, 0.8, 0.85])
+def test_borderline_label_is_decided_by_the_final_method(comparator, reference_bytes, label, threshold):
+    # Sem o código de barras a etiqueta passa pelos cortes antecipados;
+    # o veredito e o score são os do SSIM completo, no limite da pergunta
+    test = encode(remove_box(label, BARCODE_BOX))
+    expected = comparator.compare_images(reference_bytes, test, 'ssim')['score']
+
+    result = comparator.compare_cascade(reference_bytes, test, threshold)
+
+    assert result['decided_by'] == 'ssim'
+    assert result['score'] == expected
+    assert result['approved'] == (expected >= threshold)
+
+
+def test_orb_final_method_skips_coarse_ssim(comparator, reference_bytes, label):
+    result = comparator.compare_cascade(reference_bytes, encode(cv2.flip(label, 1)), 0.8, final_method='orb')
+
+    assert [stage['stage'] for stage in result['stages']] == ['phash', 'orb']
+    assert result['decided_by'] == 'orb'
+
+
+def test_cutoffs_override_enables_early_accept(comparator, reference_bytes):
+    result = comparator.compare_cascade(reference_bytes, reference_bytes, 0.8, cutoffs={'phash': (None, 4)})
+
+    assert result['decided_by'] == 'phash'
+    assert result['score'] == 1.0 and result['approved']
+
+
+def test_unknown_final_method_is_an_error(comparator, reference_bytes):
+    result = comparator.compare_cascade(reference_bytes, reference_bytes, 0.8, final_method='histogram')
+
+    assert not result['success'] and not result['approved']
+
+
+def test_worker_passes_cutoffs(reference_bytes):
+    response = RequestHandler().handle({'op': 'compare_cascade', 'params': {
+        'reference_b64': b64(reference_bytes), 'test_b64': b64(reference_bytes), 'threshold': 0.8,
+        'cutoffs': {'phash': [None, 4]}
+    }})
+
+    assert response['ok']
+    assert response['result']['decided_by'] == 'phash' and response['result']['approved']
@@ -0,0 +1,49 @@
+"""Método color e a trava de cor em compare_multiple_methods"""
+
+import pytest
+
+from benchmark_image_comparison import perturb
+from conftest import encode
+from image_comparison import ImageComparator
+
+
+@pytest.fixture(scope='module')
+def comparator():
+    return ImageComparator()
+
+
+def test_recolored_label_fails_on_color(comparator, reference_bytes, label):
+    # Vermelho e azul trocados: a estrutura é idêntica, a cor não
+    recolored = label[..., ::-1].copy()
+    result = comparator.compare_multiple_methods(reference_bytes, encode(recolored))
+
+    structural = max(result['all_results'][method]['score'] for method in ('ssim', 'orb', 'template'))
+    assert structural > 0.95
+    assert result['best_method'] == 'color'
+    assert result['best_score'] == result['all_results']['color']['score'] < 0.6
+
+
+def test_brightness_change_keeps_color_score(comparator, reference_bytes, label):
+    result = comparator.compare_multiple_methods(reference_bytes, encode(perturb(label, 'brightness')))
+
+    assert result['all_results']['color']['score'] > 0.9
+    assert result['best_score'] > 0.9
+
+
+def test_identical_label_keeps_structural_best(comparator, reference_bytes):
+    result = comparator.compare_multiple_methods(reference_bytes, reference_bytes)
+
+    assert result['best_method'] in ('ssim', 'orb', 'template')
+    assert result['best_score'] == 1.0
+
+
+def test_color_regions_locate_the_recolored_logo(comparator, reference_bytes, label):
+    # Logotipo verde (0, 120, 0) pintado de vermelho; o resto da etiqueta não muda
+    recolored = label.copy()
+    logo = recolored[480:780, 820:1100]
+    logo[(logo == (0, 120, 0)).all(axis=2)] = (0, 0, 200)
+    result = comparator.compare_images(reference_bytes, encode(recolored), 'color')
+
+    assert result['success']
+    worst = max(result['color_regions'], key=lambda region: region['delta_e'])
+    assert 820 - worst['width'] < worst['x'] < 1100 and 480 - worst['height'] < worst['y'] < 780
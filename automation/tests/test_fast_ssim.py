@@ -0,0 +1,40 @@
+"""Engine rápido de SSIM (float32 com filtros do OpenCV) contra o skimage"""
+
+import cv2
+import pytest
+from skimage.metrics import structural_similarity
+
+from benchmark_image_comparison import perturb
+from conftest import encode
+from image_comparison import FAST_SSIM_MODES, FAST_SSIM_TOLERANCE, ImageComparator, fast_ssim, ssim_map
+
+
+@pytest.fixture(scope='module')
+def grays(label):
+    reference = cv2.cvtColor(label, cv2.COLOR_BGR2GRAY)
+    return reference, cv2.cvtColor(perturb(label, 'noise', seed=1), cv2.COLOR_BGR2GRAY)
+
+
+@pytest.mark.parametrize('mode', FAST_SSIM_MODES)
+def test_fast_ssim_matches_skimage(grays, mode):
+    reference, test = grays
+    if mode == 'gaussian':
+        expected = structural_similarity(reference, test, gaussian_weights=True, sigma=1.5)
+    else:
+        expected = float(ssim_map(reference, test, engine='skimage').mean())
+
+    assert abs(fast_ssim(reference, test, mode) - expected) < FAST_SSIM_TOLERANCE
+
+
+def test_fast_engine_scores_like_skimage(reference_bytes, label):
+    test = encode(perturb(label, 'noise', seed=1))
+
+    fast = ImageComparator(ssim_engine='fast').compare_images(reference_bytes, test, 'ssim')
+    reference = ImageComparator().compare_images(reference_bytes, test, 'ssim')
+
+    assert fast['score'] == pytest.approx(reference['score'], abs=FAST_SSIM_TOLERANCE)
+
+
+def test_unknown_engine_is_rejected():
+    with pytest.raises(ValueError):
+        ImageComparator(ssim_engine='gpu')
@@ -0,0 +1,51 @@
+"""Cache de features das referências: memória, disco e orçamento de bytes"""
+
+import pytest
+
+from benchmark_image_comparison import perturb
+from conftest import encode
+from image_comparison import ImageComparator, ReferenceFeatureStore
+
+
+@pytest.fixture(scope='module')
+def test_bytes(label):
+    return encode(perturb(label, 'noise', seed=1))
+
+
+def test_reference_is_prepared_once(reference_bytes, test_bytes):
+    store = ReferenceFeatureStore()
+    comparator = ImageComparator(feature_store=store)
+
+    first = comparator.compare_images(reference_bytes, test_bytes, 'orb', instrument=True)
+    again = comparator.compare_images(reference_bytes, test_bytes, 'orb', instrument=True)
+
+    assert not first['instrumentation']['reference_cache_hit']
+    assert again['instrumentation']['reference_cache_hit']
+    assert 'decode_reference' not in again['instrumentation']['stages']
+    assert again['score'] == first['score']
+    assert store.stats()['memory_hits'] == 1
+
+
+def test_feature_store_reloads_from_disk(tmp_path, reference_bytes, test_bytes):
+    cache_dir = str(tmp_path / 'features')
+    expected = ImageComparator(feature_store=ReferenceFeatureStore(cache_dir=cache_dir)).compare_images(
+        reference_bytes, test_bytes, 'orb'
+    )
+
+    store = ReferenceFeatureStore(cache_dir=cache_dir)
+    result = ImageComparator(feature_store=store).compare_images(reference_bytes, test_bytes, 'orb',
+                                                                 instrument=True)
+
+    assert result['instrumentation']['reference_cache_hit']
+    assert result['score'] == expected['score']
+    assert store.stats()['disk_hits'] == 1
+
+
+def test_memory_budget_is_respected(reference_bytes, label):
+    store = ReferenceFeatureStore(max_bytes=1)
+    comparator = ImageComparator(feature_store=store)
+
+    comparator.prepare_reference(reference_bytes)
+    comparator.prepare_reference(encode(perturb(label, 'blur')))
+
+    assert store.stats()['entries'] == 0 and store.stats()['bytes'] == 0
@@ -0,0 +1,52 @@
+"""Entradas por caminho ou bytes e leitura de blocos binários com prefixo de tamanho"""
+
+import io
+import os
+import struct
+import subprocess
+import sys
+
+import pytest
+
+from framing import read_length_prefixed
+from image_comparison import ImageComparator
+
+AUTOMATION = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def framed(*payloads: bytes) -> bytes:
+    return b''.join(struct.pack('>I', len(payload)) + payload for payload in payloads)
+
+
+def test_read_length_prefixed_round_trip():
+    assert read_length_prefixed(io.BytesIO(framed(b'abc', b'', b'de'))) == [b'abc', b'', b'de']
+
+
+@pytest.mark.parametrize('data', [framed(b'abc')[:2], framed(b'abc')[:-1]])
+def test_read_length_prefixed_rejects_truncated_input(data):
+    with pytest.raises(ValueError):
+        read_length_prefixed(io.BytesIO(data))
+
+
+def test_pdf_converter_does_not_load_opencv():
+    # O conversor de PDF só precisa do framing; OpenCV e scikit-image são caros de importar
+    code = "import sys, pdf_to_image; print(sorted({'cv2', 'skimage'} & set(sys.modules)))"
+
+    completed = subprocess.run([sys.executable, '-c', code], cwd=AUTOMATION, capture_output=True, text=True,
+                               timeout=60)
+
+    assert completed.stdout.strip() == '[]'
+
+
+def test_bytes_and_path_inputs_give_the_same_result(tmp_path, reference_bytes, photo_bytes):
+    reference_path, photo_path = tmp_path / 'reference.png', tmp_path / 'photo.jpg'
+    reference_path.write_bytes(reference_bytes)
+    photo_path.write_bytes(photo_bytes)
+    comparator = ImageComparator()
+
+    from_bytes = comparator.compare_images(reference_bytes, photo_bytes, 'template')
+    from_paths = comparator.compare_images(str(reference_path), str(photo_path), 'template')
+
+    assert from_bytes['score'] == from_paths['score']
+    assert from_paths['test_image'] == str(photo_path)
+    assert from_bytes['test_image'] == f'<{len(photo_bytes)} bytes>'
@@ -0,0 +1,17 @@
+"""Tempos por estágio e metadados da comparação (instrument)"""
+
+from image_comparison import ImageComparator
+
+
+def test_instrumentation_reports_stages(reference_bytes, photo_bytes):
+    result = ImageComparator().compare_images(reference_bytes, photo_bytes, 'ssim', instrument=True)
+    report = result['instrumentation']
+
+    assert {'read_reference', 'decode_reference', 'decode_test', 'ssim'} <= set(report['stages'])
+    assert all(entry['wall_ms'] >= 0 for entry in report['stages'].values())
+    assert report['image_dimensions']['reference'] == [1200, 900]
+    assert report['bytes_decoded'] == {'reference': len(reference_bytes), 'test': len(photo_bytes)}
+
+
+def test_instrumentation_is_off_by_default(reference_bytes):
+    assert 'instrumentation' not in ImageComparator().compare_images(reference_bytes, reference_bytes)
@@ -0,0 +1,55 @@
+"""Localização da etiqueta na foto (--localize)"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+from conftest import photograph, rotated_jpeg
+from image_comparison import ImageComparator
+
+# Cantos da etiqueta em photograph() (1600x1200)
+PHOTO_CORNERS = np.float32([[260, 180], [1330, 230], [1300, 1020], [230, 960]])
+
+
+def _localized(reference_bytes, photo_bytes):
+    return ImageComparator(localize=True).compare_images(reference_bytes, photo_bytes, 'ssim')
+
+
+def test_localizes_label_by_homography(reference_bytes, photo_bytes):
+    result = _localized(reference_bytes, photo_bytes)
+
+    assert result['success']
+    assert result['localization']['method'] == 'homography'
+    # Recortada na geometria da referência, a etiqueta volta a ser quase idêntica
+    assert result['score'] > 0.85
+
+
+def test_localization_is_deterministic_across_runs(reference_bytes, photo_bytes):
+    first = _localized(reference_bytes, photo_bytes)
+    for _ in range(4):
+        again = _localized(reference_bytes, photo_bytes)
+        assert again['score'] == first['score']
+        assert again['localization'] == first['localization']
+
+
+def test_localization_is_deterministic_across_threads(reference_bytes, photo_bytes):
+    comparator = ImageComparator(localize=True)
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        results = list(executor.map(lambda _: comparator.compare_images(reference_bytes, photo_bytes, 'ssim'),
+                                    range(8)))
+
+    assert len({result['score'] for result in results}) == 1
+    assert len({str(result['localization']) for result in results}) == 1
+
+
+def test_corners_follow_exif_orientation(reference_bytes, label):
+    # Gravada 4000x3000 com orientação 6: exibida (e decodificada) 3000x4000
+    stored = cv2.resize(photograph(label), (4000, 3000), interpolation=cv2.INTER_LINEAR)
+    result = _localized(reference_bytes, rotated_jpeg(stored, 6))
+
+    # Girar 90° no sentido horário: (x, y) -> (altura - 1 - y, x)
+    scaled = PHOTO_CORNERS * 2.5
+    expected = np.stack([3000 - 1 - scaled[:, 1], scaled[:, 0]], axis=1)
+    assert result['localization']['method'] == 'homography'
+    assert np.abs(np.float32(result['localization']['corners']) - expected).max() < 10
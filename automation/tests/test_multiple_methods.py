@@ -0,0 +1,55 @@
+"""compare_multiple_methods: decodificação única, métodos em paralelo e prazo"""
+
+from benchmark_image_comparison import perturb
+from conftest import encode
+from image_comparison import ImageComparator
+
+
+def test_every_method_is_reported(reference_bytes, photo_bytes):
+    result = ImageComparator().compare_multiple_methods(reference_bytes, photo_bytes)
+
+    assert set(result['all_results']) == {'ssim', 'orb', 'template', 'color'}
+    assert all(item['success'] for item in result['all_results'].values())
+    assert result['best_score'] == result['all_results'][result['best_method']]['score']
+
+
+def test_images_are_decoded_once(reference_bytes, photo_bytes):
+    result = ImageComparator().compare_multiple_methods(reference_bytes, photo_bytes, instrument=True)
+    report = result['instrumentation']
+
+    assert report['bytes_decoded'] == {'reference': len(reference_bytes), 'test': len(photo_bytes)}
+    assert {'decode_reference', 'decode_test', 'ssim', 'orb', 'template', 'color'} <= set(report['stages'])
+
+
+def test_scores_match_single_method_calls(reference_bytes, label):
+    test = encode(perturb(label, 'noise', seed=1))
+    comparator = ImageComparator()
+
+    result = comparator.compare_multiple_methods(reference_bytes, test)
+
+    for method in ('ssim', 'orb', 'template'):
+        assert result['all_results'][method]['score'] == comparator.compare_images(reference_bytes, test,
+                                                                                   method)['score']
+
+
+def test_all_methods_are_repeatable(reference_bytes, photo_bytes):
+    first = ImageComparator().compare_multiple_methods(reference_bytes, photo_bytes)
+    again = ImageComparator().compare_multiple_methods(reference_bytes, photo_bytes)
+
+    assert first['best_method'] == again['best_method']
+    assert ({method: result['score'] for method, result in first['all_results'].items()}
+            == {method: result['score'] for method, result in again['all_results'].items()})
+
+
+def test_deadline_reports_unfinished_methods(reference_bytes, photo_bytes):
+    result = ImageComparator().compare_multiple_methods(reference_bytes, photo_bytes, deadline=1e-6)
+
+    assert result['deadline_exceeded']
+    assert any(item.get('timed_out') for item in result['all_results'].values())
+
+
+def test_unreadable_test_image_fails_every_method(reference_bytes):
+    result = ImageComparator().compare_multiple_methods(reference_bytes, b'not an image')
+
+    assert not result['success']
+    assert not any(item['success'] for item in result['all_results'].values())
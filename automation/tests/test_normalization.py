@@ -0,0 +1,46 @@
+"""Normalização de iluminação (CLAHE) e alinhamento ECC antes da comparação"""
+
+import cv2
+import numpy as np
+import pytest
+
+from conftest import encode
+from image_comparison import ComparisonResultCache, IlluminationNormalizer, ImageComparator
+
+
+@pytest.fixture(scope='module')
+def factory_photo(label):
+    # Luz caindo da direita para a esquerda e a etiqueta levemente deslocada
+    gradient = np.linspace(0.45, 1.0, label.shape[1])[None, :, None]
+    lit = np.clip(label * gradient, 0, 255).astype(np.uint8)
+    shift = np.float32([[1, 0, 12], [0, 1, -8]])
+    return encode(cv2.warpAffine(lit, shift, (label.shape[1], label.shape[0]), borderMode=cv2.BORDER_REPLICATE))
+
+
+def test_normalization_recovers_lighting_and_offset(reference_bytes, factory_photo):
+    plain = ImageComparator().compare_images(reference_bytes, factory_photo, 'ssim')
+    normalized = ImageComparator(normalizer=IlluminationNormalizer()).compare_images(
+        reference_bytes, factory_photo, 'ssim'
+    )
+
+    assert normalized['alignment']['aligned']
+    assert normalized['alignment']['translation'] == pytest.approx([12, -8], abs=1)
+    assert normalized['score'] > plain['score'] + 0.2
+
+
+def test_aligned_photo_is_left_untouched(reference_bytes):
+    result = ImageComparator(normalizer=IlluminationNormalizer()).compare_images(reference_bytes, reference_bytes,
+                                                                                 'ssim')
+
+    assert not result['alignment']['aligned']
+    assert result['score'] == 1.0
+
+
+def test_normalizer_is_part_of_the_cache_key(reference_bytes, factory_photo):
+    cache = ComparisonResultCache()
+    ImageComparator(result_cache=cache).compare_images(reference_bytes, factory_photo, 'ssim')
+    result = ImageComparator(result_cache=cache, normalizer=IlluminationNormalizer()).compare_images(
+        reference_bytes, factory_photo, 'ssim'
+    )
+
+    assert 'cached' not in result
@@ -0,0 +1,27 @@
+"""Scores reprodutíveis: o mesmo par de imagens sempre tem o mesmo score"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from image_comparison import ImageComparator, OrbMatcher
+
+
+@pytest.mark.parametrize('verify_geometry', [False, True])
+def test_orb_score_is_identical_across_comparators(reference_bytes, photo_bytes, verify_geometry):
+    scores = {
+        ImageComparator(orb_matcher=OrbMatcher(verify_geometry=verify_geometry))
+        .compare_images(reference_bytes, photo_bytes, 'orb')['score']
+        for _ in range(5)
+    }
+
+    assert len(scores) == 1
+
+
+def test_orb_score_is_identical_across_threads(reference_bytes, photo_bytes):
+    comparator = ImageComparator(orb_matcher=OrbMatcher(verify_geometry=True))
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        results = list(executor.map(lambda _: comparator.compare_images(reference_bytes, photo_bytes, 'orb'),
+                                    range(8)))
+
+    assert len({result['score'] for result in results}) == 1
@@ -0,0 +1,53 @@
+"""Resolução de trabalho e SSIM do nível grosseiro para o fino da pirâmide"""
+
+from benchmark_image_comparison import perturb
+from conftest import encode
+from image_comparison import ImageComparator
+
+
+def test_coarse_levels_do_not_approve_a_blurred_photo(reference_bytes, label):
+    # O desfoque some nos níveis grosseiros (SSIM ~1) e só aparece na resolução de trabalho
+    result = ImageComparator().compare_images(reference_bytes, encode(perturb(label, 'blur')), 'ssim',
+                                              threshold=0.95)
+
+    assert result['ssim_level'] == 0
+    assert result['ssim_level_scores'][max(result['ssim_level_scores'])] > 0.95
+    assert result['score'] < 0.95
+
+
+def test_coarse_levels_reject_early(reference_bytes, label):
+    result = ImageComparator().compare_images(reference_bytes, encode(perturb(label, 'rotation')), 'ssim',
+                                              threshold=0.9)
+
+    assert result['ssim_level'] > 0
+    assert result['score'] < 0.9 - ImageComparator().ssim_margin
+
+
+def test_coarse_levels_are_skipped_when_they_cannot_reject(reference_bytes, label):
+    comparator = ImageComparator()
+    result = comparator.compare_images(reference_bytes, encode(perturb(label, 'rotation')), 'ssim',
+                                       threshold=comparator.ssim_margin)
+
+    assert 'ssim_level' not in result
+
+
+def test_threshold_does_not_change_an_approved_score(reference_bytes, label):
+    test = encode(perturb(label, 'brightness'))
+    comparator = ImageComparator()
+
+    plain = comparator.compare_images(reference_bytes, test, 'ssim')
+    with_threshold = comparator.compare_images(reference_bytes, test, 'ssim', threshold=0.9)
+
+    assert with_threshold['ssim_level'] == 0
+    assert with_threshold['score'] == plain['score']
+
+
+def test_working_resolution_bounds_both_images(reference_bytes, photo_bytes):
+    result = ImageComparator(working_pixels=250_000).compare_images(reference_bytes, photo_bytes, 'ssim',
+                                                                    instrument=True)
+
+    dimensions = result['instrumentation']['image_dimensions']
+    for name in ('reference_working', 'test_working'):
+        width, height = dimensions[name]
+        assert width * height <= 250_000
+    assert dimensions['reference'] == [1200, 900]
@@ -0,0 +1,34 @@
+"""Verificação rápida de qualidade da foto antes da comparação"""
+
+import cv2
+import numpy as np
+import pytest
+
+from conftest import encode
+from image_comparison import ImageComparator, QualityGate
+
+
+@pytest.mark.parametrize('damage, reason', [
+    (lambda label: cv2.GaussianBlur(label, (31, 31), 0), 'BLURRY'),
+    (lambda label: (label * 0.1).astype(np.uint8), 'UNDEREXPOSED'),
+    (lambda label: cv2.resize(label, (400, 300)), 'RESOLUTION_TOO_LOW'),
+    (lambda label: np.full_like(label, 128), 'LOW_CONTRAST')
+])
+def test_quality_gate_rejects_bad_photos(reference_bytes, label, damage, reason):
+    result = ImageComparator(quality_gate=QualityGate()).compare_images(reference_bytes, encode(damage(label)))
+
+    assert not result['success']
+    assert result['error_code'] == 'QUALITY_REJECTED'
+    assert reason in result['quality']['reasons']
+
+
+def test_quality_gate_accepts_a_good_photo(reference_bytes, photo_bytes):
+    comparator = ImageComparator(quality_gate=QualityGate())
+
+    assert comparator.check_quality(photo_bytes)['passed']
+    assert comparator.compare_images(reference_bytes, photo_bytes)['success']
+
+
+def test_quality_thresholds_are_validated():
+    with pytest.raises(ValueError):
+        QualityGate(min_focus=10)
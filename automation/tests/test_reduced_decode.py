@@ -0,0 +1,37 @@
+"""Decodificação reduzida de JPEGs grandes direto em cinza"""
+
+import cv2
+import pytest
+
+from conftest import encode
+from image_comparison import ImageComparator
+
+
+@pytest.fixture(scope='module')
+def large_label(label):
+    return cv2.resize(label, (4800, 3600), interpolation=cv2.INTER_NEAREST)
+
+
+def test_large_jpeg_is_decoded_at_the_working_size(reference_bytes, large_label):
+    comparator = ImageComparator(working_pixels=1_000_000)
+    result = comparator.compare_images(reference_bytes, encode(large_label, '.jpg'), 'ssim', instrument=True)
+
+    # O maior fator (1/4) que ainda entrega pelo menos working_pixels
+    assert result['instrumentation']['image_dimensions']['test'] == [1200, 900]
+    assert result['score'] > 0.9
+
+
+def test_png_is_decoded_at_full_size(reference_bytes, large_label):
+    comparator = ImageComparator(working_pixels=1_000_000)
+    result = comparator.compare_images(reference_bytes, encode(large_label), 'ssim', instrument=True)
+
+    assert result['instrumentation']['image_dimensions']['test'] == [4800, 3600]
+
+
+def test_reduced_decode_scores_like_a_full_decode(reference_bytes, large_label):
+    photo = encode(large_label, '.jpg')
+    reduced = ImageComparator(working_pixels=1_000_000).compare_images(reference_bytes, photo, 'ssim')
+    full = ImageComparator(working_pixels=1_000_000, max_pixels=None)
+    full._decode_reduction = lambda data: 1
+
+    assert reduced['score'] == pytest.approx(full.compare_images(reference_bytes, photo, 'ssim')['score'], abs=0.03)
@@ -0,0 +1,78 @@
+"""Índice de referências: a etiqueta certa para uma foto, persistido entre processos"""
+
+import cv2
+import numpy as np
+import pytest
+
+from automation_worker import RequestHandler
+from benchmark_image_comparison import perturb
+from conftest import b64, encode, photograph
+from image_comparison import ImageComparator, ReferenceIndex
+
+
+@pytest.fixture(scope='module')
+def references(label, reference_bytes):
+    rng = np.random.default_rng(3)
+    blobs = np.full(label.shape, 255, dtype=np.uint8)
+    for _ in range(60):
+        center = (int(rng.integers(0, 1200)), int(rng.integers(0, 900)))
+        color = tuple(int(value) for value in rng.integers(0, 200, 3))
+        cv2.circle(blobs, center, int(rng.integers(10, 80)), color, -1)
+    return {'label': reference_bytes, 'flipped': encode(cv2.flip(label, 0)), 'blobs': encode(blobs)}
+
+
+@pytest.fixture
+def index_path(tmp_path, references):
+    path = str(tmp_path / 'references.npz')
+    index = ReferenceIndex(ImageComparator(), path)
+    for reference_id, data in references.items():
+        index.add(reference_id, data)
+    return path
+
+
+@pytest.mark.parametrize('kind', ['photo', 'noise'])
+def test_finds_the_photographed_label(index_path, label, kind):
+    photo = encode(photograph(label), '.jpg') if kind == 'photo' else encode(perturb(label, 'noise'))
+    matches = ReferenceIndex(ImageComparator(), index_path).find_best_references(photo, k=3)
+
+    assert [match['id'] for match in matches][0] == 'label'
+    assert matches[0]['score'] > matches[1]['score'] >= matches[2]['score']
+
+
+def test_changes_are_seen_by_other_instances(index_path, reference_bytes):
+    index = ReferenceIndex(ImageComparator(), index_path)
+    other = ReferenceIndex(ImageComparator(), index_path)
+
+    assert other.remove('label')
+    assert len(index) == 2
+    assert index.find_best_references(reference_bytes, k=1)[0]['id'] != 'label'
+
+
+def test_empty_index_has_no_matches(reference_bytes):
+    assert ReferenceIndex(ImageComparator()).find_best_references(reference_bytes) == []
+
+
+def test_worker_rebuild_indexes_existing_references(tmp_path, references, label):
+    # Referências cadastradas antes do índice existir, enviadas em lotes pelo servidor
+    handler = RequestHandler({'reference_index': str(tmp_path / 'references.npz')})
+    items = [{'id': reference_id, 'reference_b64': b64(data)} for reference_id, data in references.items()]
+
+    first = handler.handle({'op': 'index_rebuild', 'params': {'references': items[:2]}})
+    second = handler.handle({'op': 'index_rebuild', 'params': {'references': items[2:] + [
+        {'id': 'broken', 'reference_b64': b64(b'not an image')}
+    ]}})
+
+    assert first['result'] == {'indexed': 2, 'failed': [], 'size': 2}
+    assert second['result'] == {'indexed': 1, 'failed': ['broken'], 'size': 3}
+    matches = ReferenceIndex(ImageComparator(), str(tmp_path / 'references.npz')).find_best_references(
+        encode(perturb(label, 'noise')), k=1
+    )
+    assert matches[0]['id'] == 'label'
+
+
+def test_rebuild_with_reset_drops_references_missing_from_the_list(index_path, references):
+    index = ReferenceIndex(ImageComparator(), index_path)
+
+    result = index.rebuild([('label', references['label'])], reset=True)
+
+    assert result['size'] == 1 and len(ReferenceIndex(ImageComparator(), index_path)) == 1
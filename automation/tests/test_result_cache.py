@@ -0,0 +1,86 @@
+"""Cache de resultados: chaves por conteúdo e pelos parâmetros que afetam o score"""
+
+import pytest
+
+from automation_worker import RequestHandler
+from benchmark_image_comparison import perturb
+from conftest import b64, encode
+from image_comparison import ComparisonResultCache, ImageComparator, OrbMatcher
+
+ROI = [{'x': 0.0, 'y': 0.0, 'width': 0.5, 'height': 0.5}]
+
+
+@pytest.fixture(scope='module')
+def test_bytes(label):
+    return encode(perturb(label, 'noise', seed=1))
+
+
+def test_repeated_comparison_is_cached(reference_bytes, test_bytes):
+    comparator = ImageComparator(result_cache=ComparisonResultCache())
+
+    first = comparator.compare_images(reference_bytes, test_bytes, 'ssim')
+    again = comparator.compare_images(reference_bytes, test_bytes, 'ssim')
+
+    assert 'cached' not in first
+    assert again['cached'] and again['score'] == first['score']
+
+
+@pytest.mark.parametrize('changed', [{'method': 'template'}, {'threshold': 0.9}, {'rois': ROI}])
+def test_call_parameters_are_part_of_the_key(reference_bytes, test_bytes, changed):
+    comparator = ImageComparator(result_cache=ComparisonResultCache())
+    comparator.compare_images(reference_bytes, test_bytes, 'ssim')
+
+    arguments = {'method': 'ssim', **changed}
+    result = comparator.compare_images(reference_bytes, test_bytes, arguments.pop('method'), **arguments)
+
+    assert 'cached' not in result
+
+
+def test_orb_ratio_is_part_of_the_shared_key(tmp_path, reference_bytes, photo_bytes):
+    # Dois workers com o mesmo banco SQLite e ratios diferentes não podem trocar scores
+    db_path = str(tmp_path / 'results.db')
+    default = ImageComparator(result_cache=ComparisonResultCache(db_path=db_path))
+    strict = ImageComparator(result_cache=ComparisonResultCache(db_path=db_path),
+                             orb_matcher=OrbMatcher(ratio=0.7))
+
+    first = default.compare_images(reference_bytes, photo_bytes, 'orb')
+    other = strict.compare_images(reference_bytes, photo_bytes, 'orb')
+    shared = ImageComparator(result_cache=ComparisonResultCache(db_path=db_path)).compare_images(
+        reference_bytes, photo_bytes, 'orb'
+    )
+
+    assert 'cached' not in other and other['score'] != first['score']
+    assert shared['cached'] and shared['score'] == first['score']
+
+
+def test_pixel_budget_applies_to_cached_results(tmp_path, reference_bytes, test_bytes):
+    db_path = str(tmp_path / 'results.db')
+    ImageComparator(result_cache=ComparisonResultCache(db_path=db_path)).compare_images(
+        reference_bytes, test_bytes, 'ssim'
+    )
+
+    result = ImageComparator(result_cache=ComparisonResultCache(db_path=db_path),
+                             max_pixels=100_000).compare_images(reference_bytes, test_bytes, 'ssim')
+
+    assert not result['success'] and result['error_code'] == 'INPUT_TOO_LARGE'
+    assert 'cached' not in result
+
+
+def test_expired_entries_are_recomputed(reference_bytes, test_bytes):
+    comparator = ImageComparator(result_cache=ComparisonResultCache(ttl=0))
+
+    comparator.compare_images(reference_bytes, test_bytes, 'ssim')
+    result = comparator.compare_images(reference_bytes, test_bytes, 'ssim')
+
+    assert 'cached' not in result
+
+
+def test_worker_retry_is_served_from_the_cache(reference_bytes, test_bytes):
+    handler = RequestHandler()
+    params = {'reference_b64': b64(reference_bytes), 'test_b64': b64(test_bytes), 'method': 'ssim'}
+
+    first = handler.handle({'op': 'compare', 'params': params})
+    again = handler.handle({'op': 'compare', 'params': params})
+
+    assert again['result']['cached'] and again['result']['score'] == first['result']['score']
+    assert handler.handle({'op': 'stats'})['result']['result_cache']['memory_hits'] == 1
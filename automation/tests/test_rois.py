@@ -0,0 +1,55 @@
+"""Regiões de interesse com pesos por referência"""
+
+import pytest
+
+from benchmark_image_comparison import perturb
+from conftest import encode
+from image_comparison import ImageComparator, ReferenceFeatureStore, normalize_rois
+
+LOWER_HALF = [{'name': 'codigo', 'x': 0.0, 'y': 0.5, 'width': 1.0, 'height': 0.5, 'weight': 2}]
+
+
+def test_rois_must_be_fractions():
+    with pytest.raises(ValueError):
+        normalize_rois([{'x': 10, 'y': 10, 'width': 200, 'height': 100}])
+    with pytest.raises(ValueError):
+        normalize_rois([{'x': 0, 'y': 0, 'width': 0.5, 'height': 0.5, 'weight': 0}])
+
+
+def test_rois_ignore_defects_outside_them(reference_bytes, label):
+    comparator = ImageComparator()
+    # O defeito de perturb fica na metade de cima da etiqueta
+    damaged = encode(perturb(label, 'defect'))
+
+    whole = comparator.compare_images(reference_bytes, damaged, 'ssim')
+    lower = comparator.compare_images(reference_bytes, damaged, 'ssim', rois=LOWER_HALF)
+
+    assert lower['score'] == 1.0 > whole['score']
+
+
+def test_per_call_rois_do_not_replace_the_stored_ones(reference_bytes, label):
+    comparator = ImageComparator()
+    damaged = encode(perturb(label, 'defect'))
+    upper_half = [{'x': 0.0, 'y': 0.0, 'width': 1.0, 'height': 0.5}]
+    comparator.set_reference_rois(reference_bytes, LOWER_HALF)
+
+    per_call = comparator.compare_images(reference_bytes, damaged, 'ssim', rois=upper_half)
+    stored = comparator.compare_images(reference_bytes, damaged, 'ssim')
+    all_methods = comparator.compare_multiple_methods(reference_bytes, damaged, rois=upper_half)
+
+    assert per_call['score'] < 1.0 and all_methods['all_results']['ssim']['score'] == per_call['score']
+    assert stored['score'] == 1.0
+    assert comparator.compare_images(reference_bytes, damaged, 'ssim')['score'] == 1.0
+
+
+def test_stored_rois_are_shared_through_the_feature_cache(tmp_path, reference_bytes, label):
+    cache_dir = str(tmp_path / 'features')
+    writer = ImageComparator(feature_store=ReferenceFeatureStore(cache_dir=cache_dir))
+    reader = ImageComparator(feature_store=ReferenceFeatureStore(cache_dir=cache_dir))
+    damaged = encode(perturb(label, 'defect'))
+
+    writer.set_reference_rois(reference_bytes, LOWER_HALF)
+    assert reader.compare_images(reference_bytes, damaged, 'ssim')['score'] == 1.0
+
+    writer.set_reference_rois(reference_bytes, None)
+    assert reader.compare_images(reference_bytes, damaged, 'ssim')['score'] < 1.0
@@ -0,0 +1,41 @@
+"""Deduplicação de fotos quase idênticas dentro de uma sessão de inspeção"""
+
+from benchmark_image_comparison import perturb
+from conftest import encode
+from image_comparison import ImageComparator, SessionDedup
+
+
+def test_near_identical_photo_reuses_the_session_score(reference_bytes, label):
+    comparator = ImageComparator(session_dedup=SessionDedup())
+    first = comparator.compare_images(reference_bytes, encode(perturb(label, 'noise', seed=1), '.jpg'),
+                                      session_id='inspecao-1', photo_id='foto-1')
+    retry = comparator.compare_images(reference_bytes, encode(perturb(label, 'noise', seed=2), '.jpg'),
+                                      session_id='inspecao-1', photo_id='foto-2')
+
+    assert retry['duplicate_of'] == 'foto-1' and retry['photo_id'] == 'foto-2'
+    assert retry['score'] == first['score']
+
+
+def test_dedup_is_scoped_to_session_and_content(reference_bytes, label):
+    comparator = ImageComparator(session_dedup=SessionDedup())
+    photo = encode(perturb(label, 'noise', seed=1), '.jpg')
+    comparator.compare_images(reference_bytes, photo, session_id='inspecao-1')
+
+    other_session = comparator.compare_images(reference_bytes, photo, session_id='inspecao-2')
+    other_photo = comparator.compare_images(reference_bytes, encode(perturb(label, 'rotation'), '.jpg'),
+                                            session_id='inspecao-1')
+    other_method = comparator.compare_images(reference_bytes, photo, 'template', session_id='inspecao-1')
+
+    assert 'duplicate_of' not in other_session
+    assert 'duplicate_of' not in other_photo
+    assert 'duplicate_of' not in other_method
+
+
+def test_ended_session_is_forgotten(reference_bytes):
+    dedup = SessionDedup()
+    comparator = ImageComparator(session_dedup=dedup)
+    comparator.compare_images(reference_bytes, reference_bytes, session_id='inspecao-1')
+
+    assert dedup.forget('inspecao-1')
+    assert 'duplicate_of' not in comparator.compare_images(reference_bytes, reference_bytes,
+                                                           session_id='inspecao-1')
@@ -0,0 +1,67 @@
+"""Rajada de quadros: pré-pontuação, melhor quadro e orçamento"""
+
+import cv2
+import numpy as np
+import pytest
+
+from automation_worker import RequestHandler
+from conftest import b64, encode, photograph
+from image_comparison import ImageComparator
+
+
+@pytest.fixture(scope='module')
+def frames(label):
+    photo = photograph(label)
+    return {
+        'blurred': encode(cv2.GaussianBlur(photo, (21, 21), 0), '.jpg'),
+        'sharp': encode(photo, '.jpg'),
+        'empty': encode(photograph(np.full_like(label, 128)), '.jpg')
+    }
+
+
+def test_sharp_framed_frame_wins(reference_bytes, frames):
+    stream = ImageComparator(localize=True).open_stream(reference_bytes, 'ssim')
+    reports = {name: stream.push(data)['frame'] for name, data in frames.items()}
+
+    assert stream.best['frame'] == reports['sharp']['frame']
+    assert reports['sharp']['confidence'] > reports['empty']['confidence']
+    assert reports['sharp']['sharpness'] > reports['blurred']['sharpness']
+
+    result = stream.finish()
+    assert result['stream']['frames'] == 3
+    assert result['score'] == ImageComparator(localize=True).compare_images(reference_bytes, frames['sharp'],
+                                                                            'ssim')['score']
+
+
+def test_frame_budget_ends_the_burst(reference_bytes, frames):
+    stream = ImageComparator().open_stream(reference_bytes, max_frames=2, max_seconds=None)
+
+    stream.push(frames['blurred'])
+    second = stream.push(frames['blurred'])
+    third = stream.push(frames['sharp'])
+
+    assert second['done'] and third['skipped']
+    assert stream.best['frame'] == 0
+
+
+def test_finish_without_frames_is_an_error(reference_bytes):
+    with pytest.raises(ValueError):
+        ImageComparator().open_stream(reference_bytes).finish()
+
+
+def test_worker_stream_operations(reference_bytes, frames):
+    handler = RequestHandler()
+    sequence = [frames['blurred'], reference_bytes, frames['blurred']]
+
+    opened = handler.handle({'op': 'stream_open', 'params': {'stream_id': 's1', 'max_frames': 3,
+                                                             'reference_b64': b64(reference_bytes)}})
+    pushed = [handler.handle({'op': 'stream_frame', 'params': {'stream_id': 's1', 'frame_b64': b64(frame)}})
+              for frame in sequence]
+    finished = handler.handle({'op': 'stream_finish', 'params': {'stream_id': 's1'}})
+
+    assert opened['ok'] and all(response['ok'] for response in pushed)
+    assert pushed[-1]['result']['done']
+    assert finished['result']['stream']['best_frame']['frame'] == 1
+    assert finished['result']['score'] == 1.0
+    # O fluxo é descartado ao terminar
+    assert not handler.handle({'op': 'stream_finish', 'params': {'stream_id': 's1'}})['ok']
@@ -0,0 +1,51 @@
+"""SSIM por blocos com memória constante, mapa de diferenças e piores regiões"""
+
+import cv2
+import numpy as np
+import pytest
+
+from benchmark_image_comparison import perturb
+from conftest import encode
+from image_comparison import ImageComparator, ssim_map, tiled_ssim
+
+DEFECT_BOX = (60, 180, 540, 270)  # a caixa apagada por perturb(..., 'defect') em 1200x900
+
+
+@pytest.fixture(scope='module')
+def grays(label):
+    reference = cv2.cvtColor(label, cv2.COLOR_BGR2GRAY)
+    return reference, cv2.cvtColor(perturb(label, 'noise', seed=1), cv2.COLOR_BGR2GRAY)
+
+
+@pytest.mark.parametrize('engine', ['skimage', 'fast'])
+def test_tiled_ssim_matches_whole_image(grays, engine):
+    reference, test = grays
+    whole = float(ssim_map(reference, test, engine=engine).mean())
+
+    assert tiled_ssim(reference, test, tile=128, engine=engine)['score'] == pytest.approx(whole, abs=1e-6)
+
+
+def test_methods_are_the_supported_set():
+    # Os engines de SSIM são internos ao método ssim, não métodos próprios
+    assert set(ImageComparator().methods) == {'ssim', 'orb', 'template', 'color'}
+
+
+def test_small_tiles_do_not_change_the_score(reference_bytes, label):
+    test = encode(perturb(label, 'noise', seed=1))
+    whole = ImageComparator().compare_images(reference_bytes, test, 'ssim')
+    tiled = ImageComparator(ssim_tile=128).compare_images(reference_bytes, test, 'ssim')
+
+    assert tiled['score'] == pytest.approx(whole['score'], abs=1e-4)
+
+
+@pytest.mark.parametrize('engine', ['skimage', 'fast'])
+def test_difference_regions_cover_the_defect(reference_bytes, label, engine):
+    result = ImageComparator(ssim_engine=engine).compare_images(
+        reference_bytes, encode(perturb(label, 'defect')), 'ssim'
+    )
+
+    left, top, right, bottom = DEFECT_BOX
+    worst = result['difference_regions'][0]
+    assert worst['x'] < right and worst['x'] + worst['width'] > left
+    assert worst['y'] < bottom and worst['y'] + worst['height'] > top
+    assert np.asarray(result['ssim_heatmap']).min() >= 0
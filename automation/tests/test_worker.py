@@ -0,0 +1,93 @@
+"""Protocolo do worker persistente: operações, erros e JSON lines em stdin/stdout"""
+
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import automation_worker
+from automation_worker import RequestHandler, encode_response
+from benchmark_image_comparison import perturb
+from conftest import b64, encode
+
+WORKER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'automation_worker.py')
+
+
+@pytest.fixture
+def handler():
+    return RequestHandler({'max_input_pixels': None})
+
+
+def test_ping(handler):
+    response = handler.handle({'op': 'ping'})
+
+    assert response == {'ok': True, 'result': {'pid': os.getpid()}, 'error': None}
+
+
+def test_unknown_operation_is_an_error_response(handler):
+    response = handler.handle({'op': 'resize', 'params': {}})
+
+    assert not response['ok'] and response['result'] is None
+    assert 'resize' in response['error']
+
+
+def test_missing_parameter_is_an_error_response(handler, reference_bytes):
+    response = handler.handle({'op': 'compare', 'params': {'reference_b64': b64(reference_bytes)}})
+
+    assert not response['ok']
+
+
+def test_compare_with_base64_images(handler, reference_bytes, label):
+    response = handler.handle({'op': 'compare', 'params': {
+        'reference_b64': b64(reference_bytes), 'test_b64': b64(encode(perturb(label, 'noise'))), 'method': 'ssim'
+    }})
+
+    assert response['ok'] and response['result']['success']
+    assert response['result']['test_image'].endswith('bytes>')
+    assert json.loads(encode_response(response))['result']['score'] == response['result']['score']
+
+
+def test_concurrent_pdf_requests_keep_their_own_options(handler, monkeypatch):
+    # No modo em processo o servidor de socket atende requisições em threads
+    both_started = threading.Barrier(2)
+
+    def convert(converter, pdf_bytes, filename):
+        both_started.wait(timeout=5)
+        time.sleep(0.05)
+        return {'success': True, 'dpi': converter.dpi, 'format': converter.format, 'image_bytes': b''}
+
+    monkeypatch.setattr(automation_worker.PDFToImageConverter, 'convert_pdf_bytes_in_memory', convert)
+    requests = [{'op': 'pdf_to_image', 'params': {'pdf_b64': b64(b'%PDF'), 'dpi': dpi, 'format': image_format}}
+                for dpi, image_format in ((150, 'PNG'), (300, 'JPEG'))]
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        responses = list(executor.map(handler.handle, requests))
+
+    assert [(response['result']['dpi'], response['result']['format']) for response in responses] == [
+        (150, 'PNG'), (300, 'JPEG')
+    ]
+
+
+def test_stdio_worker_answers_with_request_ids(reference_bytes):
+    requests = [
+        {'id': 'a', 'op': 'ping'},
+        {'id': 'b', 'op': 'compare', 'params': {'reference_b64': b64(reference_bytes),
+                                                'test_b64': b64(reference_bytes)}},
+        {'id': 'c', 'op': 'nope'}
+    ]
+    stdin = ''.join(json.dumps(request) + '\n' for request in requests) + 'not json\n'
+
+    completed = subprocess.run([sys.executable, WORKER, '--workers', '1'], input=stdin, capture_output=True,
+                               text=True, timeout=120)
+
+    responses = [json.loads(line) for line in completed.stdout.splitlines()]
+    by_id = {response['id']: response for response in responses}
+    assert by_id['a']['ok'] and by_id['a']['result']['pid'] != os.getpid()
+    assert by_id['b']['ok'] and by_id['b']['result']['score'] == 1.0
+    assert not by_id['c']['ok']
+    assert not by_id[None]['ok']
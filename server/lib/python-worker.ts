@@ -0,0 +1,207 @@
+import { spawn, ChildProcessWithoutNullStreams } from 'child_process';
+import path from 'path';
+import readline from 'readline';
+import { logger } from './logger';
+
+export interface PythonWorkerOptions {
+  pythonPath: string;      // Executável Python
+  scriptPath: string;      // Script do worker persistente
+  workers: number;         // Número de processos worker no lado Python
+  requestTimeout: number;  // Timeout por requisição em ms
+  restartDelay: number;    // Intervalo antes de reiniciar o worker após falha em ms
+  referenceIndex: string;  // Arquivo do índice de referências, compartilhado entre os processos worker
+  qualityGate: string;     // Verificação de qualidade das fotos (opcional): 'true', 'false' ou limites em JSON
+}
+
+export interface PythonWorkerResponse<T = any> {
+  id: string;
+  ok: boolean;
+  result: T | null;
+  error: string | null;
+}
+
+interface PendingRequest {
+  resolve: (value: any) => void;
+  reject: (error: Error) => void;
+  timer: NodeJS.Timeout;
+}
+
+/**
+ * Cliente do worker Python persistente (automation/automation_worker.py).
+ * Mantém um único processo python3 com as bibliotecas de imagem já carregadas
+ * e troca requisições JSON lines identificadas por id.
+ */
+class PythonWorkerPool {
+  private static instance: PythonWorkerPool;
+  private process: ChildProcessWithoutNullStreams | null = null;
+  private pending: Map<string, PendingRequest> = new Map();
+  private options: PythonWorkerOptions;
+  private nextId = 0;
+  private restartTimer: NodeJS.Timeout | null = null;
+  private shuttingDown = false;
+  private startHooks: Array<() => void> = [];
+
+  private constructor(options?: Partial<PythonWorkerOptions>) {
+    this.options = {
+      pythonPath: process.env.PYTHON_PATH || 'python3',
+      scriptPath: path.join(__dirname, '../../automation/automation_worker.py'),
+      workers: parseInt(process.env.PYTHON_WORKERS || '2'),
+      requestTimeout: parseInt(process.env.PYTHON_WORKER_TIMEOUT || '60000'),
+      restartDelay: 1000,
+      referenceIndex: process.env.LABEL_REFERENCE_INDEX || path.join(process.cwd(), 'uploads', 'reference-index.npz'),
+      // Desligada por padrão: fotos recusadas voltam 422 e o operador precisa
+      // fotografar de novo; ative com LABEL_QUALITY_GATE=true ou limites em JSON
+      qualityGate: process.env.LABEL_QUALITY_GATE || 'false',
+      ...options
+    };
+  }
+
+  static getInstance(options?: Partial<PythonWorkerOptions>): PythonWorkerPool {
+    if (!PythonWorkerPool.instance) {
+      PythonWorkerPool.instance = new PythonWorkerPool(options);
+    }
+    return PythonWorkerPool.instance;
+  }
+
+  /**
+   * Executar uma operação no worker (ex.: 'compare', 'compare_all', 'pdf_to_image')
+   */
+  public request<T = any>(op: string, params: Record<string, any> = {}, timeout?: number): Promise<T> {
+    this.ensureStarted();
+
+    const id = String(++this.nextId);
+    const timeoutMs = timeout ?? this.options.requestTimeout;
+
+    return new Promise<T>((resolve, reject) => {
+      const timer = setTimeout(() => {
+        this.pending.delete(id);
+        reject(new Error(`Timeout de ${timeoutMs}ms na operação Python '${op}'`));
+      }, timeoutMs);
+
+      this.pending.set(id, { resolve, reject, timer });
+      this.process!.stdin.write(JSON.stringify({ id, op, params }) + '\n');
+    });
+  }
+
+  /**
+   * Registrar uma função chamada sempre que o processo do worker é iniciado
+   * (inclusive nos reinícios após falha)
+   */
+  public onStart(hook: () => void): void {
+    this.startHooks.push(hook);
+  }
+
+  /**
+   * Arquivo do índice de referências usado pelo worker
+   */
+  public get referenceIndexPath(): string {
+    return this.options.referenceIndex;
+  }
+
+  /**
+   * Encerrar o worker (usado no desligamento do servidor)
+   */
+  public shutdown(): void {
+    this.shuttingDown = true;
+    if (this.restartTimer) {
+      clearTimeout(this.restartTimer);
+      this.restartTimer = null;
+    }
+    if (this.process) {
+      this.process.kill('SIGTERM');
+      this.process = null;
+    }
+  }
+
+  private ensureStarted(): void {
+    if (this.process) {
+      return;
+    }
+
+    this.shuttingDown = false;
+    const child = spawn(this.options.pythonPath, [
+      this.options.scriptPath,
+      '--workers', String(this.options.workers),
+      '--request-timeout', String(Math.ceil(this.options.requestTimeout / 1000)),
+      '--reference-index', this.options.referenceIndex,
+      '--quality-gate', this.options.qualityGate
+    ]);
+    this.process = child;
+
+    readline.createInterface({ input: child.stdout }).on('line', (line) => this.handleLine(line));
+
+    child.stderr.on('data', (data) => {
+      // O worker registra seus logs em stderr; apenas erros são repassados
+      const message = data.toString();
+      if (message.includes('ERROR') || message.includes('Traceback')) {
+        logger.warn('PYTHON_WORKER', 'STDERR', { message: message.trim() });
+      }
+    });
+
+    child.on('error', (error) => {
+      logger.error('PYTHON_WORKER', 'SPAWN_ERROR', error);
+      this.handleExit(child, null);
+    });
+
+    child.on('exit', (code) => this.handleExit(child, code));
+
+    logger.info('PYTHON_WORKER', 'STARTED', { pid: child.pid, workers: this.options.workers });
+
+    // Executados após a requisição que iniciou o processo ser enviada
+    for (const hook of this.startHooks) {
+      setImmediate(hook);
+    }
+  }
+
+  private handleLine(line: string): void {
+    let response: PythonWorkerResponse;
+    try {
+      response = JSON.parse(line);
+    } catch (error) {
+      logger.warn('PYTHON_WORKER', 'INVALID_RESPONSE', { line });
+      return;
+    }
+
+    const pending = this.pending.get(response.id);
+    if (!pending) {
+      return;
+    }
+
+    this.pending.delete(response.id);
+    clearTimeout(pending.timer);
+
+    if (response.ok) {
+      pending.resolve(response.result);
+    } else {
+      pending.reject(new Error(`Erro no worker Python: ${response.error}`));
+    }
+  }
+
+  private handleExit(child: ChildProcessWithoutNullStreams, code: number | null): void {
+    if (this.process !== child) {
+      return;
+    }
+    this.process = null;
+
+    // Rejeitar requisições em andamento; novas requisições reiniciam o processo
+    for (const [id, pending] of this.pending) {
+      clearTimeout(pending.timer);
+      pending.reject(new Error(`Worker Python finalizado (código ${code})`));
+      this.pending.delete(id);
+    }
+
+    if (this.shuttingDown) {
+      return;
+    }
+
+    logger.warn('PYTHON_WORKER', 'EXITED', { code });
+    this.restartTimer = setTimeout(() => {
+      this.restartTimer = null;
+      if (!this.shuttingDown) {
+        this.ensureStarted();
+      }
+    }, this.options.restartDelay);
+  }
+}
+
+export const pythonWorker = PythonWorkerPool.getInstance();
@@ -1,13 +1,12 @@
 import express from 'express';
 import multer from 'multer';
-import path from 'path';
 import fs from 'fs';
-import { spawn } from 'child_process';
 import { createClient } from '@supabase/supabase-js';
 import { db } from '../db';
 import { etiquetaQuestions, etiquetaInspectionResults } from '../../shared/schema';
-import { eq, and } from 'drizzle-orm';
+import { eq, and, inArray } from 'drizzle-orm';
 import { logger } from '../lib/logger';
+import { pythonWorker } from '../lib/python-worker';
 
 // Configurar cliente Supabase
 const supabaseUrl = process.env.SUPABASE_URL;
@@ -86,41 +85,86 @@ async function uploadToSupabaseStorage(file: Express.Multer.File, bucket: string
   return urlData.publicUrl;
 }
 
-// Função para executar script Python
-async function executePythonScript(scriptPath: string, args: string[]): Promise<any> {
-  return new Promise((resolve, reject) => {
-    const pythonProcess = spawn('python3', [scriptPath, ...args]);
-    
-    let stdout = '';
-    let stderr = '';
-    
-    pythonProcess.stdout.on('data', (data) => {
-      stdout += data.toString();
-    });
-    
-    pythonProcess.stderr.on('data', (data) => {
-      stderr += data.toString();
-    });
-    
-    pythonProcess.on('close', (code) => {
-      if (code === 0) {
+// Função para baixar um arquivo do Supabase Storage a partir da URL pública salva no banco
+async function downloadFromSupabaseStorage(url: string, bucket: string = 'ENSOS'): Promise<Buffer> {
+  if (!supabase) {
+    throw new Error('Supabase não configurado');
+  }
+
+  const { data, error } = await supabase.storage
+    .from(bucket)
+    .download(url.replace(supabase.storage.from(bucket).getPublicUrl('').data.publicUrl, ''));
+
+  if (error) {
+    throw new Error(`Erro ao baixar arquivo do Supabase Storage: ${error.message}`);
+  }
+
+  return Buffer.from(await data.arrayBuffer());
+}
+
+// Referências enviadas por requisição index_rebuild: cada lote precisa caber no
+// timeout por requisição do worker
+const INDEX_REBUILD_BATCH = 5;
+let indexBackfillRunning = false;
+
+// Indexar as referências já cadastradas quando o arquivo do índice não existe
+// (primeiro deploy do índice ou arquivo apagado); perguntas criadas depois
+// entram pelo index_add do cadastro
+async function backfillReferenceIndex(): Promise<void> {
+  if (indexBackfillRunning || fs.existsSync(pythonWorker.referenceIndexPath)) {
+    return;
+  }
+  if (!supabase) {
+    logger.warn('ETIQUETA_QUESTIONS', 'INDEX_BACKFILL_SKIPPED', { reason: 'Supabase não configurado' });
+    return;
+  }
+
+  indexBackfillRunning = true;
+  const startTime = Date.now();
+  let indexed = 0;
+  const failed: string[] = [];
+
+  try {
+    const questions = await db.select({
+      id: etiquetaQuestions.id,
+      arquivoReferencia: etiquetaQuestions.arquivoReferencia
+    }).from(etiquetaQuestions);
+
+    for (let start = 0; start < questions.length; start += INDEX_REBUILD_BATCH) {
+      const references = [];
+      for (const question of questions.slice(start, start + INDEX_REBUILD_BATCH)) {
         try {
-          const result = JSON.parse(stdout);
-          resolve(result);
-        } catch (error) {
-          reject(new Error(`Erro ao parsear resultado do Python: ${stdout}`));
+          const referenceBuffer = await downloadFromSupabaseStorage(question.arquivoReferencia);
+          references.push({ id: String(question.id), reference_b64: referenceBuffer.toString('base64') });
+        } catch (error: any) {
+          logger.warn('ETIQUETA_QUESTIONS', 'INDEX_BACKFILL_DOWNLOAD_ERROR', { id: question.id, error: error.message });
+          failed.push(String(question.id));
         }
-      } else {
-        reject(new Error(`Script Python falhou: ${stderr}`));
       }
+
+      if (references.length > 0) {
+        const result = await pythonWorker.request('index_rebuild', { references });
+        indexed += result.indexed;
+        failed.push(...result.failed);
+      }
+    }
+
+    logger.performance('ETIQUETA_QUESTIONS', 'INDEX_BACKFILL', Date.now() - startTime, {
+      questions: questions.length,
+      indexed,
+      failed
     });
-    
-    pythonProcess.on('error', (error) => {
-      reject(new Error(`Erro ao executar script Python: ${error.message}`));
-    });
-  });
+  } catch (error) {
+    logger.error('ETIQUETA_QUESTIONS', 'INDEX_BACKFILL_ERROR', error);
+  } finally {
+    indexBackfillRunning = false;
+  }
 }
 
+pythonWorker.onStart(() => {
+  backfillReferenceIndex();
+});
+
 // POST /api/etiqueta-questions - Criar nova pergunta de etiqueta
 router.post('/', upload.single('arquivo_referencia'), async (req: any, res) => {
   const startTime = Date.now();
@@ -144,34 +188,17 @@ router.post('/', upload.single('arquivo_referencia'), async (req: any, res) => {
 
     let referenceUrl: string;
     let originalUrl: string;
+    let referenceImage: Buffer;
 
     if (req.file.mimetype === 'application/pdf') {
       // Se for PDF, converter para imagem
       originalUrl = await uploadToSupabaseStorage(req.file, 'ENSOS', `PLANOS/etiquetas/${question_id}_reference.pdf`);
       
-      // Converter PDF para imagem usando script Python
-      const scriptPath = path.join(__dirname, '../../automation/pdf_to_image.py');
-      
-      // Salvar PDF temporariamente para conversão
-      const tempPdfPath = path.join(__dirname, '../../uploads/temp', `${question_id}_temp.pdf`);
-      const tempDir = path.dirname(tempPdfPath);
-      if (!fs.existsSync(tempDir)) {
-        fs.mkdirSync(tempDir, { recursive: true });
-      }
-      fs.writeFileSync(tempPdfPath, req.file.buffer);
-      
-      const conversionResult = await executePythonScript(scriptPath, [
-        tempPdfPath,
-        '--output', `${question_id}_reference.png`,
-        '--upload-dir', path.join(__dirname, '../../uploads/temp')
-      ]);
-      
-      // Limpar arquivo temporário
-      try {
-        fs.unlinkSync(tempPdfPath);
-      } catch (error) {
-        logger.warn('ETIQUETA_QUESTIONS', 'CLEANUP_TEMP_ERROR', error);
-      }
+      // Converter PDF para imagem em memória usando o worker Python persistente
+      const conversionResult = await pythonWorker.request('pdf_to_image', {
+        pdf_b64: req.file.buffer.toString('base64'),
+        filename: req.file.originalname
+      });
       
       if (!conversionResult.success) {
         throw new Error(`Falha na conversão do PDF: ${conversionResult.error}`);
@@ -179,25 +206,20 @@ router.post('/', upload.single('arquivo_referencia'), async (req: any, res) => {
       
       // Upload da imagem convertida para o Supabase Storage
       const imageFileName = `PLANOS/etiquetas/${question_id}_reference.png`;
-      const imageBuffer = fs.readFileSync(conversionResult.output_image);
+      const imageBuffer = Buffer.from(conversionResult.image_b64, 'base64');
+      referenceImage = imageBuffer;
       referenceUrl = await uploadToSupabaseStorage(
         { ...req.file, buffer: imageBuffer, mimetype: 'image/png' } as Express.Multer.File,
         'ENSOS',
         imageFileName
       );
-      
-      // Limpar arquivo de imagem temporário
-      try {
-        fs.unlinkSync(conversionResult.output_image);
-      } catch (error) {
-        logger.warn('ETIQUETA_QUESTIONS', 'CLEANUP_IMAGE_ERROR', error);
-      }
     } else {
       // Se for imagem, usar diretamente
       const fileExtension = req.file.originalname.split('.').pop() || 'png';
       const imageFileName = `PLANOS/etiquetas/${question_id}_reference.${fileExtension}`;
       referenceUrl = await uploadToSupabaseStorage(req.file, 'ENSOS', imageFileName);
       originalUrl = referenceUrl; // Para imagens, o original é o mesmo
+      referenceImage = req.file.buffer;
     }
     
     // Salvar pergunta no banco
@@ -212,6 +234,17 @@ router.post('/', upload.single('arquivo_referencia'), async (req: any, res) => {
       pdf_original_url: originalUrl
     }).returning();
     
+    // Incluir a referência no índice usado para identificar etiquetas por foto;
+    // uma falha aqui não impede o cadastro da pergunta
+    try {
+      await pythonWorker.request('index_add', {
+        id: String(newQuestion[0].id),
+        reference_b64: referenceImage.toString('base64')
+      });
+    } catch (error) {
+      logger.warn('ETIQUETA_QUESTIONS', 'INDEX_ADD_ERROR', error, { id: newQuestion[0].id });
+    }
+    
     const duration = Date.now() - startTime;
     logger.performance('ETIQUETA_QUESTIONS', 'CREATE_QUESTION', duration, { 
       id: newQuestion[0].id,
@@ -229,6 +262,41 @@ router.post('/', upload.single('arquivo_referencia'), async (req: any, res) => {
   }
 });
 
+// POST /api/etiqueta-questions/identify - Encontrar as etiquetas mais parecidas com uma foto
+router.post('/identify', upload.single('test_photo'), async (req: any, res) => {
+  const startTime = Date.now();
+  
+  try {
+    if (!req.file) {
+      return res.status(400).json({ message: 'Foto de teste é obrigatória' });
+    }
+    
+    const k = Math.min(parseInt(req.body?.k || '5') || 5, 50);
+    const { matches } = await pythonWorker.request('index_query', {
+      photo_b64: req.file.buffer.toString('base64'),
+      k
+    });
+    
+    const questions = matches.length > 0
+      ? await db.select().from(etiquetaQuestions).where(inArray(etiquetaQuestions.id, matches.map((match: any) => match.id)))
+      : [];
+    const questionsById = new Map(questions.map((question: any) => [String(question.id), question]));
+    
+    // Referências removidas do banco mas ainda presentes no índice são descartadas
+    const candidates = matches
+      .filter((match: any) => questionsById.has(match.id))
+      .map((match: any) => ({ ...match, question: questionsById.get(match.id) }));
+    
+    const duration = Date.now() - startTime;
+    logger.performance('ETIQUETA_QUESTIONS', 'IDENTIFY', duration, { candidates: candidates.length });
+    
+    res.json({ candidates });
+  } catch (error: any) {
+    logger.error('ETIQUETA_QUESTIONS', 'IDENTIFY_ERROR', error, req);
+    res.status(500).json({ message: 'Erro ao identificar etiqueta' });
+  }
+});
+
 // GET /api/etiqueta-questions - Listar perguntas de etiqueta
 router.get('/', async (req: any, res) => {
   try {
@@ -303,54 +371,52 @@ router.post('/:id/inspect', upload.single('test_photo'), async (req: any, res) =
       userId: req.user?.id 
     }, req);
 
-    // Upload da foto de teste para o Supabase Storage
-    const testPhotoFileName = `PLANOS/etiquetas/test_photos/${inspection_session_id}_${Date.now()}.jpg`;
-    const testPhotoUrl = await uploadToSupabaseStorage(req.file, 'ENSOS', testPhotoFileName);
-
-    // Executar comparação de imagens usando script Python
-    const scriptPath = path.join(__dirname, '../../automation/image_comparison.py');
-    
-    // Salvar foto de teste temporariamente para comparação
-    const tempTestPhotoPath = path.join(__dirname, '../../uploads/temp', `test_${Date.now()}.jpg`);
-    const tempDir = path.dirname(tempTestPhotoPath);
-    if (!fs.existsSync(tempDir)) {
-      fs.mkdirSync(tempDir, { recursive: true });
-    }
-    fs.writeFileSync(tempTestPhotoPath, req.file.buffer);
-    
     // Baixar imagem de referência do Supabase Storage
-    const referenceImagePath = path.join(__dirname, '../../uploads/temp', `ref_${Date.now()}.png`);
-    const { data: refImageData, error: refError } = await supabase.storage
-      .from('ENSOS')
-      .download(etiquetaQuestion.arquivo_referencia.replace(supabase.storage.from('ENSOS').getPublicUrl('').data.publicUrl, ''));
-    
-    if (refError) {
-      throw new Error(`Erro ao baixar imagem de referência: ${refError.message}`);
-    }
+    const referenceBuffer = await downloadFromSupabaseStorage(etiquetaQuestion.arquivoReferencia);
     
-    fs.writeFileSync(referenceImagePath, Buffer.from(await refImageData.arrayBuffer()));
+    // Caminho da foto no Storage; também identifica a foto na deduplicação da sessão
+    const testPhotoFileName = `PLANOS/etiquetas/test_photos/${inspection_session_id}_${Date.now()}.jpg`;
     
-    const comparisonResult = await executePythonScript(scriptPath, [
-      referenceImagePath,
-      tempTestPhotoPath,
-      '--method', 'ssim'
-    ]);
+    // Executar comparação de imagens em memória usando o worker Python persistente
+    const comparisonResult = await pythonWorker.request('compare', {
+      reference_b64: referenceBuffer.toString('base64'),
+      test_b64: req.file.buffer.toString('base64'),
+      // O SSIM traz o mapa de diferenças e as regiões mais diferentes
+      // (difference_regions) para destacar o defeito; fotos grandes são
+      // comparadas por blocos dentro do comparador
+      method: 'ssim',
+      // Drizzle devolve as colunas em camelCase (limiteAprovacao)
+      threshold: etiquetaQuestion.limiteAprovacao,
+      // Fotos quase idênticas da mesma sessão reaproveitam o score (duplicate_of)
+      session_id: inspection_session_id,
+      photo_id: testPhotoFileName
+    });
     
-    // Limpar arquivos temporários
-    try {
-      fs.unlinkSync(tempTestPhotoPath);
-      fs.unlinkSync(referenceImagePath);
-    } catch (error) {
-      logger.warn('ETIQUETA_INSPECTION', 'CLEANUP_TEMP_ERROR', error);
+    if (comparisonResult.error_code === 'QUALITY_REJECTED') {
+      // Foto inadequada (tremida, escura, pequena...): o operador deve tirar outra
+      logger.info('ETIQUETA_INSPECTION', 'INSPECT_QUALITY_REJECTED', {
+        question_id: id,
+        reasons: comparisonResult.quality?.reasons
+      }, req);
+      return res.status(422).json({
+        message: 'Foto recusada na verificação de qualidade. Tire outra foto da etiqueta.',
+        error_code: comparisonResult.error_code,
+        reasons: comparisonResult.quality?.reasons,
+        quality: comparisonResult.quality
+      });
     }
     
     if (!comparisonResult.success) {
       throw new Error(`Falha na comparação de imagens: ${comparisonResult.error}`);
     }
     
+    // Upload da foto de teste para o Supabase Storage (só depois de ela passar
+    // pela verificação de qualidade, para não guardar fotos que serão refeitas)
+    const testPhotoUrl = await uploadToSupabaseStorage(req.file, 'ENSOS', testPhotoFileName);
+    
     // Determinar resultado final
     const similarityScore = comparisonResult.score;
-    const isApproved = similarityScore >= etiquetaQuestion.limite_aprovacao;
+    const isApproved = similarityScore >= etiquetaQuestion.limiteAprovacao;
     const resultadoFinal = isApproved ? 'APROVADO' : 'REPROVADO';
     
     // Salvar resultado no banco
@@ -452,6 +518,12 @@ router.delete('/:id', async (req: any, res) => {
     // Excluir do banco (cascade irá excluir resultados também)
     await db.delete(etiquetaQuestions).where(eq(etiquetaQuestions.id, id));
     
+    try {
+      await pythonWorker.request('index_remove', { id: String(id) });
+    } catch (error) {
+      logger.warn('ETIQUETA_QUESTIONS', 'INDEX_REMOVE_ERROR', error, { id });
+    }
+    
     res.json({ message: 'Pergunta excluída com sucesso' });
   } catch (error: any) {
     logger.error('ETIQUETA_QUESTIONS', 'DELETE_QUESTION_ERROR', error, req);